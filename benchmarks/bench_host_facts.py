@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Count and time the probes made by the power and laptop checks of an
+# unattended install in coreconfig-softwareupdate-run.py, as the script
+# originally made them and through HostFacts.
+#
+# Probes are answered from the outputs collected in fixtures/host_facts
+# after --latency seconds, so this runs anywhere. The parsing of those
+# outputs is checked by tests/test_host_facts.py.
+#
+# The script is Python 2, so run this with the same Python it uses.
+#
+# Usage: bench_host_facts.py [--latency 0.03] [--model macbookpro]
+#                            [--power macbookpro-discharging] [--checks 3]
+#
+##################################################################
+
+from __future__ import print_function
+import argparse
+import imp
+import logging
+import os
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(HERE), 'coreconfig-softwareupdate-run.py')
+FIXTURES = os.path.join(HERE, 'fixtures', 'host_facts')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as output:
+        return output.read()
+
+
+class Prober(object):
+    """ Answers sysctl and pmset from fixtures, counting the calls """
+    def __init__(self, model, power, latency):
+        self.outputs = {'sysctl': fixture('sysctl-hw.model-{}.txt'.format(model)),
+                        'pmset': fixture('pmset-batt-{}.txt'.format(power))}
+        self.latency = latency
+        self.calls = 0
+
+    def __call__(self, cmd):
+        self.calls += 1
+        time.sleep(self.latency)
+        return self.outputs[cmd[0]]
+
+
+def legacy_checks(run, min_battery):
+    # unattended_install()'s checks, as the script originally made them
+    def is_a_laptop():
+        return run(['sysctl', 'hw.model']).find('MacBook') > 0
+
+    def using_ac_power():
+        return run(['pmset', '-g', 'batt']).split("\t")[0].split(" ")[3][1:] == 'AC'
+
+    def min_battery_level(min):
+        if is_a_laptop():
+            try:
+                return int(run(['pmset', '-g', 'batt']).split("\t")[1].split(';')[0][:-1]) >= min
+            except (IndexError, ValueError):
+                return False
+
+    return (using_ac_power() or min_battery_level(min_battery)), is_a_laptop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and time the host facts probes')
+    parser.add_argument('--latency', type=float, default=0.03, help='seconds each probe takes')
+    parser.add_argument('--model', default='macbookpro', help='which sysctl-hw.model fixture to use')
+    parser.add_argument('--power', default='macbookpro-discharging', help='which pmset-batt fixture to use')
+    parser.add_argument('--checks', type=int, default=3, help='times the checks are made in a run')
+    args = parser.parse_args()
+
+    swupdate = imp.load_source('swupdate_run', SCRIPT)
+    swupdate.logger.addHandler(logging.NullHandler())
+
+    legacy = Prober(args.model, args.power, args.latency)
+    start = time.time()
+    for _ in range(args.checks):
+        legacy_answer = legacy_checks(legacy, 20)
+    legacy_seconds = time.time() - start
+
+    cached = Prober(args.model, args.power, args.latency)
+    swupdate.host_facts = swupdate.HostFacts(cached)
+    start = time.time()
+    for _ in range(args.checks):
+        answer = (swupdate.using_ac_power() or swupdate.min_battery_level(20)), swupdate.is_a_laptop()
+    cached_seconds = time.time() - start
+
+    print('{:<12} {:>8} {:>10}  {}'.format('approach', 'probes', 'seconds', '(ok to install, laptop)'))
+    print('{:<12} {:>8} {:>10.3f}  {}'.format('original', legacy.calls, legacy_seconds, legacy_answer))
+    print('{:<12} {:>8} {:>10.3f}  {}'.format('HostFacts', cached.calls, cached_seconds, answer))
+
+
+if __name__ == '__main__':
+    main()
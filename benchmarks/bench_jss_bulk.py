@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Compare the original one-at-a-time DELETE loop from
+# remove-redundant-records.py with the concurrent jss_bulk engine,
+# against a local fake JSS which injects latency and errors.
+#
+# The sequential loop stops at the first error, so it is only run
+# against an error-free server.
+#
+# Usage: bench_jss_bulk.py [--records 500] [--latency 0.05]
+#                          [--error-rate 0.05] [--workers 8] [--rate 0]
+#
+##################################################################
+
+from __future__ import print_function
+import argparse
+import base64
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import jss_bulk
+import jss_client
+from fake_jss import FakeJSS, computer_records
+
+try:
+    import urllib2
+except ImportError:
+    import urllib.request as urllib2
+
+
+def legacy_remove_computers(base_url, computers):
+    # As remove-redundant-records.py originally did it
+    for comp in computers:
+        request = urllib2.Request('{}/computers/name/{}'.format(base_url, comp))
+        request.add_header('Accept', 'application/json')
+        request.add_header('Authorization', 'Basic ' + base64.b64encode(b'user:pass').decode('ascii'))
+        request.get_method = lambda: 'DELETE'
+        urllib2.urlopen(request).read()
+
+
+def report(label, records, elapsed, summary):
+    print('{:<28} {:>8} {:>9.2f} {:>9.1f}  {}'.format(label, records, elapsed, records / elapsed, summary))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bulk DELETEs against a fake JSS')
+    parser.add_argument('--records', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.05, help='server delay per request (s)')
+    parser.add_argument('--error-rate', type=float, default=0.05, help='fraction of requests which fail')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=0, help='requests/s limit, 0 for none')
+    args = parser.parse_args()
+
+    computers = dict((comp['id'], jss_client.computer_record(comp)) for comp in computer_records(args.records))
+    names = [comp['name'] for comp in computers.values()]
+    print('{:<28} {:>8} {:>9} {:>9}  {}'.format('engine', 'records', 'seconds', 'rec/s', 'outcomes'))
+
+    server = FakeJSS(group_size=args.records, latency=args.latency).start()
+    try:
+        start = time.time()
+        legacy_remove_computers(server.base_url, names)
+        report('sequential (no errors)', args.records, time.time() - start, '')
+    finally:
+        server.stop()
+
+    for error_rate in (0.0, args.error_rate):
+        server = FakeJSS(group_size=args.records, latency=args.latency, error_rate=error_rate).start()
+        client = jss_client.JSSClient('user', 'pass', base_url=server.base_url, pool_size=args.workers)
+        try:
+            start = time.time()
+            outcomes = jss_bulk.delete_computers(client, computers, workers=args.workers,
+                                                 rate=args.rate or None, backoff=0.01)
+            elapsed = time.time() - start
+            report('bulk x{} ({:.0%} errors)'.format(args.workers, error_rate), args.records, elapsed,
+                   'statuses {}, {} requests sent'.format(jss_bulk.summarise(outcomes), len(server.requests)))
+        finally:
+            client.close()
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Compare the original one-shot urllib2 + json.loads group fetch with
+# the streaming, keep-alive jss_client against a local fake JSS.
+#
+# Each measurement runs in its own process so that peak RSS reflects
+# only that approach.
+#
+# Usage: bench_jss_client.py [--size 50000] [--repeat 200]
+#
+##################################################################
+
+from __future__ import print_function
+import argparse
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import jss_client
+from fake_jss import FakeJSS
+
+try:
+    import urllib2
+    from urllib import quote
+except ImportError:
+    import urllib.request as urllib2
+    from urllib.parse import quote
+
+BIG_GROUP = 'Compliance - Check in over 365 days'
+SMALL_GROUP = 'Benchmark - small group'
+
+
+def peak_rss_kb():
+    # ru_maxrss survives exec on Linux, so it would include the parent's
+    # peak; the high-water mark in /proc is reset for the new image
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def legacy_get_computers(base_url, group):
+    # As the cleanup scripts originally did it
+    request = urllib2.Request('{}/computergroups/name/{}'.format(base_url, quote(group, safe='')))
+    request.add_header('Accept', 'application/json')
+    request.add_header('Authorization', 'Basic ' + base64.b64encode(b'user:pass').decode('ascii'))
+    response = urllib2.urlopen(request)
+    response_json = json.loads(response.read())
+    comp_group = {}
+    for computer in response_json['computer_group']['computers']:
+        comp_group[computer.get('name')] = computer.get('serial_number')
+    return comp_group
+
+
+def client_get_computers(client, group):
+    comp_group = {}
+    for computer in client.iter_group_computers(group):
+        comp_group[computer.get('name')] = computer.get('serial_number')
+    return comp_group
+
+
+def run_child(mode, base_url, group, repeat):
+    client = jss_client.JSSClient('user', 'pass', base_url=base_url)
+    start = time.time()
+    for _ in range(repeat):
+        if mode == 'legacy':
+            count = len(legacy_get_computers(base_url, group))
+        else:
+            count = len(client_get_computers(client, group))
+    elapsed = time.time() - start
+    client.close()
+    print(json.dumps({'seconds': elapsed, 'count': count, 'peak_rss_kb': peak_rss_kb()}))
+
+
+def measure(mode, base_url, group, repeat):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', mode,
+                                      '--url', base_url, '--group', group, '--repeat', str(repeat)])
+    return json.loads(output.decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=50000, help='computers in the large group')
+    parser.add_argument('--repeat', type=int, default=200, help='fetches of the small group')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--group', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.url, args.group, args.repeat)
+        return
+
+    server = FakeJSS(group_size=args.size, group_sizes={SMALL_GROUP: 10}).start()
+    # Generate the documents before timing anything
+    server.group(BIG_GROUP)
+    server.group(SMALL_GROUP)
+    try:
+        print('{:<32} {:>10} {:>10} {:>14}'.format('scenario', 'mode', 'seconds', 'peak RSS (KB)'))
+        for label, group, repeat in [('{} member group x1'.format(args.size), BIG_GROUP, 1),
+                                     ('10 member group x{}'.format(args.repeat), SMALL_GROUP, args.repeat)]:
+            for mode in ('legacy', 'client'):
+                result = measure(mode, server.base_url, group, repeat)
+                print('{:<32} {:>10} {:>10.3f} {:>14}'.format(label, mode, result['seconds'], result['peak_rss_kb']))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
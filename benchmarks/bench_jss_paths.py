@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Compare addressing computers as /computers/name/<name> (as the
+# cleanup scripts originally did, with a {name: serial} dict and the
+# name unescaped) with /computers/id/<id>, against a local fake JSS.
+#
+# Requests are sent one at a time over a single kept-alive connection,
+# so the per-request latencies reflect only the cost of the lookup.
+# A proportion of the computers have names with spaces or slashes, or
+# duplicated names, to show which records each approach gets wrong.
+#
+# Usage: bench_jss_paths.py [--records 5000] [--awkward-every 50]
+#                           [--name-lookup-latency 0]
+#
+##################################################################
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import jss_bulk
+import jss_client
+from fake_jss import FakeJSS
+
+
+def run(client, jobs):
+    start = time.time()
+    outcomes = jss_bulk.BulkRunner(client, workers=1, rate=None, attempts=1).run(jobs)
+    return outcomes, time.time() - start
+
+
+def report(label, expected, outcomes, elapsed):
+    stats = jss_bulk.performance(outcomes, elapsed)
+    done = sum(1 for o in outcomes if o.error is None)
+    print('{:<8} {:>9} {:>9} {:>9} {:>10.2f} {:>10.2f} {:>9.1f}'.format(
+        label, expected, len(outcomes), done, stats['p50'] * 1000, stats['p99'] * 1000, stats['per_second']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark name vs ID addressing against a fake JSS')
+    parser.add_argument('--records', type=int, default=5000)
+    parser.add_argument('--awkward-every', type=int, default=50,
+                        help='every Nth computer has a space, slash or duplicate in its name')
+    parser.add_argument('--name-lookup-latency', type=float, default=0.0,
+                        help='extra server delay for a name lookup (s)')
+    args = parser.parse_args()
+
+    server = FakeJSS(group_size=args.records, awkward_every=args.awkward_every,
+                     name_lookup_latency=args.name_lookup_latency).start()
+    client = jss_client.JSSClient('user', 'pass', base_url=server.base_url, pool_size=1)
+    try:
+        group = list(client.iter_group_computers('Compliance - No check-in for over 300 days'))
+        print('{:<8} {:>9} {:>9} {:>9} {:>10} {:>10} {:>9}'.format(
+            'path', 'records', 'sent', 'ok', 'p50 (ms)', 'p99 (ms)', 'req/s'))
+
+        # The original approach: duplicate names collapse in the dict, and
+        # names are put into the URL as they are
+        by_name = dict((comp['name'], comp['serial_number']) for comp in group)
+        jobs = (jss_bulk.Job(name, 'DELETE', '/computers/name/{}'.format(name), None, None) for name in by_name)
+        report('name', len(group), *run(client, jobs))
+
+        by_id = dict((comp['id'], jss_client.computer_record(comp)) for comp in group)
+        jobs = (jss_bulk.Job(comp['id'], 'DELETE', jss_client.computer_path(comp), None, None)
+                for comp in by_id.values())
+        report('id', len(group), *run(client, jobs))
+    finally:
+        client.close()
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
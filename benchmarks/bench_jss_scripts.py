@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Benchmark the record-cleanup scripts' own functions against a local
+# fake JSS (see fake_jss.py), with configurable group size, latency
+# and error rate:
+#
+#   get      - get_computers() from get-redundant-computers.py,
+#              fetching the whole group into an empty cache
+#   remove   - jss_records.remove_computers(), as remove- and
+#              cleanup-redundant-records.py call it
+#   unmanage - jss_records.unmanage_computers(), as unmanage- and
+#              cleanup-redundant-records.py call it
+#
+# Only the imports, constants and function definitions are taken from
+# get-redundant-computers.py, so nothing at its top level is run. Each
+# benchmark runs in its own process so its peak RSS is its own. Reports
+# requests/s, records/s, p50/p99 latency per request and peak RSS.
+#
+# The scripts are Python 2, so run this with the same Python they use.
+#
+# Usage: bench_jss_scripts.py [--records 2000] [--latency 0.02]
+#                             [--group-latency 0] [--error-rate 0]
+#                             [--workers 8] [--rate 0] [--repeat 5]
+#                             [--only get,remove,unmanage] [--json]
+#
+##################################################################
+
+from __future__ import print_function
+import argparse
+import ast
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, REPO)
+sys.path.insert(0, HERE)
+
+import jss_bulk
+import jss_cache
+import jss_client
+import jss_events
+import jss_records
+from bench_jss_client import peak_rss_kb
+from fake_jss import FakeJSS
+
+GROUP = 'Compliance - Check in over 365 days'
+BENCHMARKS = ('get', 'remove', 'unmanage')
+# Which script each benchmark takes its function from
+SCRIPTS = {'get': 'get-redundant-computers.py'}
+
+
+def load_functions(script, namespace):
+    """ Run just the imports, upper case constants and definitions from
+        script in namespace, and return it
+    """
+    path = os.path.join(REPO, script)
+    with open(path) as source:
+        try:
+            tree = ast.parse(source.read(), path)
+        except SyntaxError as e:
+            sys.exit('Unable to parse {} ({}). Run this with the Python the scripts use.'.format(script, e))
+    keep = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)):
+            keep.append(node)
+        elif isinstance(node, ast.Assign) and all(isinstance(target, ast.Name) and target.id.isupper()
+                                                    for target in node.targets):
+            keep.append(node)
+    tree.body = keep
+    exec(compile(tree, path, 'exec'), namespace)
+    return namespace
+
+
+def run_child(name, args):
+    workdir = tempfile.mkdtemp()
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.NullHandler())
+    events = jss_events.EventLog(os.path.join(workdir, 'events.jsonl'))
+    if name in SCRIPTS:
+        script = load_functions(SCRIPTS[name], {'logger': logger, 'events': events, '__name__': 'bench'})
+    client = jss_client.JSSClient('user', 'pass', base_url=args.url, pool_size=args.workers)
+    # Keep the scripts' own output out of ours
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        latencies = []
+        if name == 'get':
+            requests = records = 0
+            start = time.time()
+            for i in range(args.repeat):
+                # An empty cache each time, so the whole group is fetched and parsed
+                cache = jss_cache.GroupCache(os.path.join(workdir, 'cache-{}.sqlite'.format(i)))
+                fetch_start = time.time()
+                computers, amount = script['get_computers'](cache, client, 0)
+                latencies.append(time.time() - fetch_start)
+                cache.close()
+                requests += 1
+                records += amount
+            elapsed = time.time() - start
+        else:
+            computers = dict((comp['id'], jss_client.computer_record(comp))
+                             for comp in client.iter_group_computers(GROUP))
+            rate = args.rate or None
+            start = time.time()
+            if name == 'remove':
+                outcomes = jss_records.remove_computers(client, computers, args.workers, rate, logger, events)
+            else:
+                journal = jss_bulk.Journal(os.path.join(workdir, 'journal'))
+                outcomes = jss_records.unmanage_computers(client, computers, journal, args.workers, rate,
+                                                          logger, events)
+                journal.close()
+            elapsed = time.time() - start
+            latencies = [o.seconds for o in outcomes]
+            requests = sum(o.attempts for o in outcomes)
+            records = len(outcomes)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        events.close()
+        client.close()
+        shutil.rmtree(workdir)
+    print(json.dumps({'benchmark': name,
+                      'requests': requests,
+                      'records': records,
+                      'seconds': elapsed,
+                      'requests_per_second': requests / elapsed if elapsed else 0.0,
+                      'records_per_second': records / elapsed if elapsed else 0.0,
+                      'p50': jss_bulk.percentile(latencies, 0.5),
+                      'p99': jss_bulk.percentile(latencies, 0.99),
+                      'peak_rss_kb': peak_rss_kb()}))
+
+
+def measure(name, url, args):
+    command = [sys.executable, os.path.abspath(__file__), '--child', name, '--url', url,
+               '--workers', str(args.workers), '--rate', str(args.rate), '--repeat', str(args.repeat)]
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cleanup scripts against a fake JSS')
+    parser.add_argument('--records', type=int, default=2000, help='computers in the group')
+    parser.add_argument('--latency', type=float, default=0.02, help='server delay per computer request (s)')
+    parser.add_argument('--group-latency', type=float, default=0.0, help='server delay per group request (s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of computer requests which fail')
+    parser.add_argument('--workers', type=int, default=jss_bulk.WORKERS)
+    parser.add_argument('--rate', type=float, default=0, help='requests/s limit, 0 for none')
+    parser.add_argument('--repeat', type=int, default=5, help='group fetches for the get benchmark')
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help='comma separated benchmarks to run')
+    parser.add_argument('--json', action='store_true', help='print one JSON result per line')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args)
+        return
+
+    names = [name for name in args.only.split(',') if name]
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}, choose from {}'.format(name, ', '.join(BENCHMARKS)))
+
+    if not args.json:
+        print('{:<9} {:>8} {:>8} {:>9} {:>9} {:>10} {:>10} {:>10} {:>14}'.format(
+            'benchmark', 'requests', 'records', 'seconds', 'req/s', 'rec/s', 'p50 (ms)', 'p99 (ms)', 'peak RSS (KB)'))
+    for name in names:
+        # A fresh server for each, so one benchmark's deletions don't affect the next
+        server = FakeJSS(group_size=args.records, latency=args.latency, group_latency=args.group_latency,
+                         error_rate=args.error_rate).start()
+        server.group(GROUP)
+        try:
+            result = measure(name, server.base_url, args)
+        finally:
+            server.stop()
+        if args.json:
+            print(json.dumps(result, sort_keys=True))
+        else:
+            print('{:<9} {:>8} {:>8} {:>9.2f} {:>9.1f} {:>10.1f} {:>10.2f} {:>10.2f} {:>14}'.format(
+                name, result['requests'], result['records'], result['seconds'], result['requests_per_second'],
+                result['records_per_second'], result['p50'] * 1000, result['p99'] * 1000, result['peak_rss_kb']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Time login-copyfiles.py copying a synthetic template tree (10,000
+# small files by default, spread over several items) into an empty
+# home folder, as at a first login, and again into the same home
+# folder, as at every login after that.
+#
+#   full        - every file is copied at every login, as originally
+#   incremental - files unchanged since the last login are skipped,
+#                 using the per-user manifest
+#
+# Files are chowned to --uid/--gid if running as root, otherwise to
+# the current user. Each mode is run --repeat times into fresh home
+# folders and the best times kept. Set COPYFILES_SCRIPT to time another
+# version of the script, and TMPDIR to choose the filesystem used. The
+# script is Python 2, so run this with the same Python it uses.
+#
+# Usage: bench_login_copyfiles.py [--files 10000] [--dirs 100]
+#                                 [--size 2048] [--items 4] [--repeat 3]
+#                                 [--workers 8] [--modes full,incremental]
+#
+##################################################################
+
+from __future__ import print_function
+import argparse
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.environ.get('COPYFILES_SCRIPT') or os.path.join(os.path.dirname(HERE), 'login-copyfiles.py')
+MODES = ('full', 'incremental')
+
+
+def make_template(root, files, dirs, size, items):
+    """ Create files spread over dirs directories under items top level
+        items, plus a single file item. Returns the list of items.
+    """
+    names = []
+    for i in range(items):
+        names.append('Library/Item{}'.format(i))
+    for i in range(files):
+        directory = os.path.join(root, names[i % items], 'dir{:03d}'.format(i % dirs))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'file{:05d}'.format(i)), 'wb') as f:
+            f.write(os.urandom(size))
+    os.makedirs(os.path.join(root, 'Library/Preferences'))
+    with open(os.path.join(root, 'Library/Preferences/com.example.template.plist'), 'wb') as f:
+        f.write(b'<plist/>')
+    return names + ['Library/Preferences/com.example.template.plist']
+
+
+def login(copyfiles, args):
+    # The script logs every file it copies, so keep that out of our output
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        copyfiles.main(dict(args))
+        return time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark login-copyfiles.py on a large template')
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--dirs', type=int, default=100, help='directories per item')
+    parser.add_argument('--size', type=int, default=2048, help='bytes per file')
+    parser.add_argument('--items', type=int, default=4, help='directory items the files are spread over')
+    parser.add_argument('--uid', type=int, default=501)
+    parser.add_argument('--gid', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each mode, keeping the best')
+    parser.add_argument('--workers', type=int, help='copying threads (default: the script\'s COPY_WORKERS)')
+    parser.add_argument('--modes', default=','.join(MODES), help='comma separated modes to run')
+    args = parser.parse_args()
+
+    copyfiles = imp.load_source('login_copyfiles', SCRIPT)
+    # Everyone is a network user here
+    copyfiles.user_is_local = lambda user: False
+    if args.workers:
+        copyfiles.COPY_WORKERS = args.workers
+
+    workdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(workdir, 'template')
+        items = make_template(source, args.files, args.dirs, args.size, args.items)
+        if os.getuid() == 0:
+            uid, gid = args.uid, args.gid
+        else:
+            uid, gid = os.getuid(), os.getgid()
+        print('{} files of {} bytes in {} items'.format(args.files, args.size, len(items)))
+        print('{:<14} {:>14} {:>14}'.format('mode', 'first login', 'repeat login'))
+        for mode in [m for m in args.modes.split(',') if m]:
+            if mode not in MODES:
+                parser.error('unknown mode {}, choose from {}'.format(mode, ', '.join(MODES)))
+            copyfiles.INCREMENTAL = mode == 'incremental'
+            firsts = []
+            repeats = []
+            for run in range(args.repeat):
+                home = os.path.join(workdir, 'home-{}-{}'.format(mode, run))
+                os.mkdir(home)
+                copyfiles.MANIFEST_DIR = os.path.join(workdir, 'manifests-{}-{}'.format(mode, run))
+                script_args = {'source': source, 'items': items, 'target': home,
+                               'uid': uid, 'gid': gid, 'user': 'bench'}
+                firsts.append(login(copyfiles, script_args))
+                repeats.append(login(copyfiles, script_args))
+                shutil.rmtree(home)
+            print('{:<14} {:>13.2f}s {:>13.2f}s'.format(mode, min(firsts), min(repeats)))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Time each way login-copyfiles.py can deploy read-only ('ro:') items
+# - copy, clone, link and auto - by logging in --users users with a
+# synthetic template, on whatever filesystem TMPDIR is on, and report
+# the disk space used by all the home folders and the store together,
+# counting each file once however many links it has.
+#
+# On a filesystem which can't clone (eg ext4), clone falls back to copy
+# and auto to link, which the 'clone'/'link' columns show. That each
+# deploys the right thing is checked by tests/test_login_copyfiles.py.
+# Set COPYFILES_SCRIPT to time another version of the script. The
+# script is Python 2, so run this with the same Python it uses.
+#
+# Usage: bench_login_deploy.py [--files 2000] [--dirs 20] [--size 16384]
+#                              [--users 5] [--deploy copy,clone,link,auto]
+#
+##################################################################
+
+from __future__ import print_function
+import argparse
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.environ.get('COPYFILES_SCRIPT') or os.path.join(os.path.dirname(HERE), 'login-copyfiles.py')
+DEPLOYS = ('copy', 'clone', 'link', 'auto')
+ITEM = 'Library/Fonts'
+
+
+def make_template(root, files, dirs, size):
+    for i in range(files):
+        directory = os.path.join(root, ITEM, 'dir{:03d}'.format(i % dirs))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, 'file{:05d}'.format(i))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        os.chmod(path, 0o755 if i % 7 == 0 else 0o644)
+
+
+def disk_usage(*roots):
+    """ Bytes allocated to the files under roots, counting each inode once """
+    seen = set()
+    total = 0
+    for root in roots:
+        for directory, _, names in os.walk(root):
+            for name in names:
+                st = os.lstat(os.path.join(directory, name))
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    total += st.st_blocks * 512
+    return total
+
+
+def login(copyfiles, workdir, source, user, uid, gid):
+    copyfiles.MANIFEST_DIR = os.path.join(workdir, 'manifests')
+    home = os.path.join(workdir, 'homes', user)
+    if not os.path.isdir(home):
+        os.makedirs(home)
+    args = {'source': source, 'items': [copyfiles.READONLY_PREFIX + ITEM], 'target': home,
+            'uid': uid, 'gid': gid, 'user': user}
+    # The script logs every file it copies, so keep that out of our output
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        copyfiles.main(args)
+        return time.time() - start, args['engine']
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def run(copyfiles, deploy, source, users, uid, gid):
+    """ Returns (first login seconds, cloned, linked, bytes used) """
+    copyfiles.READONLY_DEPLOY = deploy
+    workdir = tempfile.mkdtemp()
+    try:
+        copyfiles.STORE_DIR = os.path.join(workdir, 'store')
+        firsts = []
+        cloned = linked = 0
+        for user in ['user{}'.format(i) for i in range(users)]:
+            seconds, engine = login(copyfiles, workdir, source, user, uid, gid)
+            firsts.append(seconds)
+            cloned += engine.cloned
+            linked += engine.linked
+        used = disk_usage(os.path.join(workdir, 'homes'), copyfiles.STORE_DIR)
+        return sum(firsts) / len(firsts), cloned, linked, used
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time deploying read-only items')
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--dirs', type=int, default=20)
+    parser.add_argument('--size', type=int, default=16384, help='bytes per file')
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--uid', type=int, default=501)
+    parser.add_argument('--gid', type=int, default=20)
+    parser.add_argument('--deploy', default=','.join(DEPLOYS), help='comma separated ways to deploy')
+    args = parser.parse_args()
+
+    copyfiles = imp.load_source('login_copyfiles', SCRIPT)
+    # Everyone is a network user here
+    copyfiles.user_is_local = lambda user: False
+    copyfiles.INCREMENTAL = True
+    if os.getuid() == 0:
+        uid, gid = args.uid, args.gid
+    else:
+        uid, gid = os.getuid(), os.getgid()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(workdir, 'template')
+        make_template(source, args.files, args.dirs, args.size)
+        template = args.files * args.size
+        print('{} users, {} files of {} bytes'.format(args.users, args.files, args.size))
+        print('{:<8} {:>12} {:>8} {:>8} {:>12} {:>10}'.format('deploy', 'first login', 'cloned', 'linked',
+                                                            'disk used', 'templates'))
+        for deploy in [d for d in args.deploy.split(',') if d]:
+            if deploy not in DEPLOYS:
+                parser.error('unknown deploy {}, choose from {}'.format(deploy, ', '.join(DEPLOYS)))
+            seconds, cloned, linked, used = run(copyfiles, deploy, source, args.users, uid, gid)
+            print('{:<8} {:>11.2f}s {:>8} {:>8} {:>10.1f}MB {:>10.2f}'.format(
+                deploy, seconds, cloned, linked, used / 1048576.0, float(used) / template))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
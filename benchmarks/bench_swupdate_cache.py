@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Compare how coreconfig-softwareupdate-run.py originally looked up
+# downloaded updates (an os.listdir() of /Library/Updates for every
+# is_downloaded() call, and another of the product directory in
+# requires_restart()) with the UpdatesCacheIndex, against a synthetic
+# updates cache with thousands of products.
+#
+# For each of --updates recommended updates, process_updates() calls
+# is_downloaded() twice and requires_restart() once, which is what is
+# timed here. The .dist files are parsed in both cases. A second run
+# with the index is then timed, as the next check-in would be, where
+# the restart cache saved by the first means no .dist is parsed.
+#
+# The script is Python 2, so run this with the same Python it uses.
+#
+# Usage: bench_swupdate_cache.py [--products 5000] [--updates 20]
+#
+##################################################################
+
+from __future__ import print_function
+import argparse
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+from xml.etree import ElementTree
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(HERE), 'coreconfig-softwareupdate-run.py')
+
+DIST = '''<?xml version="1.0" encoding="utf-8"?>
+<installer-gui-script minSpecVersion="1">
+    <choice id="{key}">
+        <pkg-ref id="com.apple.pkg.{key}" {conclusion}/>
+    </choice>
+</installer-gui-script>
+'''
+
+
+def product_key(i):
+    return '041-{:05d}'.format(i)
+
+
+def make_cache(root, products):
+    """ Create a fake updates cache with products product directories, each
+        with a .dist file and a package. Every other product needs a restart.
+    """
+    for i in range(products):
+        key = product_key(i)
+        os.mkdir(os.path.join(root, key))
+        conclusion = 'onConclusion="RequireRestart"' if i % 2 else ''
+        with open(os.path.join(root, key, '{}.English.dist'.format(key)), 'w') as dist:
+            dist.write(DIST.format(key=key, conclusion=conclusion))
+        with open(os.path.join(root, key, '{}.pkg'.format(key)), 'wb') as pkg:
+            pkg.write(b'\0' * 1024)
+    # Plus the files that live alongside the products
+    with open(os.path.join(root, 'index.plist'), 'w') as index:
+        index.write('<plist/>')
+
+
+def legacy_is_downloaded(root, update):
+    # As the script originally did it
+    return update.get("Product Key") in os.listdir(root)
+
+
+def legacy_requires_restart(root, update):
+    distfile = None
+    for afile in os.listdir(os.path.join(root, update.get("Product Key"))):
+        if afile.endswith(".dist"):
+            distfile = os.path.join(root, update.get("Product Key"), afile.replace('zzzz', ''))
+            break
+    distinfo = ElementTree.parse(distfile)
+    for pkg in distinfo.findall('choice/pkg-ref'):
+        if pkg.get('onConclusion') == "RequireRestart":
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark downloaded update lookups')
+    parser.add_argument('--products', type=int, default=5000, help='products in the synthetic cache')
+    parser.add_argument('--updates', type=int, default=20, help='recommended updates to process')
+    args = parser.parse_args()
+
+    swupdate = imp.load_source('swupdate_run', SCRIPT)
+    root = tempfile.mkdtemp()
+    # Outside the cache, so it isn't taken for a product
+    metrics_dir = tempfile.mkdtemp()
+    swupdate.metrics = swupdate.PhaseMetrics(os.path.join(metrics_dir, 'metrics.jsonl'))
+    try:
+        make_cache(root, args.products)
+        # Spread the updates through the cache
+        step = max(1, args.products // args.updates)
+        updates = [{'Product Key': product_key(i)} for i in range(0, args.products, step)][:args.updates]
+
+        start = time.time()
+        legacy = []
+        for update in updates:
+            if legacy_is_downloaded(root, update) and legacy_is_downloaded(root, update):
+                legacy.append(legacy_requires_restart(root, update))
+        legacy_seconds = time.time() - start
+
+        restart_cache = os.path.join(root, 'restart-cache.plist')
+        start = time.time()
+        swupdate.updates_cache = swupdate.UpdatesCacheIndex(root)
+        swupdate.restart_cache = swupdate.RestartCache(restart_cache)
+        indexed = []
+        for update in updates:
+            if swupdate.is_downloaded(update) and swupdate.is_downloaded(update):
+                indexed.append(swupdate.requires_restart(update))
+        swupdate.restart_cache.save()
+        indexed_seconds = time.time() - start
+
+        start = time.time()
+        swupdate.updates_cache = swupdate.UpdatesCacheIndex(root)
+        swupdate.restart_cache = swupdate.RestartCache(restart_cache)
+        rerun = []
+        for update in updates:
+            if swupdate.is_downloaded(update) and swupdate.is_downloaded(update):
+                rerun.append(swupdate.requires_restart(update))
+        rerun_seconds = time.time() - start
+
+        # And keeping the index up to date after a download
+        start = time.time()
+        swupdate.updates_cache.refresh(updates[0]['Product Key'])
+        refresh_one_seconds = time.time() - start
+        start = time.time()
+        swupdate.updates_cache.refresh()
+        refresh_all_seconds = time.time() - start
+
+        assert legacy == indexed == rerun
+        print('{} products in the cache, {} updates processed'.format(args.products, len(updates)))
+        print('{:<30} {:>10.4f}s'.format('listdir per lookup', legacy_seconds))
+        print('{:<30} {:>10.4f}s'.format('cache index (incl. scan)', indexed_seconds))
+        print('{:<30} {:>10.4f}s'.format('next run, restart cache warm', rerun_seconds))
+        print('{:<30} {:>10.4f}s'.format('refresh one product', refresh_one_seconds))
+        print('{:<30} {:>10.4f}s'.format('refresh everything changed', refresh_all_seconds))
+    finally:
+        swupdate.metrics.close()
+        shutil.rmtree(metrics_dir)
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Time process_updates() from coreconfig-softwareupdate-run.py with
+# fake_softwareupdate.py standing in for /usr/sbin/softwareupdate,
+# comparing the original one-at-a-time download and install loop with
+# the background download scheduler at a range of concurrencies.
+#
+# Everything which would need a Mac (preferences, the console user) is
+# replaced, and no update needs a restart unless --restart-every is
+# given, in which case process_updates() stops at the "someone is
+# logged in" check once the downloads and installs are done. With
+# --downloaded, that many updates are already in the cache at the start,
+# and are installed while the rest download. With --batch, updates are
+# installed in batches (BATCH_INSTALLS) rather than one at a time.
+#
+# The script is Python 2, so run this with the same Python it uses.
+#
+# Usage: bench_swupdate_downloads.py [--updates 8] [--download 1.0]
+#                                    [--install 0.5] [--restart-every 0]
+#                                    [--concurrency 1,2,4] [--downloaded 0]
+#                                    [--batch]
+#
+##################################################################
+
+from __future__ import print_function
+import argparse
+import imp
+import json
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(HERE), 'coreconfig-softwareupdate-run.py')
+FAKE = os.path.join(HERE, 'fake_softwareupdate.py')
+
+
+def make_catalog(count, restart_every):
+    updates = []
+    for i in range(count):
+        updates.append({'Product Key': '041-{:05d}'.format(i),
+                        'Identifier': 'FakeUpdate{}'.format(i),
+                        'Display Name': 'Fake Update {}'.format(i),
+                        'Display Version': '1.0.{}'.format(i),
+                        'RequireRestart': bool(restart_every) and i % restart_every == 0})
+    return updates
+
+
+def legacy_process(swupdate, updates):
+    # The original loop: download, then install, one update at a time
+    for update in updates:
+        if not swupdate.is_downloaded(update):
+            for _ in swupdate.download_updates([update], 1):
+                pass
+        if swupdate.is_downloaded(update) and not swupdate.requires_restart(update):
+            swupdate.install_update(update)
+
+
+def overlap(log_file):
+    """ Return the seconds during which an install ran alongside a download """
+    commands = []
+    with open(log_file) as log:
+        for line in log:
+            commands.append(json.loads(line))
+    downloads = [(c['start'], c['end']) for c in commands if '-d' in c['args']]
+    installs = [(c['start'], c['end']) for c in commands if '-i' in c['args']]
+    total = 0.0
+    for i_start, i_end in installs:
+        for d_start, d_end in downloads:
+            total += max(0.0, min(i_end, d_end) - max(i_start, d_start))
+    return total
+
+
+def run(swupdate, workdir, catalog, concurrency, downloaded, batch):
+    cache = os.path.join(workdir, 'Updates')
+    if os.path.exists(cache):
+        shutil.rmtree(cache)
+    os.mkdir(cache)
+    os.environ['FAKE_SWUPDATE_CACHE'] = cache
+    env = dict(os.environ, FAKE_SWUPDATE_DOWNLOAD='0', FAKE_SWUPDATE_STARTUP='0', FAKE_SWUPDATE_LOG=os.devnull)
+    for update in catalog[:downloaded]:
+        subprocess.check_call([swupdate.SWUPDATE, '-d', swupdate.update_label(update)], env=env,
+                              stdout=open(os.devnull, 'w'))
+    log_file = os.path.join(workdir, 'commands.jsonl')
+    if os.path.exists(log_file):
+        os.remove(log_file)
+    os.environ['FAKE_SWUPDATE_LOG'] = log_file
+    swupdate.UPDATES_CACHE = cache
+    swupdate.updates_cache = swupdate.UpdatesCacheIndex(cache)
+    swupdate.restart_cache = swupdate.RestartCache(os.path.join(workdir, 'restart-cache.plist'))
+    swupdate.sync_state = swupdate.SyncState(os.path.join(workdir, 'sync-state.plist'))
+    swupdate.metrics = swupdate.PhaseMetrics(os.path.join(workdir, 'metrics.jsonl'))
+    prefs = swupdate.MockPreferencesBackend({swupdate.SWUPDATE_PREFS: {'RecommendedUpdates': catalog}})
+    swupdate.updates_snapshot = swupdate.UpdateSnapshot(prefs)
+
+    # is_downloaded() prints, so keep that out of our output
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        if concurrency is None:
+            swupdate.sync_update_list()
+            legacy_process(swupdate, swupdate.updates_snapshot.updates)
+        else:
+            swupdate.process_updates({'DOWNLOAD_CONCURRENCY': concurrency, 'SYNC_FRESHNESS': 0,
+                                       'BATCH_INSTALLS': batch}, None)
+        seconds = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return seconds, overlap(log_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark update downloads with a fake softwareupdate')
+    parser.add_argument('--updates', type=int, default=8)
+    parser.add_argument('--download', type=float, default=1.0, help='seconds per download')
+    parser.add_argument('--install', type=float, default=0.5, help='seconds per install')
+    parser.add_argument('--restart-every', type=int, default=0, help='every Nth update needs a restart')
+    parser.add_argument('--concurrency', default='1,2,4', help='comma separated download concurrencies')
+    parser.add_argument('--downloaded', type=int, default=0, help='updates already downloaded at the start')
+    parser.add_argument('--batch', action='store_true', help='install in batches')
+    args = parser.parse_args()
+
+    swupdate = imp.load_source('swupdate_run', SCRIPT)
+    swupdate.logger.addHandler(logging.NullHandler())
+    # Nobody is at the console, and nobody is logged in remotely
+    swupdate.console_user = lambda: None
+    swupdate.nobody_logged_in = lambda: False
+
+    workdir = tempfile.mkdtemp()
+    try:
+        catalog = make_catalog(args.updates, args.restart_every)
+        with open(os.path.join(workdir, 'catalog.json'), 'w') as catalog_file:
+            json.dump(catalog, catalog_file)
+        # A wrapper, so the fake runs with this Python whatever its #! says
+        wrapper = os.path.join(workdir, 'softwareupdate')
+        with open(wrapper, 'w') as script:
+            script.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, FAKE))
+        os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IXUSR)
+        swupdate.SWUPDATE = wrapper
+        os.environ['FAKE_SWUPDATE_CATALOG'] = os.path.join(workdir, 'catalog.json')
+        os.environ['FAKE_SWUPDATE_DOWNLOAD'] = str(args.download)
+        os.environ['FAKE_SWUPDATE_INSTALL'] = str(args.install)
+
+        print('{} updates, {}s per download, {}s per install'.format(args.updates, args.download, args.install))
+        print('{:<24} {:>10} {:>22}'.format('approach', 'seconds', 'install/download overlap'))
+        seconds, overlapped = run(swupdate, workdir, catalog, None, args.downloaded, args.batch)
+        print('{:<24} {:>10.2f} {:>21.2f}s'.format('one at a time', seconds, overlapped))
+        for concurrency in [int(c) for c in args.concurrency.split(',') if c]:
+            seconds, overlapped = run(swupdate, workdir, catalog, concurrency, args.downloaded, args.batch)
+            print('{:<24} {:>10.2f} {:>21.2f}s'.format('background x{}'.format(concurrency), seconds, overlapped))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
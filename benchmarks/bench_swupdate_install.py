@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Time installing downloaded updates which don't need a restart with
+# coreconfig-softwareupdate-run.py, one softwareupdate -i per update
+# (install_update() for each) against a single batched softwareupdate -i
+# (install_updates()), with fake_softwareupdate.py standing in for
+# /usr/sbin/softwareupdate.
+#
+# --startup is what every softwareupdate command costs before it gets
+# going (loading the catalogue), which batching pays once. With --fail,
+# that update fails to install, so the batch falls back to installing
+# whatever is still pending one at a time.
+#
+# The script is Python 2, so run this with the same Python it uses.
+#
+# Usage: bench_swupdate_install.py [--updates 8] [--startup 2.0]
+#                                  [--install 0.5] [--fail 3]
+#
+##################################################################
+
+from __future__ import print_function
+import argparse
+import imp
+import json
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(HERE), 'coreconfig-softwareupdate-run.py')
+FAKE = os.path.join(HERE, 'fake_softwareupdate.py')
+
+
+def make_catalog(count):
+    return [{'Product Key': '041-{:05d}'.format(i),
+             'Identifier': 'FakeUpdate{}'.format(i),
+             'Display Name': 'Fake Update {}'.format(i),
+             'Display Version': '1.0.{}'.format(i)} for i in range(count)]
+
+
+class InstalledPreferences(object):
+    """ Recommends the updates in the catalogue which the fake hasn't installed """
+    def __init__(self, catalog, installed_file):
+        self.catalog = catalog
+        self.installed_file = installed_file
+
+    def copy_value(self, key, domain):
+        installed = set()
+        if os.path.exists(self.installed_file):
+            with open(self.installed_file) as installed_list:
+                installed = set(line.strip() for line in installed_list)
+        return [u for u in self.catalog if '{}-{}'.format(u['Identifier'], u['Display Version']) not in installed]
+
+
+def run(swupdate, workdir, catalog, batched):
+    installed_file = os.path.join(workdir, 'installed')
+    log_file = os.path.join(workdir, 'commands.jsonl')
+    for path in (installed_file, log_file):
+        if os.path.exists(path):
+            os.remove(path)
+    os.environ['FAKE_SWUPDATE_INSTALLED'] = installed_file
+    os.environ['FAKE_SWUPDATE_LOG'] = log_file
+    swupdate.updates_snapshot = swupdate.UpdateSnapshot(InstalledPreferences(catalog, installed_file))
+
+    start = time.time()
+    if batched:
+        swupdate.install_updates(catalog)
+    else:
+        for update in catalog:
+            swupdate.install_update(update)
+    seconds = time.time() - start
+    with open(log_file) as log:
+        commands = len(log.readlines())
+    return seconds, commands, len(swupdate.updates_snapshot)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark batched installs with a fake softwareupdate')
+    parser.add_argument('--updates', type=int, default=8)
+    parser.add_argument('--startup', type=float, default=2.0, help='seconds each softwareupdate command takes to start')
+    parser.add_argument('--install', type=float, default=0.5, help='seconds per install')
+    parser.add_argument('--fail', type=int, help='index of an update which fails to install')
+    args = parser.parse_args()
+
+    swupdate = imp.load_source('swupdate_run', SCRIPT)
+    swupdate.logger.addHandler(logging.NullHandler())
+
+    workdir = tempfile.mkdtemp()
+    try:
+        swupdate.sync_state = swupdate.SyncState(os.path.join(workdir, 'sync-state.plist'))
+        swupdate.metrics = swupdate.PhaseMetrics(os.path.join(workdir, 'metrics.jsonl'))
+        catalog = make_catalog(args.updates)
+        with open(os.path.join(workdir, 'catalog.json'), 'w') as catalog_file:
+            json.dump(catalog, catalog_file)
+        # A wrapper, so the fake runs with this Python whatever its #! says
+        wrapper = os.path.join(workdir, 'softwareupdate')
+        with open(wrapper, 'w') as script:
+            script.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, FAKE))
+        os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IXUSR)
+        swupdate.SWUPDATE = wrapper
+        os.environ['FAKE_SWUPDATE_CATALOG'] = os.path.join(workdir, 'catalog.json')
+        os.environ['FAKE_SWUPDATE_STARTUP'] = str(args.startup)
+        os.environ['FAKE_SWUPDATE_INSTALL'] = str(args.install)
+        if args.fail is not None:
+            os.environ['FAKE_SWUPDATE_FAIL'] = '{}-{}'.format(catalog[args.fail]['Identifier'],
+                                                               catalog[args.fail]['Display Version'])
+
+        print('{} updates, {}s to start softwareupdate, {}s per install'.format(args.updates, args.startup,
+                                                                               args.install))
+        print('{:<16} {:>10} {:>10} {:>10}'.format('approach', 'seconds', 'commands', 'left over'))
+        sequential, commands, left = run(swupdate, workdir, catalog, False)
+        print('{:<16} {:>10.2f} {:>10} {:>10}'.format('one at a time', sequential, commands, left))
+        batched, commands, left = run(swupdate, workdir, catalog, True)
+        print('{:<16} {:>10.2f} {:>10} {:>10}'.format('batched', batched, commands, left))
+        print('saved {:.2f}s ({:.0f}%)'.format(sequential - batched, 100 * (sequential - batched) / sequential))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Check and time login-copyfiles.py's wait_for_target(): how long after
+# the home folder appears it returns, looking once a second as the
+# script originally did, and watching with the backend watch_directory()
+# picks here (inotify on Linux, kqueue on macOS).
+#
+# The home folder is created --delay seconds after the wait starts, in
+# each of the ways it might be:
+#   mkdir   - made where it belongs
+#   rename  - made elsewhere in the same folder and moved into place
+#   nested  - the folder above it doesn't exist yet either, and is made
+#             first
+#   never   - it doesn't appear, so the wait should give up (timed
+#             from the start of the wait)
+#
+# Exits non-zero if any wait returns the wrong answer. The script is
+# Python 2, so run this with the same Python it uses.
+#
+# Usage: bench_wait_for_target.py [--delay 0.35] [--maxwait 3]
+#
+##################################################################
+
+from __future__ import print_function
+import argparse
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.environ.get('COPYFILES_SCRIPT') or os.path.join(os.path.dirname(HERE), 'login-copyfiles.py')
+SCENARIOS = ('mkdir', 'rename', 'nested', 'never')
+
+
+def appear(scenario, workdir, delay, created):
+    time.sleep(delay)
+    if scenario == 'mkdir':
+        os.mkdir(os.path.join(workdir, 'Users', 'someone'))
+    elif scenario == 'rename':
+        os.mkdir(os.path.join(workdir, 'Users', '.someone.tmp'))
+        os.rename(os.path.join(workdir, 'Users', '.someone.tmp'), os.path.join(workdir, 'Users', 'someone'))
+    elif scenario == 'nested':
+        os.mkdir(os.path.join(workdir, 'Users', 'network'))
+        time.sleep(delay)
+        os.mkdir(os.path.join(workdir, 'Users', 'network', 'someone'))
+    else:
+        return
+    created.append(time.time())
+
+
+def run(copyfiles, scenario, delay, maxwait, watch):
+    """ Returns (found, seconds from the folder appearing to the wait returning) """
+    workdir = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(workdir, 'Users'))
+        if scenario == 'nested':
+            target = os.path.join(workdir, 'Users', 'network', 'someone')
+        else:
+            target = os.path.join(workdir, 'Users', 'someone')
+        created = []
+        thread = threading.Thread(target=appear, args=(scenario, workdir, delay, created))
+        thread.start()
+        # The script logs while it waits, so keep that out of our output
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            start = time.time()
+            found = copyfiles.wait_for_target(target, maxwait, watch)
+            returned = time.time()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        thread.join()
+        return found, returned - (created[0] if created else start)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and time waiting for the home folder')
+    parser.add_argument('--delay', type=float, default=0.35, help='seconds before the home folder appears')
+    parser.add_argument('--maxwait', type=float, default=3, help='seconds to wait before giving up')
+    args = parser.parse_args()
+
+    copyfiles = imp.load_source('login_copyfiles', SCRIPT)
+    watched = copyfiles.watch_directory(tempfile.gettempdir())
+    watched.close()
+    backends = [('polling', copyfiles.PollingDirectoryBackend),
+                (type(watched).__name__.replace('DirectoryBackend', '').lower(), None)]
+
+    failed = False
+    print('{:<10} {:<10} {:>7} {:>22}'.format('scenario', 'backend', 'found', 'seconds after it did'))
+    for scenario in SCENARIOS:
+        for name, watch in backends:
+            found, seconds = run(copyfiles, scenario, args.delay, args.maxwait, watch)
+            ok = found == (scenario != 'never')
+            failed = failed or not ok
+            print('{:<10} {:<10} {:>7} {:>21.3f}s{}'.format(scenario, name, str(found), seconds,
+                                                            '' if ok else '  FAIL'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
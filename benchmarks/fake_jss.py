@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# A local stand-in for the JSS Classic API, for benchmarking the
+# record-cleanup scripts without touching the real JSS.
+#
+# Serves /JSSResource/computergroups/name/<name>, returning a group of
+# a configurable number of computers with an ETag, and accepts DELETE
+# and PUT requests for /JSSResource/computers/... . HTTP/1.1 keep-alive
+# is supported so connection re-use can be measured, and latency and
+# error responses can be injected into the computer requests. Computers are looked up
+# by JSS ID in an index, and by name with a linear scan plus an optional
+# extra delay, to model the cost of a name lookup on the real JSS.
+#
+##################################################################
+
+import hashlib
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+
+GROUP_PREFIX = '/JSSResource/computergroups/name/'
+COMPUTER_PREFIX = '/JSSResource/computers/'
+
+
+def computer_records(size, awkward_every=0):
+    """ Return size fake computer group members, with JSS IDs from 1.
+
+        If awkward_every is set, every awkward_every'th computer gets a name
+        which is awkward to address by name: one containing a space, one
+        containing a slash, or a duplicate of the previous name, in turn.
+    """
+    computers = []
+    for i in range(1, size + 1):
+        name = 'UOE-MAC-{:06d}'.format(i)
+        if awkward_every and i % awkward_every == 0:
+            kind = (i // awkward_every) % 3
+            if kind == 0:
+                name = 'UoE Mac {:06d}'.format(i)
+            elif kind == 1:
+                name = 'UOE/MAC/{:06d}'.format(i)
+            else:
+                name = computers[-1]['name']
+        computers.append({'id': i,
+                          'name': name,
+                          'mac_address': '00:00:00:{:02X}:{:02X}:{:02X}'.format(i >> 16 & 255, i >> 8 & 255, i & 255),
+                          'alt_mac_address': '',
+                          'serial_number': 'C02{:09d}'.format(i)})
+    return computers
+
+
+def group_document(name, computers):
+    """ Return the JSON body the JSS would send for a group of computers """
+    group = {'computer_group': {'id': 1,
+                                'name': name,
+                                'is_smart': True,
+                                'site': {'id': -1, 'name': 'None'},
+                                'criteria': [{'name': 'Last Check-in',
+                                              'priority': 0,
+                                              'and_or': 'and',
+                                              'search_type': 'more than x days ago',
+                                              'value': '365'}],
+                                'computers': computers}}
+    return json.dumps(group).encode('utf-8')
+
+
+class FakeJSSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; don't let Nagle's algorithm
+    # add delayed-ACK stalls to every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self.path.startswith(GROUP_PREFIX):
+            self.send_body(404, b'Not Found', 'text/plain')
+            return
+        if self.server.group_latency:
+            time.sleep(self.server.group_latency)
+        body = self.server.group(unquote(self.path[len(GROUP_PREFIX):]))
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_DELETE(self):
+        self.computer_request(200)
+
+    def do_PUT(self):
+        # The request body has to be read for the connection to be re-used
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.computer_request(201)
+
+    def computer_request(self, success):
+        if not self.path.startswith(COMPUTER_PREFIX):
+            self.send_body(404, b'Not Found', 'text/plain')
+            return
+        code = self.server.computer_request(self.command, self.path, success)
+        if code == 429:
+            self.send_response(code)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif code >= 400:
+            self.send_body(code, 'Error {}'.format(code).encode('utf-8'), 'text/plain')
+        else:
+            self.send_body(code, '<computer><id>1</id></computer>'.encode('utf-8'), 'text/xml')
+
+
+class FakeJSS(ThreadingMixIn, HTTPServer):
+    """ A threaded fake JSS listening on localhost
+
+        group_size is the number of computers in every group, unless the
+        group is listed in group_sizes. Groups are drawn from the same set
+        of computers, with awkward names as described in computer_records().
+        latency is the delay in seconds before answering a computer request,
+        and name_lookup_latency is added to requests which address a
+        computer by name. group_latency is the delay before answering a
+        request for a group.
+        error_rate is the fraction of computer requests which fail, with a
+        code chosen at random from error_codes.
+    """
+    daemon_threads = True
+    # Allow plenty of simultaneous connections from concurrent clients
+    request_queue_size = 128
+
+    def __init__(self, group_size=1000, group_sizes=None, latency=0.0, error_rate=0.0,
+                 error_codes=(429, 500, 503), name_lookup_latency=0.0, awkward_every=0, port=0,
+                 group_latency=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeJSSHandler)
+        self.group_size = group_size
+        self.group_sizes = group_sizes or {}
+        self.latency = latency
+        self.name_lookup_latency = name_lookup_latency
+        self.group_latency = group_latency
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.computers = computer_records(max([group_size] + list(self.group_sizes.values())), awkward_every)
+        self._by_id = dict((comp['id'], comp) for comp in self.computers)
+        # Requests received, as (method, path, status) tuples
+        self.requests = []
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+
+    def find_computer(self, path):
+        """ Return the computer addressed by path (relative to /computers/), or None """
+        kind, _, value = path.partition('/')
+        if kind == 'id':
+            try:
+                return self._by_id.get(int(value))
+            except ValueError:
+                return None
+        elif kind == 'name':
+            if self.name_lookup_latency:
+                time.sleep(self.name_lookup_latency)
+            name = unquote(value)
+            # With duplicate names, whichever record is found first is the one acted on
+            for comp in self.computers:
+                if comp['name'] == name:
+                    return comp
+        return None
+
+    def computer_request(self, method, path, success=200):
+        """ Record a request for a computer and return the status to answer with """
+        path = path[len(COMPUTER_PREFIX):]
+        found = self.find_computer(path)
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if found is None:
+                code = 404
+            elif self._random.random() < self.error_rate:
+                code = self._random.choice(self.error_codes)
+            else:
+                code = success
+            self.requests.append((method, path, code))
+        return code
+
+    def handle_error(self, request, client_address):
+        # Clients closing idle keep-alive connections is expected
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}/JSSResource'.format(self.server_address[1])
+
+    def group(self, name):
+        # Documents are generated once and cached, so the server itself
+        # doesn't dominate the timings
+        with self._lock:
+            if name not in self._groups:
+                size = self.group_sizes.get(name, self.group_size)
+                self._groups[name] = group_document(name, self.computers[:size])
+            return self._groups[name]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# A stand-in for /usr/sbin/softwareupdate, for trying out and
+# benchmarking coreconfig-softwareupdate-run.py away from a Mac.
+#
+# Supports the commands the script uses:
+#   -l [-r]        list the updates in the catalogue
+#   -d <label>     sleep, then write a stub product directory (a .dist
+#                  file and a package) into the updates cache
+#   -i <label>...  sleep for each update, as if installing them
+#   -i -r          sleep for each recommended update, as if installing all
+#
+# A label is <Identifier>-<Display Version>, as the script builds them.
+# Configured through the environment:
+#   FAKE_SWUPDATE_CATALOG   JSON list of update dicts, as found in the
+#                           RecommendedUpdates preference, each with an
+#                           optional "RequireRestart" boolean
+#   FAKE_SWUPDATE_CACHE     the updates cache to write products into
+#   FAKE_SWUPDATE_DOWNLOAD  seconds each download takes (default 1)
+#   FAKE_SWUPDATE_INSTALL   seconds each install takes (default 1)
+#   FAKE_SWUPDATE_LIST      seconds a listing takes (default 0)
+#   FAKE_SWUPDATE_STARTUP   seconds every command takes to get going, as
+#                           the real one loads the catalogue (default 0)
+#   FAKE_SWUPDATE_FAIL      comma separated labels which fail to install
+#   FAKE_SWUPDATE_INSTALLED optional file to append the label of each
+#                           update installed to
+#   FAKE_SWUPDATE_LOG       optional file to append a JSON line to for
+#                           each command, with its start and end times
+#
+##################################################################
+
+from __future__ import print_function
+import json
+import os
+import sys
+import time
+
+DIST = '''<?xml version="1.0" encoding="utf-8"?>
+<installer-gui-script minSpecVersion="1">
+    <title>{name}</title>
+    <choice id="{key}" title="{name}">
+        <pkg-ref id="com.apple.pkg.{identifier}" {conclusion}/>
+    </choice>
+</installer-gui-script>
+'''
+
+
+def label(update):
+    return '{}-{}'.format(update.get('Identifier'), update.get('Display Version'))
+
+
+def load_catalog():
+    with open(os.environ['FAKE_SWUPDATE_CATALOG']) as catalog:
+        return json.load(catalog)
+
+
+def find(catalog, wanted):
+    for update in catalog:
+        if label(update) == wanted:
+            return update
+    print('{}: No such update'.format(wanted))
+    sys.exit(1)
+
+
+def seconds(name, default):
+    return float(os.environ.get(name, default))
+
+
+def list_updates(catalog):
+    time.sleep(seconds('FAKE_SWUPDATE_LIST', 0))
+    print('Software Update Tool\n')
+    print('Finding available software')
+    if not catalog:
+        print('No new software available.')
+        return
+    print('Software Update found the following new or updated software:')
+    for update in catalog:
+        print('   * {}'.format(label(update)))
+        print('\t{} ({}), {}K [recommended]{}'.format(update.get('Display Name'), update.get('Display Version'),
+                                                      update.get('Size', 1024),
+                                                      ' [restart]' if update.get('RequireRestart') else ''))
+
+
+def download(update):
+    time.sleep(seconds('FAKE_SWUPDATE_DOWNLOAD', 1))
+    product = os.path.join(os.environ['FAKE_SWUPDATE_CACHE'], update['Product Key'])
+    if not os.path.isdir(product):
+        os.makedirs(product)
+    conclusion = 'onConclusion="RequireRestart"' if update.get('RequireRestart') else ''
+    with open(os.path.join(product, '{}.English.dist'.format(update['Product Key'])), 'w') as dist:
+        dist.write(DIST.format(name=update.get('Display Name'), key=update['Product Key'],
+                               identifier=update.get('Identifier'), conclusion=conclusion))
+    with open(os.path.join(product, '{}.pkg'.format(update.get('Identifier'))), 'wb') as pkg:
+        pkg.write(b'\0' * 1024)
+    print('Downloaded {}'.format(update.get('Display Name')))
+
+
+def install(update):
+    time.sleep(seconds('FAKE_SWUPDATE_INSTALL', 1))
+    print('Installing {}'.format(update.get('Display Name')))
+    if label(update) in os.environ.get('FAKE_SWUPDATE_FAIL', '').split(','):
+        print('Error installing {}'.format(update.get('Display Name')))
+        return False
+    print('Done with {}'.format(update.get('Display Name')))
+    if os.environ.get('FAKE_SWUPDATE_INSTALLED'):
+        with open(os.environ['FAKE_SWUPDATE_INSTALLED'], 'a') as installed:
+            installed.write(label(update) + '\n')
+    return True
+
+
+def main(argv):
+    start = time.time()
+    time.sleep(seconds('FAKE_SWUPDATE_STARTUP', 0))
+    catalog = load_catalog()
+    status = 0
+    if '-l' in argv:
+        list_updates(catalog)
+    elif '-d' in argv:
+        download(find(catalog, argv[argv.index('-d') + 1]))
+    elif '-i' in argv:
+        if '-r' in argv:
+            updates = catalog
+        else:
+            updates = [find(catalog, name) for name in argv[argv.index('-i') + 1:] if not name.startswith('-')]
+        # Carry on past a failure, as the real one does
+        for update in updates:
+            if not install(update):
+                status = 1
+    else:
+        print('Usage: softwareupdate -l [-r] | -d <label> | -i <label>... | -i -r')
+        return 1
+    if os.environ.get('FAKE_SWUPDATE_LOG'):
+        with open(os.environ['FAKE_SWUPDATE_LOG'], 'a') as log:
+            log.write(json.dumps({'args': argv, 'start': start, 'end': time.time()}) + '\n')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
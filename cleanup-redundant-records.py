@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+###################################################################
+#
+# Retire redundant computer records from the JSS in a single pass.
+#
+# Each tier is a smart group for machines which haven't checked in
+# for a given number of days, and the action to take on its members:
+#   report   - just list them
+#   unmanage - turn off management of them
+#   delete   - remove their records from the JSS
+#
+# Every tier's group is fetched at the same time, through the local
+# group cache. A machine in more than one group belongs to the tier
+# with the highest threshold, so it is only acted on once.
+#
+# Parameters ($1-$3 are reserved by the JSS):
+#   $4, $5  encrypted JSS username and password
+#   $6, $7  salt and passphrase to decrypt them
+#   $8      optional number of concurrent requests
+#   $9      optional requests per second limit
+#   $10     optional tiers, separated by semicolons, each as
+#           <smart group name>:<days>:<action>
+#           eg "Compliance - No check-in for over 300 days:300:unmanage;
+#               Compliance - Check in over 365 days:365:delete"
+#
+# Date: @@DATE
+# Version: @@VERSION
+# Origin: @@ORIGIN
+# Released by JSS User: @@USER
+#
+##################################################################
+
+# Import resources
+from collections import OrderedDict, namedtuple
+import sys
+# The shared jss_* modules. Jamf only runs the script itself, so they're
+# installed in JSS_MODULES by the JSS tools package (see README.md)
+JSS_MODULES = '/Library/Management/UoE/jss-modules'
+sys.path.append(JSS_MODULES)
+import jss_client
+import jss_credentials
+import jss_events
+import jss_cache
+import jss_bulk
+import jss_records
+import logging
+import datetime
+import os
+import time
+
+# What to do with the members of a tier's group
+ACTIONS = ('report', 'unmanage', 'delete')
+
+# A smart group, how many days its members haven't checked in for, and what to do with them
+Tier = namedtuple('Tier', ['group', 'days', 'action'])
+
+# Tiers used if none are given
+TIERS = [Tier("Compliance - No check-in for over 300 days", 300, 'unmanage'),
+         Tier("Compliance - Check in over 365 days", 365, 'delete')]
+
+# Get current day and time, convert to short version so we can append to log.
+current_date = datetime.datetime.now()
+current_day = current_date.strftime("%d")
+current_month = current_date.strftime("%b")
+current_year = current_date.strftime("%y")
+# Concatenate strings
+current_short_date = current_day + "-" + current_month + "-" + current_year
+
+# Create folder for logs
+log_path = "/Library/Logs/JSSRecordsCleanup/"
+
+# Create folder to store logs (just so we have a record of what's been done.)
+if not os.path.exists(log_path):
+    try:
+        # Create directory
+        os.mkdir(log_path)
+    except OSError:
+        print "Unable to create " + log_path
+else:
+    print "Logging directory %s already exists." % log_path
+
+log_file = "/Library/Logs/JSSRecordsCleanup/%s.log" % current_short_date
+
+# JSS IDs of the machines unmanaged so far. Kept until a run completes
+# without errors, so an interrupted run doesn't unmanage the same machines
+# again.
+journal_file = "/Library/Logs/JSSRecordsCleanup/unmanaged-ids.journal"
+
+# One line of JSON for every request made for a record, for later analysis
+events_file = "/Library/Logs/JSSRecordsCleanup/events.jsonl"
+
+# Create logger object and set default logging level
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Create console handler and set level to debug
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+
+# Create file handler and set level to debug
+file_handler = logging.FileHandler(log_file)
+file_handler.setLevel(logging.DEBUG)
+
+# Create formatter
+formatter = logging.Formatter('[%(asctime)s][%(levelname)s] %(message)s', datefmt='%a, %d-%b-%y %H:%M:%S')
+
+# Set formatters for handlers
+console_handler.setFormatter(formatter)
+file_handler.setFormatter(formatter)
+
+# Add handlers to logger
+logger.addHandler(console_handler)
+logger.addHandler(file_handler)
+
+# Events are queued and written out by a background thread, so logging them
+# never holds up the requests
+events = jss_events.EventLog(events_file)
+
+# Function to close and remove logging handlers
+def close_logger():
+    events.close()
+    console_handler.close()
+    file_handler.close()
+    logger.removeHandler(console_handler)
+    logger.removeHandler(file_handler)
+
+# Function to read the tiers from a parameter, or use the defaults if it's empty
+def parse_tiers(spec):
+    if not spec.strip():
+        return list(TIERS)
+    tiers = []
+    for item in spec.replace("\n", ";").split(";"):
+        if not item.strip():
+            continue
+        try:
+            group, days, action = item.strip().rsplit(":", 2)
+            tier = Tier(group.strip(), int(days), action.strip().lower())
+        except ValueError:
+            raise ValueError("Tier must be <smart group name>:<days>:<action>, not %s" % item.strip())
+        if tier.action not in ACTIONS:
+            raise ValueError("Action for %s must be one of %s, not %s" % (tier.group, ", ".join(ACTIONS), tier.action))
+        tiers.append(tier)
+    return tiers
+
+# Function to obtain every tier's computers from the JSS in one go
+def get_computers(client, tiers):
+    logger.info("\n")
+    logger.info("Obtaining information from %d JSS smart groups:" % len(tiers))
+    # Always check with the JSS before acting on records. The groups are fetched
+    # concurrently, and the local cache means only the differences are written back.
+    cache = jss_cache.GroupCache()
+    groups = cache.members_of(client, [tier.group for tier in tiers], max_age=0)
+    for tier in tiers:
+        refresh = cache.refreshes[tier.group]
+        logger.info('"%s": %d machines (%d added, %d removed, %d changed since last fetch)'
+                    % (tier.group, len(groups[tier.group]), refresh.added, refresh.removed, refresh.changed))
+    cache.close()
+    return groups
+
+# Function to put each machine in the highest tier it belongs to. Returns an
+# OrderedDict of tier -> {JSS ID: computer record}, highest threshold first.
+def assign_tiers(tiers, groups):
+    assigned = OrderedDict()
+    seen = set()
+    for tier in sorted(tiers, key=lambda t: t.days, reverse=True):
+        members = dict((comp_id, comp) for comp_id, comp in groups[tier.group].items() if comp_id not in seen)
+        seen.update(members)
+        assigned[tier] = jss_records.sort_by_name(members)
+    return assigned
+
+# Get encrypted strings
+apiuser = str(sys.argv[4])
+apipword = str(sys.argv[5])
+salt = str(sys.argv[6])
+passphrase = str(sys.argv[7])
+# Optional concurrency and requests-per-second limit
+try:
+    workers = int(sys.argv[8])
+except (IndexError, ValueError):
+    workers = jss_bulk.WORKERS
+try:
+    rate = float(sys.argv[9])
+except (IndexError, ValueError):
+    rate = jss_bulk.RATE
+# Optional tiers
+try:
+    tiers = parse_tiers(sys.argv[10] if len(sys.argv) > 10 else "")
+except ValueError as e:
+    logger.error(str(e))
+    close_logger()
+    sys.exit(1)
+
+# De-crypt strings
+try:
+    JSSusername = jss_credentials.decrypt_string(apiuser, salt, passphrase)
+    JSSpword = jss_credentials.decrypt_string(apipword, salt, passphrase)
+except jss_credentials.DecryptError as err:
+    logger.error("Unable to decrypt the JSS credentials: %s" % err)
+    close_logger()
+    sys.exit(1)
+
+# Connect to the JSS. Connections are kept open and shared by every request,
+# with one per worker.
+client = jss_client.JSSClient(JSSusername, JSSpword, pool_size=max(workers, len(tiers)))
+
+# Get every tier's machines, and give each machine to just one tier
+start = time.time()
+groups = get_computers(client, tiers)
+assigned = assign_tiers(tiers, groups)
+logger.info("Fetched %d groups in %.1fs" % (len(tiers), time.time() - start))
+
+outcomes = []
+journal = jss_bulk.Journal(journal_file)
+for tier, computers in assigned.items():
+    logger.info("\n")
+    logger.info("%d machines not seen in over %d days (%s): %s" % (len(computers), tier.days, tier.group, tier.action))
+    if not computers:
+        continue
+    if tier.action == 'report':
+        for comp in computers.values():
+            events.log(comp['id'], 'report')
+            logger.info("%s : %s (JSS ID %s)" % (comp['name'].upper(), comp['serial_number'], comp['id']))
+    elif tier.action == 'unmanage':
+        outcomes += jss_records.unmanage_computers(client, computers, journal, workers, rate, logger, events)
+    elif tier.action == 'delete':
+        outcomes += jss_records.remove_computers(client, computers, workers, rate, logger, events)
+client.close()
+
+if all(o.error is None for o in outcomes):
+    # Everything is done, so the next run can start afresh
+    journal.clear()
+    logger.info("JSS Records cleaned up!")
+else:
+    failed = sum(1 for o in outcomes if o.error is not None)
+    logger.warn("JSS Records cleaned up, with %d errors. %d machines are journalled as unmanaged and will be skipped next time." % (failed, len(journal)))
+journal.close()
+
+jss_records.close_events(events, logger)
+close_logger()
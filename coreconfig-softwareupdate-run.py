@@ -35,42 +35,76 @@ import sys
 import subprocess
 import plistlib
 import datetime
-import thread
+import errno
+import hashlib
+import json
+import re
+import select
 import time
 import logging
+import logging.handlers
 import signal
-from threading import Timer
-from SystemConfiguration import SCDynamicStoreCopyConsoleUser
+from collections import deque, namedtuple
+from contextlib import contextmanager
 from xml.etree import ElementTree
-from Foundation import CFPreferencesCopyAppValue
+try:
+    from SystemConfiguration import SCDynamicStoreCopyConsoleUser
+    from Foundation import CFPreferencesCopyAppValue
+except ImportError:
+    # Not on a Mac, eg when trying the script out elsewhere with
+    # MockPreferencesBackend. Anything that needs these will fail.
+    SCDynamicStoreCopyConsoleUser = None
+    CFPreferencesCopyAppValue = None
+try:
+    # For being told when the console user changes
+    from SystemConfiguration import (SCDynamicStoreCreate, SCDynamicStoreSetNotificationKeys,
+                                     SCDynamicStoreCreateRunLoopSource)
+    from CoreFoundation import (CFRunLoopGetCurrent, CFRunLoopAddSource, CFRunLoopRunInMode,
+                                kCFRunLoopDefaultMode)
+except ImportError:
+    # SessionWatcher falls back to polling
+    SCDynamicStoreCreate = None
 
 # Set location of log file
 log_file = "/Library/Logs/software-update.log"
-if os.path.exists(log_file):
-    os.remove(log_file)
+# How long each phase of each run took, kept across runs
+metrics_file = "/Library/Logs/software-update-metrics.jsonl"
+# Size the metrics file reaches before it's rotated, and old files kept
+METRICS_MAX_BYTES = 1024 * 1024
+METRICS_BACKUPS = 5
 
 # Create logger object and set default logging level
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# Create console handler and set level to debug
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
+# Handlers are created by setup_logger() when the script is run
+console_handler = None
+file_handler = None
 
-# Create file handler and set level to debug
-file_handler = logging.FileHandler(r'/Library/Logs/software-update.log')
-file_handler.setLevel(logging.DEBUG)
+# Function to create the logging handlers, starting a new log file
+def setup_logger():
+    global console_handler, file_handler
+    if os.path.exists(log_file):
+        os.remove(log_file)
 
-# Create formatter
-formatter = logging.Formatter('[%(asctime)s][%(levelname)s] %(message)s', datefmt='%a, %d-%b-%y %H:%M:%S')
+    # Create console handler and set level to debug
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.DEBUG)
 
-# Set formatters for handlers
-console_handler.setFormatter(formatter)
-file_handler.setFormatter(formatter)
+    # Create file handler and set level to debug
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setLevel(logging.DEBUG)
 
-# Add handlers to logger
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+    # Create formatter
+    formatter = logging.Formatter('[%(asctime)s][%(levelname)s] %(message)s', datefmt='%a, %d-%b-%y %H:%M:%S')
+
+    # Set formatters for handlers
+    console_handler.setFormatter(formatter)
+    file_handler.setFormatter(formatter)
+
+    # Add handlers to logger
+    logger.addHandler(console_handler)
+    logger.addHandler(file_handler)
 
 # Declare variables
 SWUPDATE = '/usr/sbin/softwareupdate'
@@ -80,8 +114,13 @@ INDEX = '/Library/Updates/index.plist'
 TRIGGERFILE = '/var/db/.AppleLaunchSoftwareUpdate'
 OPTIONSFILE = '/var/db/.SoftwareUpdateOptions'
 DEFER_FILE = '/var/db/UoESoftwareUpdateDeferral'
+# When the update list was last synced, so a recent sync needn't be repeated
+SYNC_STATE = '/var/db/UoESoftwareUpdateSyncState.plist'
+# Whether updates we've seen before need a restart, so their .dist files needn't be parsed again
+RESTART_CACHE = '/var/db/UoESoftwareUpdateRestartCache.plist'
 QUICKADD_LOCK = '/var/run/UoEQuickAddRunning'
 UPDATES_CACHE = '/Library/Updates'
+SWUPDATE_PREFS = '/Library/Preferences/com.apple.SoftwareUpdate'
 NO_NETWORK_MSG = ("Can't connect to the Apple Software Update server, "
                   "because you are not connected to the Internet.")
 SWUPDATE_PROCESSES = ['softwareupdated', 'swhelperd',
@@ -91,6 +130,23 @@ HELPER_AGENT = '/Library/LaunchAgents/uk.ac.ed.mdp.jamfhelper-swupdate.plist'
 #SWUPDATE_ICON = '/System/Library/CoreServices/Software Update.app/Contents/Resources/SoftwareUpdate.icns'
 UNI_LOGO = '/usr/local/jamf/UoELogo.png'
 CAUTION_ICON = '/System/Library/CoreServices/CoreTypes.bundle/Contents/Resources/AlertCautionIcon.icns'
+# Seconds to wait for the user to log out once asked to
+LOGOUT_WAIT = 30
+# Most seconds between looks while waiting for a logout, in case the
+# change notification never arrives
+LOGOUT_POLL_INTERVAL = 2
+# The System Configuration key holding the console user
+CONSOLE_USER_KEY = 'State:/Users/ConsoleUser'
+# Default number of updates to download at once. Can be set as ${8} in the JSS.
+DOWNLOAD_CONCURRENCY = 2
+# Seconds a download is given before it's killed
+DOWNLOAD_TIMEOUT = 3600
+# Whether updates which don't need a restart are installed together with one
+# softwareupdate -i, rather than one at a time. Can be set as ${10} in the JSS (1 or 0).
+BATCH_INSTALLS = True
+# Default hours a sync of the update list is trusted for before softwareupdate -l
+# is run again. Can be set as ${9} in the JSS; 0 syncs on every run.
+SYNC_FRESHNESS = 4
 
 def get_args():
     logger.info("Grabbing arguments from JSS.")
@@ -103,14 +159,29 @@ def get_args():
     except ValueError:
         logger.error("You need to specify DEFER_LIMIT, QUIET_HOURS_START, QUIET_HOURS_AND and MIN_BATTERY_LEVEL as integers")
         raise
+    # Optional
+    try:
+        args['DOWNLOAD_CONCURRENCY'] = max(1, int(sys.argv[8]))
+    except (IndexError, ValueError):
+        args['DOWNLOAD_CONCURRENCY'] = DOWNLOAD_CONCURRENCY
+    try:
+        args['SYNC_FRESHNESS'] = max(0, int(sys.argv[9]))
+    except (IndexError, ValueError):
+        args['SYNC_FRESHNESS'] = SYNC_FRESHNESS
+    try:
+        args['BATCH_INSTALLS'] = bool(int(sys.argv[10]))
+    except (IndexError, ValueError):
+        args['BATCH_INSTALLS'] = BATCH_INSTALLS
     return args
 
 # Function to close and remove logging handlers
 def close_logger():
-    console_handler.close()
-    file_handler.close()
-    logger.removeHandler(console_handler)
-    logger.removeHandler(file_handler)
+    # Metrics first, while there's still a log for any problem writing them
+    metrics.close()
+    for handler in (console_handler, file_handler):
+        if handler:
+            handler.close()
+            logger.removeHandler(handler)
 
 def check_for_icon(path_to_icon):
     if os.path.exists(path_to_icon):
@@ -145,34 +216,65 @@ def process_updates(args,sw_update_icon):
     need_restart = []
     try:
         logger.info("Checking to see what updates are available.")
-        sync_update_list()
-        if (recommended_updates() is None) or len(recommended_updates()) == 0:
+        listing = sync_update_list(args['SYNC_FRESHNESS'])
+        # Installing an update invalidates the snapshot, so work from the list as it was
+        updates = updates_snapshot.updates
+        if listing is not None:
+            # The preferences can lag behind what softwareupdate has just listed
+            listed = set(u.label for u in listing.updates)
+            for update in updates:
+                if update_label(update) not in listed:
+                    logger.info("{} is no longer listed by softwareupdate - skipping".format(update_label(update)))
+            updates = [u for u in updates if update_label(u) in listed]
+        if len(updates) == 0:
             logger.info("There are no recommended updates to be installed.")
             remove_deferral_tracking_file()
             return True
 
-        for update in recommended_updates():
+        for update in updates:
             logger.info("Processing {}".format(update.get("Display Name")))
-            # Download only if required
-            if not is_downloaded(update):
-                logger.info("Downloading %s" % update)
-                download_update(update)
-
-            # If already downloaded
-            if is_downloaded(update):
-                if not requires_restart(update):
-                    logger.info("%s is already downloaded and doesn't require a restart. Installing..." % update)
-                    install_update(update)
-                else:
-                    # Restart is required. Add
-                    # to the list
-                    logger.info("%s is downloaded but requires a restart. Adding to the list of updates that require a restart." % update)
-                    need_restart.append(update)
-
-            if len(need_restart) == 0:
-                # No updates require a restart, and we are done.
-                logger.info("No updates require a restart.")
-                return True
+        # Download only if required. Downloads run in the background, and each
+        # update is dealt with as soon as it's ready, so installs overlap with
+        # the downloads still going. When batching, each batch is whatever is
+        # ready: first what was already downloaded, then whatever finished
+        # downloading while the last batch was installing.
+        batch = [u for u in updates if is_downloaded(u)]
+        to_download = [u for u in updates if not is_downloaded(u)]
+        # Start downloading before dealing with what's already here
+        downloads = download_updates(to_download, args['DOWNLOAD_CONCURRENCY'])
+        while True:
+            to_install = []
+            for update in batch:
+                # If already downloaded
+                if is_downloaded(update):
+                    if not requires_restart(update):
+                        if args['BATCH_INSTALLS']:
+                            logger.info("%s is already downloaded and doesn't require a restart. Adding to the batch to install." % update)
+                            to_install.append(update)
+                        else:
+                            logger.info("%s is already downloaded and doesn't require a restart. Installing..." % update)
+                            install_update(update)
+                    else:
+                        # Restart is required. Add
+                        # to the list
+                        logger.info("%s is downloaded but requires a restart. Adding to the list of updates that require a restart." % update)
+                        need_restart.append(update)
+            restart_cache.save()
+            if to_install:
+                install_updates(to_install)
+            # Everything which has finished downloading in the meantime, or
+            # else wait for the next download to finish
+            batch = downloads.finished()
+            if not batch:
+                try:
+                    batch = [next(downloads)]
+                except StopIteration:
+                    break
+
+        if len(need_restart) == 0:
+            # No updates require a restart, and we are done.
+            logger.info("No updates require a restart.")
+            return True
 
         # Now we can deal with updates that require a restart
         if console_user():
@@ -217,36 +319,271 @@ def process_updates(args,sw_update_icon):
             logger.warn("Updates require a restart but someone is logged in remotely or we are not in quiet hours - aborting")
             return False
 
-    except KeyboardInterrupt:
+    except CommandTimeout as e:
         # If any of the softwareupdate commands times out
-        # we receive a KeyboardInterrupt
-        logger.error("Command timed out: giving up!")
+        logger.error("Command timed out: giving up! {}".format(e))
+        supervisor.kill_all()
         close_logger()
         sys.exit(255)
 
 
-def cmd_with_timeout(cmd, timeout):
-    # Run a command, kill it and throw an Exception
-    # in the main thread if it doesn't complete
-    # within <timeout> seconds.
-    # stdout and stderr will be returned together.
+class PhaseMetrics(object):
+    """ Records how long each phase of a run (syncing the list, each
+        download, restart check and install, waiting on the user) took
+        and how it turned out, as a line of JSON in a metrics file which
+        is kept across runs, and rotated once it reaches max_bytes.
 
-    def kill_proc(p):
-        p.kill()
-        # The timer is running in a separate thread, so
-        # use interrupt_main() to throw a KeyboardInterrupt
-        # back in the main thread.
-        thread.interrupt_main()
+        The file is only opened when the first phase is recorded. Once
+        closed, nothing more is recorded, so any phase still going then
+        (as when the script exits part way through) is recorded as it
+        closes.
+    """
+    def __init__(self, path=None, max_bytes=METRICS_MAX_BYTES, backups=METRICS_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.run = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.handler = None
+        self.closed = False
+        # Phases which have started but not yet been recorded, innermost last
+        self.running = []
+        # A logger of our own, so metrics don't end up in the text log
+        self.logger = logging.getLogger('{}.metrics'.format(__name__))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def _open(self):
+        if self.handler is None:
+            try:
+                self.handler = logging.handlers.RotatingFileHandler(self.path or metrics_file,
+                                                                    maxBytes=self.max_bytes,
+                                                                    backupCount=self.backups)
+            except (IOError, OSError) as err:
+                logger.warn("Unable to open metrics file: {}".format(err))
+                # Don't try again this run
+                self.handler = logging.NullHandler()
+            self.logger.addHandler(self.handler)
+
+    def record(self, phase, seconds, outcome='ok', **fields):
+        """ Record that phase took seconds, with its outcome and any other fields """
+        if self.closed:
+            return
+        self._open()
+        fields.update({'time': round(time.time(), 3),
+                       'run': self.run,
+                       'phase': phase,
+                       'seconds': round(seconds, 3),
+                       'outcome': outcome})
+        self.logger.info(json.dumps(fields, sort_keys=True, separators=(',', ':')))
+
+    @contextmanager
+    def phase(self, phase, **fields):
+        """ Time the block as phase. The block can set 'outcome' (ok by
+            default) and other fields in the dict it's given. Exceptions
+            are recorded as the outcome, then raised again.
+        """
+        started = time.time()
+        fields['outcome'] = 'ok'
+        running = (phase, started, fields)
+        self.running.append(running)
+        try:
+            yield fields
+        except CommandTimeout:
+            fields['outcome'] = 'timeout'
+            raise
+        except SystemExit as e:
+            fields['outcome'] = 'exit'
+            fields['exit_code'] = e.code
+            raise
+        except BaseException as e:
+            fields['outcome'] = 'error'
+            fields['error'] = str(e)
+            raise
+        finally:
+            if running in self.running:
+                self.running.remove(running)
+                self.record(phase, time.time() - started, **fields)
+
+    def close(self):
+        """ Record the phases still going as exits, then close the file """
+        while self.running:
+            phase, started, fields = self.running.pop()
+            fields['outcome'] = 'exit'
+            self.record(phase, time.time() - started, **fields)
+        self.closed = True
+        if self.handler is not None:
+            self.handler.flush()
+            self.handler.close()
+            self.logger.removeHandler(self.handler)
+            self.handler = None
+
+# How long each phase of this run takes
+metrics = PhaseMetrics()
+
+# Lines of output kept from the end of each command, for its CommandResult
+OUTPUT_TAIL = 20
+# Seconds to wait for a killed command's output to close before giving up on it
+KILL_GRACE = 5
+
+# How a command run by the Supervisor finished
+CommandResult = namedtuple('CommandResult', ['cmd', 'returncode', 'seconds', 'timed_out', 'tail'])
+
+class CommandTimeout(Exception):
+    """ Raised when a command doesn't finish before its deadline """
+    def __init__(self, result):
+        Exception.__init__(self, "{} timed out after {:.1f}s".format(" ".join(result.cmd), result.seconds))
+        self.result = result
+
+
+class Command(object):
+    """ A command started by the Supervisor. Once it has finished,
+        self.result is its CommandResult.
+    """
+    def __init__(self, cmd, timeout, on_line=None, on_finish=None):
+        self.cmd = cmd
+        self.on_line = on_line
+        self.on_finish = on_finish
+        self.started = time.time()
+        self.deadline = self.started + timeout
+        self.killed = None
+        self.result = None
+        self.tail = deque(maxlen=OUTPUT_TAIL)
+        self._partial = ''
+        # stdout and stderr together, read as it comes
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.fd = self.proc.stdout.fileno()
+        self.name = os.path.basename(cmd[0])
+
+    def _line(self, line):
+        line = line.rstrip()
+        if not line:
+            return
+        logger.info("{}: {}".format(self.name, line))
+        self.tail.append(line)
+        if self.on_line:
+            self.on_line(line)
+
+    @staticmethod
+    def _redrawn(line):
+        # softwareupdate redraws its progress over and over with carriage
+        # returns, so only keep the last version of the line
+        drawn = [part for part in line.split('\r') if part.strip()]
+        return drawn[-1] if drawn else ''
+
+    def feed(self, data):
+        """ Log each complete line of data, keeping any partial line for next time """
+        lines = (self._partial + data).split('\n')
+        # Don't let a line being redrawn pile up until its newline arrives,
+        # but keep its last carriage return for the next version to follow
+        partial = lines.pop()
+        self._partial = partial[partial.rfind('\r', 0, len(partial.rstrip('\r'))) + 1:]
+        for line in lines:
+            self._line(self._redrawn(line))
+
+    def kill(self):
+        if self.killed is None:
+            logger.error("{} has taken too long - killing it".format(" ".join(self.cmd)))
+            self.killed = time.time()
+            try:
+                self.proc.kill()
+            except OSError:
+                # It has just finished
+                pass
+
+    def finish(self):
+        self._line(self._redrawn(self._partial))
+        self._partial = ''
+        self.proc.stdout.close()
+        if self.killed is not None and self.proc.poll() is None:
+            self.proc.kill()
+        self.result = CommandResult(self.cmd, self.proc.wait(), time.time() - self.started,
+                                    self.killed is not None, list(self.tail))
+        if self.on_finish:
+            self.on_finish(self)
+
+
+class Supervisor(object):
+    """ Runs commands alongside each other from the one thread, using
+        select() to stream each one's output into the log a line at a
+        time as it arrives. Any command still running at its deadline is
+        killed, and shows up as timed out in its CommandResult.
+
+        Commands only make progress (and are only killed) while something
+        is waiting on the supervisor, so wait for one before doing
+        anything slow.
+    """
+    def __init__(self):
+        self.running = {}
+
+    def start(self, cmd, timeout, on_line=None, on_finish=None):
+        """ Start cmd, giving it timeout seconds to finish. on_line, if
+            given, is called with each line of its output, and on_finish
+            with the Command once it has finished.
+        """
+        command = Command(cmd, timeout, on_line, on_finish)
+        self.running[command.fd] = command
+        return command
+
+    def poll(self, timeout=1.0):
+        """ Wait up to timeout seconds for output, then deal with whatever
+            has arrived, and any command past its deadline
+        """
+        now = time.time()
+        # A copy, as finished commands are removed from it
+        for command in list(self.running.values()):
+            if now >= command.deadline:
+                command.kill()
+            if command.killed is not None and now >= command.killed + KILL_GRACE:
+                # Something it started is still holding its output open
+                del self.running[command.fd]
+                command.finish()
+        if not self.running:
+            return
+        wait = max(0, min([timeout] + [c.deadline - now for c in self.running.values() if c.killed is None]))
+        try:
+            readable = select.select(list(self.running), [], [], wait)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in readable:
+            command = self.running[fd]
+            data = os.read(fd, 65536)
+            if data:
+                command.feed(data)
+            else:
+                # End of output: it has finished
+                del self.running[fd]
+                command.finish()
 
-    _proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    my_timer = Timer(timeout, kill_proc, [_proc])
+    def wait(self, commands):
+        """ Wait until one of commands has finished, and return it """
+        while True:
+            for command in commands:
+                if command.result is not None:
+                    return command
+            self.poll()
+
+    def run(self, cmd, timeout, on_line=None):
+        """ Run cmd to completion and return its CommandResult """
+        return self.wait([self.start(cmd, timeout, on_line)]).result
+
+    def kill_all(self):
+        for command in self.running.values():
+            command.kill()
 
-    try:
-        my_timer.start()
-        stdout = _proc.communicate()
-        return stdout
-    finally:
-        my_timer.cancel()
+
+# Runs the softwareupdate commands for this run
+supervisor = Supervisor()
+
+def cmd_with_timeout(cmd, timeout, on_line=None):
+    # Run a command, logging its output as it goes, and return
+    # its CommandResult. If it doesn't complete within <timeout>
+    # seconds it's killed, and CommandTimeout is raised.
+    result = supervisor.run(cmd, timeout, on_line)
+    if result.timed_out:
+        raise CommandTimeout(result)
+    return result
 
 
 def is_quiet_hours(start, end):
@@ -261,6 +598,8 @@ def unattended_install(min_battery):
     # Do a bunch of safety checks and if all is OK,
     # try to install updates unattended
     # Safety checks here?
+    # The power source may have changed since we last looked
+    host_facts.refresh('power')
     if (using_ac_power() or min_battery_level(min_battery)):
         if not is_a_laptop():
             # We won't have any network access at the loginwindow so not much point attempting this on a laptop
@@ -304,36 +643,94 @@ def lock_out_loginwindow():
     logger.info("Attempting to lockout the loginwindow")
     # Make sure our agent exists
     create_lgwindow_launchagent()
-    time.sleep(1)
+    # writePlist() has finished with it, so there's no need to wait for it
+    if not os.path.exists(HELPER_AGENT):
+        logger.error("Failed to create helper agent {}".format(HELPER_AGENT))
+        return
     # Then load it
-    helper_tries = 1
-    while helper_tries < 6:
-        if os.path.exists(HELPER_AGENT):
-            logger.info("Attempting to load: uk.ac.ed.mdp.jamfhelper-swupdate")
-            subprocess.check_call(['launchctl', 'load',
-                                   '-F', '-S', 'LoginWindow',
-                                   HELPER_AGENT ])
-            break
-        else:
-            logger.info("Failed to create helper agent, waiting...")
-            time.sleep(1)
-            helper_tries += 1
-            logger.info("waiting for agent, attempts : %d" % helper_tries)
+    logger.info("Attempting to load: uk.ac.ed.mdp.jamfhelper-swupdate")
+    subprocess.check_call(['launchctl', 'load',
+                           '-F', '-S', 'LoginWindow',
+                           HELPER_AGENT ])
 
 
-def sync_update_list():
+def sync_update_list(freshness=SYNC_FRESHNESS):
+    """ Sync the list of updates with softwareupdate -l, unless that was
+        done in the last <freshness> hours. Returns the UpdateListParser
+        which read its output, or None if the sync was skipped or its
+        output can't be trusted.
+    """
+    if sync_state.is_fresh(freshness):
+        logger.info("Update list was synced at {} - not checking again for now".format(sync_state.last_sync))
+        metrics.record('sync', 0.0, 'skipped')
+        return None
     logger.info("Checking for updates")
-    # Get all recommended updates
-    cmd_with_timeout([ SWUPDATE, '-l', '-r' ], 180)
+    # Get all recommended updates, reading them from the output as it comes
+    listing = UpdateListParser()
+    with metrics.phase('sync') as phase:
+        try:
+            result = cmd_with_timeout([ SWUPDATE, '-l', '-r' ], 180, listing.feed)
+        finally:
+            # The list may have changed, so read it again next time it's needed
+            updates_snapshot.invalidate()
+        phase['exit_code'] = result.returncode
+        phase['updates'] = len(listing.updates)
+        if result.returncode == 0 and listing.recognised:
+            if listing.fingerprint() != sync_state.fingerprint:
+                logger.info("Update catalogue has changed: {} updates listed".format(len(listing.updates)))
+                phase['changed'] = True
+            sync_state.record(listing.fingerprint())
+        else:
+            logger.warn("Couldn't make sense of the update list (exit code {}) - will check again next time".format(result.returncode))
+            phase['outcome'] = 'unrecognised'
+            # A failed or timed out listing may be missing updates, so don't
+            # let it filter out any of the ones we know about
+            return None
+    return listing
 
 
 def install_update(update):
     """ Install a single update """
-    update_name = "{}-{}".format(update.get("Identifier"),
-                                 update.get("Display Version"))
+    update_name = update_label(update)
 
     logger.info("Installing: {}".format(update_name))
-    result = cmd_with_timeout([ SWUPDATE, '-i', update_name ], 3600)
+    with metrics.phase('install', update=update_name) as phase:
+        try:
+            result = cmd_with_timeout([ SWUPDATE, '-i', update_name ], 3600)
+        finally:
+            updates_snapshot.invalidate()
+            # The list has changed, so sync it next time
+            sync_state.expire()
+        phase['exit_code'] = result.returncode
+        if result.returncode != 0:
+            phase['outcome'] = 'failed'
+
+def install_updates(updates):
+    """ Install updates with a single softwareupdate -i. If that fails,
+        install whichever are still pending one at a time, so one bad
+        package doesn't hold up the rest.
+    """
+    if len(updates) == 1:
+        return install_update(updates[0])
+    update_names = [update_label(u) for u in updates]
+
+    logger.info("Installing: {}".format(", ".join(update_names)))
+    with metrics.phase('install', update='{} updates'.format(len(update_names)), batch=update_names) as phase:
+        try:
+            result = cmd_with_timeout([ SWUPDATE, '-i' ] + update_names, 3600)
+        finally:
+            updates_snapshot.invalidate()
+            sync_state.expire()
+        phase['exit_code'] = result.returncode
+        if result.returncode != 0:
+            phase['outcome'] = 'failed'
+    if result.returncode == 0:
+        return
+    logger.warn("Installing the updates together failed (exit code {}) - installing one at a time".format(result.returncode))
+    for update in updates:
+        # Anything which did install is no longer recommended
+        if is_recommended(update):
+            install_update(update)
 
 def deferral_ok_until(limit):
     now = datetime.datetime.now()
@@ -357,6 +754,7 @@ def deferral_ok_until(limit):
         return defer_date
 
 def user_wants_to_defer(defer_until, updates, sw_update_icon):
+    asked = time.time()
     answer = subprocess.call([ JAMFHELPER,
                               '-windowType', 'utility',
                               '-title', 'UoE Mac Supported Desktop',
@@ -366,6 +764,7 @@ def user_wants_to_defer(defer_until, updates, sw_update_icon):
                               '-description', "One or more software updates require a restart:\n\n%s\n\nUpdates must be applied regularly.\n\nYou will be required to restart after:\n%s.\n" % (updates, defer_until.strftime( "%a, %d %b %H:%M:%S")),
                               '-button1', 'Apply now',
                                '-button2', 'Apply later' ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    metrics.record('prompt', time.time() - asked, 'defer' if answer == 2 else 'now', dialog='defer')
     if answer == 2: # 0 = now, 2 = defer
         logger.info("User elected to defer update")
         return True
@@ -374,6 +773,7 @@ def user_wants_to_defer(defer_until, updates, sw_update_icon):
         return False
 
 def force_logout(updates):
+    asked = time.time()
     answer = subprocess.call([ JAMFHELPER,
                               '-windowType', 'utility',
                               '-title', 'UoE Mac Supported Desktop',
@@ -382,6 +782,7 @@ def force_logout(updates):
                               '-timeout', '99999',
                               '-description', "One or more updates which require a restart have been deferred for the maximum allowable time:\n\n%s\n\nA restart is now mandatory.\n\nPlease save your work and restart now to install the update." % updates,
                               '-button1', 'Apply now' ])
+    metrics.record('prompt', time.time() - asked, 'now', dialog='mandatory')
     friendly_logout()
 
 def apply_updates_laptop():
@@ -414,33 +815,30 @@ def remove_deferral_tracking_file():
         logger.info("Removed deferral tracking file")
 
 def console_user():
-    username = (SCDynamicStoreCopyConsoleUser(None, None, None) or [None])[0]
-    username = [username, None][username in [u"loginwindow", None, u""]]
-    return username
+    return host_facts.console_user
 
 def nobody_logged_in():
     # If the 'w' command only returns 2 lines of output
     # the nobody is on the console or a tty
     # also check console user for belt and braces
-    return ( len(subprocess.check_output(['w']).strip().split("\n")) < 3 and
-             console_user() == None )
+    # This is checked while waiting for a logout, so look again, and
+    # only run w once nobody is on the console
+    host_facts.refresh('console_user')
+    return ( console_user() == None and
+             len(subprocess.check_output(['w']).strip().split("\n")) < 3 )
 
 def friendly_logout():
     user = console_user()
     logger.info("Attempting logout.")
     subprocess.call([ 'sudo', '-u', user, 'osascript', '-e', u'tell application "loginwindow" to  «event aevtrlgo»' ])
-    logout_tries = 1
-    while logout_tries < 15:
-        logger.info("logout attempts : %d" % logout_tries)
-        time.sleep(2)
-        if nobody_logged_in():
-            logger.info("It appears no one is logged in. Attempting unattended install.")
-            unattended_install(min_battery=args['MIN_BATTERY_LEVEL'])
-            logger.info("Break from loop")
-            break
-        else:
-            logout_tries += 1
-    # If after 15 attempts it's still unsuccessful, retry the logout
+    with metrics.phase('logout_wait') as phase:
+        logged_out = session_watcher.wait_for_logout(LOGOUT_WAIT)
+        phase['outcome'] = 'logged_out' if logged_out else 'still_logged_in'
+    if logged_out:
+        logger.info("It appears no one is logged in. Attempting unattended install.")
+        unattended_install(min_battery=args['MIN_BATTERY_LEVEL'])
+        return
+    # If it's still unsuccessful, retry the logout
     logger.warn("Still not logged out. Attempting again.")
     retry_logout()
 
@@ -523,39 +921,482 @@ def friendly_reboot():
 def install_recommended_updates():
     # An hour should be sufficient to install
     # updates, hopefully!
-    cmd_with_timeout([ SWUPDATE, '-i', '-r' ], 3600)
+    with metrics.phase('install', update='all recommended') as phase:
+        try:
+            result = cmd_with_timeout([ SWUPDATE, '-i', '-r' ], 3600)
+        finally:
+            updates_snapshot.invalidate()
+            sync_state.expire()
+        phase['exit_code'] = result.returncode
+        if result.returncode != 0:
+            phase['outcome'] = 'failed'
 
 def min_battery_level(min):
     if is_a_laptop():
-        try:
-            level = subprocess.check_output(['pmset', '-g', 'batt']).split("\t")[1].split(';')[0][:-1]
-            logger.info("Battery level: {}".format(level))
-            return int(level) >= min
-        except (IndexError, ValueError):
+        level = host_facts.power.battery_level
+        if level is None:
             # Couldn't get battery level - play it safe
             logger.info("Failed to get battery level")
             return False
+        logger.info("Battery level: {}".format(level))
+        return level >= min
     else:
         logger.info("Not a laptop.")
 
 def using_ac_power():
-    source = subprocess.check_output(['pmset', '-g', 'batt']).split("\t")[0].split(" ")[3][1:]
+    source = host_facts.power.source
     logger.info("Power source is: {}".format(source))
     return source == 'AC'
 
 def is_a_laptop():
-    return subprocess.check_output(['sysctl', 'hw.model']).find('MacBook') > 0
+    return host_facts.is_laptop
+
+# The power source and internal battery, as reported by pmset -g batt
+PowerState = namedtuple('PowerState', ['source', 'battery_level', 'battery_present'])
+
+def parse_pmset_batt(output):
+    """ Parse the output of pmset -g batt into a PowerState. The source
+        is the first word of what's being drawn from ('AC', 'Battery' or
+        'UPS'). Anything not reported, like the battery on a desktop, or
+        everything if the output makes no sense, is None (or False).
+    """
+    source = None
+    match = re.search(r"drawing from '([^']*)'", output)
+    if match:
+        source = match.group(1).split(' ')[0]
+    level = None
+    present = False
+    for line in output.splitlines():
+        # A UPS is listed too, but it's the internal battery we want
+        if 'InternalBattery' in line:
+            present = True
+            match = re.search(r'(\d+)%', line)
+            if match:
+                level = int(match.group(1))
+            break
+    return PowerState(source, level, present)
 
-def recommended_updates():
-    """ Return a dict of pending recommended updates """
-    updates = CFPreferencesCopyAppValue('RecommendedUpdates',
-                                        '/Library/Preferences/com.apple.SoftwareUpdate')
-    if len(updates) > 0:
-        return updates
+def parse_sysctl_model(output):
+    """ Return the model identifier (eg MacBookPro15,2) from the output of sysctl hw.model """
+    return output.split(':', 1)[-1].strip()
+
+class HostFacts(object):
+    """ Facts about this Mac, each probed the first time it's wanted and
+        then kept for the rest of the run.
+
+        The model never changes. The power state and the console user
+        can, so refresh() forgets those (or just the facts named) to be
+        probed again when next wanted. Commands are run with run, which
+        should return their output like subprocess.check_output().
+    """
+    VOLATILE = ('power', 'console_user')
+
+    def __init__(self, run=None):
+        self.run = run or subprocess.check_output
+        self._facts = {}
+
+    def _output(self, cmd):
+        try:
+            return self.run(cmd)
+        except (OSError, subprocess.CalledProcessError) as err:
+            logger.warn("Unable to run {}: {}".format(" ".join(cmd), err))
+            return ''
+
+    def _fact(self, name, probe):
+        if name not in self._facts:
+            self._facts[name] = probe()
+        return self._facts[name]
+
+    def refresh(self, *names):
+        """ Forget the named facts, or all the volatile ones """
+        for name in names or self.VOLATILE:
+            self._facts.pop(name, None)
+
+    @property
+    def model(self):
+        return self._fact('model', lambda: parse_sysctl_model(self._output(['sysctl', 'hw.model'])))
+
+    @property
+    def power(self):
+        return self._fact('power', lambda: parse_pmset_batt(self._output(['pmset', '-g', 'batt'])))
+
+    @property
+    def is_laptop(self):
+        # Newer models aren't all called MacBook, but they all have a battery
+        return 'MacBook' in self.model or self.power.battery_present
+
+    @property
+    def console_user(self):
+        return self._fact('console_user', self.read_console_user)
+
+    def read_console_user(self):
+        username = (SCDynamicStoreCopyConsoleUser(None, None, None) or [None])[0]
+        username = [username, None][username in [u"loginwindow", None, u""]]
+        return username
+
+# Facts about this Mac for this run
+host_facts = HostFacts()
+
+class PollingSessionBackend(object):
+    """ Has no way of knowing when the session changes, so just waits
+        interval seconds between looks
+    """
+    def __init__(self, interval=LOGOUT_POLL_INTERVAL):
+        self.interval = interval
+
+    def wait_for_change(self, timeout):
+        time.sleep(min(self.interval, timeout))
+
+
+class SCDynamicStoreSessionBackend(object):
+    """ Waits for System Configuration to say that the console user has
+        changed, by running the run loop until the notification arrives
+    """
+    def __init__(self):
+        self.changed = False
+        self.store = SCDynamicStoreCreate(None, 'coreconfig-softwareupdate-run', self._callback, None)
+        if self.store is None:
+            raise OSError("Unable to create a dynamic store session")
+        SCDynamicStoreSetNotificationKeys(self.store, [CONSOLE_USER_KEY], None)
+        self.source = SCDynamicStoreCreateRunLoopSource(None, self.store, 0)
+        CFRunLoopAddSource(CFRunLoopGetCurrent(), self.source, kCFRunLoopDefaultMode)
+
+    def _callback(self, store, changed_keys, info):
+        self.changed = True
+
+    def wait_for_change(self, timeout):
+        self.changed = False
+        deadline = time.time() + timeout
+        while not self.changed and time.time() < deadline:
+            # Returns after handling the notification, or at the timeout
+            CFRunLoopRunInMode(kCFRunLoopDefaultMode, deadline - time.time(), True)
+
+
+class SessionWatcher(object):
+    """ Waits for everyone to log out, looking again whenever the backend
+        says the session may have changed.
+
+        By default the console user is watched through System Configuration,
+        so a logout is seen as soon as it happens, falling back to looking
+        every couple of seconds if that isn't available.
+    """
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def _backend(self):
+        if self.backend is None:
+            try:
+                if SCDynamicStoreCreate is None:
+                    raise OSError("SystemConfiguration isn't available")
+                self.backend = SCDynamicStoreSessionBackend()
+            except Exception as err:
+                logger.warn("Can't watch for logouts ({}) - polling instead".format(err))
+                self.backend = PollingSessionBackend()
+        return self.backend
+
+    def wait_for_logout(self, timeout):
+        """ Return True as soon as nobody is logged in, or False if someone
+            still is after timeout seconds
+        """
+        deadline = time.time() + timeout
+        # Start watching before looking, so a change in between isn't missed
+        backend = self._backend()
+        while True:
+            if nobody_logged_in():
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            # Look again now and then anyway, in case a change is missed
+            backend.wait_for_change(min(remaining, LOGOUT_POLL_INTERVAL))
+
+# Watches for logouts
+session_watcher = SessionWatcher()
+
+class CFPreferencesBackend(object):
+    """ Reads preferences with CFPreferencesCopyAppValue """
+    def copy_value(self, key, domain):
+        return CFPreferencesCopyAppValue(key, domain)
+
+
+class MockPreferencesBackend(object):
+    """ Serves preferences from a dict of domain -> {key: value}, for
+        trying the script out away from a Mac. Counts reads in self.reads.
+    """
+    def __init__(self, domains=None):
+        self.domains = domains or {}
+        self.reads = 0
+
+    def copy_value(self, key, domain):
+        self.reads += 1
+        return self.domains.get(domain, {}).get(key)
+
+
+class UpdateSnapshot(object):
+    """ The pending recommended updates, read from the preferences once
+        and indexed by Product Key.
+
+        The snapshot is kept until invalidate() is called, which should
+        be done after anything that changes the list: syncing it with
+        softwareupdate -l, or installing.
+    """
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._updates = None
+        self._by_product_key = {}
+
+    def _load(self):
+        if self._updates is not None:
+            return
+        if self.backend is None:
+            self.backend = CFPreferencesBackend()
+        self._updates = list(self.backend.copy_value('RecommendedUpdates', SWUPDATE_PREFS) or [])
+        self._by_product_key = dict((u.get("Product Key"), u) for u in self._updates)
+
+    @property
+    def updates(self):
+        """ The list of update dicts """
+        self._load()
+        return self._updates
+
+    def __len__(self):
+        return len(self.updates)
+
+    def __iter__(self):
+        return iter(self.updates)
+
+    def __contains__(self, update):
+        return self.by_product_key(update.get("Product Key")) == update
+
+    def by_product_key(self, product_key):
+        self._load()
+        return self._by_product_key.get(product_key)
+
+    def invalidate(self):
+        """ Forget the snapshot, so it's read again when next needed """
+        self._updates = None
+        self._by_product_key = {}
+
+
+# The recommended updates for this run
+updates_snapshot = UpdateSnapshot()
+
+# An update as listed by softwareupdate -l
+ListedUpdate = namedtuple('ListedUpdate', ['label', 'title', 'version', 'size', 'recommended', 'restart'])
+
+class UpdateListParser(object):
+    """ Builds the list of updates from the output of softwareupdate -l,
+        fed to it a line at a time as the command runs. Understands the
+        format up to 10.14:
+
+           * Safari12.1-12.1
+                Safari (12.1), 67413K [recommended]
+
+        and from 10.15:
+
+        * Label: Safari13.1-13.1
+                Title: Safari, Version: 13.1, Size: 67413K, Recommended: YES,
+
+        self.recognised is set once the output has been seen to list
+        updates, or to say there aren't any.
+    """
+    OLD_DETAILS = re.compile(r'^(?P<title>.*) \((?P<version>[^)]*)\), (?P<size>\d+)K')
+    NEW_DETAILS = re.compile(r'(\w[\w ]*): ([^,]*)')
+
+    def __init__(self):
+        self.updates = []
+        self.recognised = False
+        self._label = None
+
+    def feed(self, line):
+        line = line.strip()
+        if line.startswith('* '):
+            label = line[2:].strip()
+            if label.startswith('Label: '):
+                label = label[len('Label: '):]
+            self._label = label
+        elif self._label is not None and line:
+            self.updates.append(self._details(self._label, line))
+            self._label = None
+        elif ('found the following' in line or 'No new software available' in line):
+            self.recognised = True
+
+    def _details(self, label, line):
+        flags = line.lower()
+        match = self.OLD_DETAILS.match(line)
+        if match:
+            return ListedUpdate(label, match.group('title'), match.group('version'), int(match.group('size')),
+                                '[recommended]' in flags, '[restart]' in flags)
+        fields = dict(self.NEW_DETAILS.findall(line))
+        if 'Title' in fields:
+            size = fields.get('Size', '').rstrip('KiB')
+            return ListedUpdate(label, fields['Title'], fields.get('Version'), int(size) if size.isdigit() else None,
+                                fields.get('Recommended') == 'YES', 'restart' in fields.get('Action', ''))
+        # Something new: keep what we can
+        return ListedUpdate(label, line, None, None, 'recommended' in flags, 'restart' in flags)
+
+    def fingerprint(self):
+        """ A digest of the updates listed, which changes when the catalogue does """
+        listed = sorted("{}|{}|{}".format(u.label, u.version, u.restart) for u in self.updates)
+        return hashlib.sha1("\n".join(listed)).hexdigest()
+
+
+class SyncState(object):
+    """ When the update list was last synced, and a fingerprint of what
+        was listed, kept from one run to the next in a plist
+    """
+    def __init__(self, path=SYNC_STATE):
+        self.path = path
+        self._state = None
+
+    def _load(self):
+        if self._state is None:
+            try:
+                self._state = dict(plistlib.readPlist(self.path))
+            except Exception:
+                # Missing or unreadable: sync
+                self._state = {}
+        return self._state
+
+    @property
+    def last_sync(self):
+        return self._load().get('LastSync')
+
+    @property
+    def fingerprint(self):
+        return self._load().get('Fingerprint')
+
+    def is_fresh(self, hours):
+        """ Returns True if the last sync was in the last <hours> hours """
+        last = self.last_sync
+        if not hours or last is None:
+            return False
+        age = datetime.datetime.now() - last
+        # A sync "in the future" means the clock has changed, so don't trust it
+        return datetime.timedelta(0) <= age < datetime.timedelta(hours=hours)
+
+    def record(self, fingerprint):
+        self._load()
+        self._state['LastSync'] = datetime.datetime.now()
+        self._state['Fingerprint'] = fingerprint
+        self._save()
+
+    def expire(self):
+        """ Make the next run sync, keeping the fingerprint """
+        if self._load().pop('LastSync', None) is not None:
+            self._save()
+
+    def _save(self):
+        try:
+            # Write to a temporary file first, so a half-written state is never read
+            plistlib.writePlist(self._state, self.path + '.tmp')
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError) as err:
+            logger.warn("Unable to save sync state {}: {}".format(self.path, err))
+
+# When the update list was last synced, kept between runs
+sync_state = SyncState()
+
+# What the cache index knows about each downloaded product
+CachedProduct = namedtuple('CachedProduct', ['dist', 'size', 'mtime'])
+
+class UpdatesCacheIndex(object):
+    """ An index of the downloaded updates in UPDATES_CACHE, built with
+        one listing of the directory rather than one per lookup.
+
+        Maps each product key to a CachedProduct with the path of its
+        .dist file (or None), the total size of the files in its
+        directory and the directory's mtime. Each product's directory
+        is only looked inside the first time its details are wanted.
+        refresh() re-scans only what has changed.
+    """
+    def __init__(self, root=UPDATES_CACHE):
+        self.root = root
+        # Product key -> CachedProduct, or None until it's been looked at
+        self._products = None
+
+    def _list(self):
+        try:
+            return os.listdir(self.root)
+        except OSError:
+            return []
+
+    def _scan_product(self, product_key):
+        path = os.path.join(self.root, product_key)
+        try:
+            mtime = os.stat(path).st_mtime
+            names = os.listdir(path)
+        except OSError:
+            # Not a directory, or it has gone
+            return CachedProduct(None, 0, 0)
+        distfile = None
+        size = 0
+        for afile in names:
+            # The .dist file is localised (ie update.language.dist)
+            # We don't know the localisation ahead of time, so just look for
+            # any .dist file in the update - any one will do.
+            if distfile is None and afile.endswith(".dist"):
+                # Some updates have a 'zzzz' prepended to the productKey, but
+                # this isn't present in the name of the dist file.
+                distfile = os.path.join(path, afile.replace('zzzz', ''))
+            try:
+                size += os.path.getsize(os.path.join(path, afile))
+            except OSError:
+                pass
+        return CachedProduct(distfile, size, mtime)
+
+    def scan(self):
+        """ Index the cache from scratch """
+        self._products = dict.fromkeys(self._list())
+
+    def refresh(self, product_key=None):
+        """ Bring the index up to date. With a product_key, only that
+            product is looked at (eg after downloading it). Otherwise
+            new products are added, removed ones dropped and any whose
+            directory has changed will be looked at again.
+        """
+        if self._products is None:
+            self.scan()
+        elif product_key is not None:
+            if os.path.exists(os.path.join(self.root, product_key)):
+                self._products[product_key] = self._scan_product(product_key)
+            else:
+                self._products.pop(product_key, None)
+        else:
+            products = {}
+            for name in self._list():
+                cached = self._products.get(name)
+                if cached is not None:
+                    try:
+                        if os.stat(os.path.join(self.root, name)).st_mtime != cached.mtime:
+                            cached = None
+                    except OSError:
+                        continue
+                products[name] = cached
+            self._products = products
+
+    def get(self, product_key):
+        """ Return the CachedProduct for product_key, or None if it isn't downloaded """
+        if self._products is None:
+            self.scan()
+        if product_key not in self._products:
+            return None
+        if self._products[product_key] is None:
+            self._products[product_key] = self._scan_product(product_key)
+        return self._products[product_key]
+
+    def __contains__(self, product_key):
+        if self._products is None:
+            self.scan()
+        return product_key in self._products
+
+
+# The downloaded updates for this run
+updates_cache = UpdatesCacheIndex()
 
 def is_downloaded(update):
     """ Returns true if the update has been downloaded """
-    if update.get("Product Key") in os.listdir(UPDATES_CACHE):
+    if update.get("Product Key") in updates_cache:
         print("{} is already downloaded".format(update.get("Product Key")))
         return True
     else:
@@ -564,7 +1405,7 @@ def is_downloaded(update):
 def is_recommended(update):
     """ Returns true if the update is in the list of
     pending recommended updates for this machine """
-    return update in recommended_updates()
+    return update in updates_snapshot
 
 
 def requires_restart(update):
@@ -578,46 +1419,174 @@ def requires_restart(update):
     # Parsing the output of softwareupdate -l is pretty horrible
     # but I'm not convinced this approach is much better.
 
-    answer = False
-    distfile = None
-
-    for afile in os.listdir(os.path.join(UPDATES_CACHE, update.get("Product Key"))):
-        # The .dist file is localised (ie update.language.dist)
-        # We don't know the localisation ahead of time, so just look for
-        # any .dist file in the update - any one will do.
-        if afile.endswith(".dist"):
-            # Some updates have a 'zzzz' prepended to the productKey, but
-            # this isn't present in the name of the dist file.
-            canonical_name = afile.replace('zzzz', '')
-            distfile = os.path.join(UPDATES_CACHE, update.get("Product Key"), canonical_name)
-            break
-    try:
-        distinfo = ElementTree.parse(distfile)
-    except IOError as err:
-        raise Exception('{}: Unreadable\n  {}'.format(update.get("Product Key"), err))
+    # The cache index has already found the .dist file
+    product_key = update.get("Product Key")
+    cached = updates_cache.get(product_key)
+    distfile = cached.dist if cached else None
+    with metrics.phase('restart_check', update=product_key) as phase:
+        try:
+            if distfile is None:
+                raise IOError("No .dist file found in {}".format(UPDATES_CACHE))
+            # The answer never changes for a given .dist file, so if we've
+            # seen this one before there's no need to parse it
+            answer = restart_cache.lookup(product_key, distfile)
+            phase['cached'] = answer is not None
+            if answer is None:
+                answer = dist_requires_restart(distfile)
+                restart_cache.store(product_key, distfile, answer)
+        except (IOError, OSError) as err:
+            raise Exception('{}: Unreadable\n  {}'.format(product_key, err))
+        phase['outcome'] = 'restart' if answer else 'no_restart'
+    return answer
 
+def dist_requires_restart(distfile):
+    """ Returns True if the .dist file at distfile says its update requires
+        a restart. The file is parsed as a stream, stopping at the first
+        package which requires one.
+    """
     # If the update requires a restart, it will have onConclusion = RequireRestart
-    # set in its package distribution file.
-    for pkg in distinfo.findall('choice/pkg-ref'):
-        if pkg.get('onConclusion') == "RequireRestart":
-            answer = True
-            break
-    return answer
+    # on a choice/pkg-ref in its package distribution file.
+    path = []
+    with open(distfile, 'rb') as dist:
+        for event, elem in ElementTree.iterparse(dist, events=('start', 'end')):
+            if event == 'start':
+                path.append(elem.tag)
+                if path[1:] == ['choice', 'pkg-ref'] and elem.get('onConclusion') == "RequireRestart":
+                    return True
+            else:
+                path.pop()
+                elem.clear()
+    return False
+
+class RestartCache(object):
+    """ Remembers whether updates require a restart from one run to the
+        next, in a plist keyed by product key. An entry is only used while
+        the size and mtime of the update's .dist file are unchanged.
+    """
+    def __init__(self, path=RESTART_CACHE):
+        self.path = path
+        self._entries = None
+        self._changed = False
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                self._entries = dict(plistlib.readPlist(self.path))
+            except Exception:
+                # Missing or unreadable: start again
+                self._entries = {}
+        return self._entries
+
+    def lookup(self, product_key, distfile):
+        """ Return True or False if the answer for distfile is known, otherwise None """
+        entry = self._load().get(product_key)
+        st = os.stat(distfile)
+        if entry and entry.get('DistSize') == st.st_size and entry.get('DistModified') == st.st_mtime:
+            return entry.get('RequireRestart')
+        return None
+
+    def store(self, product_key, distfile, answer):
+        """ Remember the answer for distfile. Call save() to keep it for the next run. """
+        st = os.stat(distfile)
+        self._load()[product_key] = {'DistSize': st.st_size,
+                                     'DistModified': st.st_mtime,
+                                     'RequireRestart': answer}
+        self._changed = True
+
+    def save(self):
+        """ Write the cache out, if anything has been added to it """
+        if not self._changed:
+            return
+        try:
+            # Write to a temporary file first, so a half-written cache is never read
+            plistlib.writePlist(self._entries, self.path + '.tmp')
+            os.rename(self.path + '.tmp', self.path)
+            self._changed = False
+        except (IOError, OSError) as err:
+            logger.warn("Unable to save restart cache {}: {}".format(self.path, err))
 
-def download_update(update):
-    """ Download a single update, using the softwareupdate -d command
+# Whether updates require a restart, kept between runs
+restart_cache = RestartCache()
 
-        Pass in an update dict
-    """
+def update_label(update):
     # The name we pass to softwareupdate consists of:
     # [Identifier]-[Display Version] so we need to derive that
     # from the productKey we've been given.
-    identifier = "{}-{}".format(update.get("Identifier"),
-                                update.get("Display Version"))
-    logger.info(("Downloading {}".format(identifier)))
-    cmd_with_timeout([SWUPDATE, '-d', identifier], 3600)
+    return "{}-{}".format(update.get("Identifier"),
+                          update.get("Display Version"))
+
+def download_updates(updates, concurrency=DOWNLOAD_CONCURRENCY):
+    """ Download updates in the background, at most concurrency at a time.
+
+        The first downloads start straight away, and the Downloads
+        returned yields each update as its download finishes, so the
+        caller can get on with other updates, and then with each
+        downloaded one, while the rest are still downloading. The
+        downloads are run by the supervisor, so they carry on while the
+        caller runs other commands through it. If a download fails, the
+        update is still yielded but won't be in the cache. If one times
+        out, CommandTimeout is raised.
+    """
+    return Downloads(updates, concurrency)
+
+class Downloads(object):
+    """ Updates being downloaded by download_updates(). Iterating waits
+        for each download to finish in turn, and finished() returns those
+        which already have, without waiting.
+    """
+    def __init__(self, updates, concurrency):
+        self.pending = list(updates)
+        self.concurrency = concurrency
+        self.downloading = {}
+        # Here, not when first iterated, or nothing would start until the
+        # caller asked for the first download
+        self._start()
+
+    def _start(self, finished=None):
+        # Called as each download finishes too, so the next starts then,
+        # even if the caller is busy installing
+        running = len([c for c in self.downloading if c.result is None])
+        while self.pending and running < self.concurrency:
+            update = self.pending.pop(0)
+            logger.info("Downloading {}".format(update_label(update)))
+            command = supervisor.start([SWUPDATE, '-d', update_label(update)], DOWNLOAD_TIMEOUT,
+                                       on_finish=self._start)
+            self.downloading[command] = update
+            running += 1
+
+    def _finish(self, command):
+        update = self.downloading.pop(command)
+        # Just look at what this download added to the cache
+        updates_cache.refresh(update.get("Product Key"))
+        # Downloads run alongside each other, so each is timed by the supervisor
+        metrics.record('download', command.result.seconds,
+                       'timeout' if command.result.timed_out else 'failed' if command.result.returncode else 'ok',
+                       update=update_label(update), exit_code=command.result.returncode)
+        if command.result.timed_out:
+            raise CommandTimeout(command.result)
+        if command.result.returncode != 0:
+            logger.error("Failed to download {}: exit code {}".format(update.get("Display Name"),
+                                                                     command.result.returncode))
+        return update
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self.downloading:
+            raise StopIteration
+        return self._finish(supervisor.wait(list(self.downloading)))
+
+    __next__ = next
+
+    def finished(self):
+        """ The updates whose downloads have finished, without waiting """
+        supervisor.poll(0)
+        return [self._finish(command) for command in list(self.downloading) if command.result is not None]
 
 if __name__ == "__main__":
+    setup_logger()
+
     # Get OS Version
     macOS_vers, _, _ = platform.mac_ver()
     macOS_vers = float('.'.join(macOS_vers.split('.')[:2]))
@@ -641,7 +1610,8 @@ if __name__ == "__main__":
         check_for_icon(SWUPDATE_ICON)
 
     args = get_args()
-    process_updates(args, SWUPDATE_ICON)
+    with metrics.phase('run'):
+        process_updates(args, SWUPDATE_ICON)
 
     # Close the loggers
     logger.info("Done!")
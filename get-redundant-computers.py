@@ -1,53 +1,52 @@
 #!/usr/bin/python
 
 # Import resources
-import urllib2
-import base64
 import getpass
 import subprocess
 from collections import OrderedDict
 import json
 import sys
+# The shared jss_* modules. Jamf only runs the script itself, so they're
+# installed in JSS_MODULES by the JSS tools package (see README.md)
+JSS_MODULES = '/Library/Management/UoE/jss-modules'
+sys.path.append(JSS_MODULES)
+import jss_client
+import jss_cache
+
+# Smart group to report on
+GROUP = "Compliance - Check in over 365 days"
 
 # Function for displaying computers in console
 def display_computers(temp_comp_dict, dict_name):
-    # Convert all machine names to upper case
-    dict_upper = {k.upper(): v for k, v in temp_comp_dict.iteritems()}
-    # Sort dictionary by keys
-    comp_dict = sort_dict_by_keys(dict_upper)
-    # For each key in the dictionary, print the key and the value
+    # Sort dictionary by machine name
+    comp_dict = sort_dict_by_keys(temp_comp_dict)
+    # For each computer in the dictionary, print the name (in upper case), serial and JSS ID
     print "\n%s" % (dict_name)
     print "========================================"
-    for key in comp_dict:
-        print "%s : %s" % (key, comp_dict[key])
+    for comp in comp_dict.values():
+        print "%s : %s (JSS ID %s)" % (comp['name'].upper(), comp['serial_number'], comp['id'])
 
-# Function for sorting dictionary by keys
+# Function for sorting dictionary of computer records by name. Keys stay as JSS IDs,
+# so machines which share a name are kept apart.
 def sort_dict_by_keys(comp_dict):
-    sorted_dict = OrderedDict(sorted(comp_dict.items(), key=lambda t: t[0]))
+    sorted_dict = OrderedDict(sorted(comp_dict.items(), key=lambda t: (t[1]['name'].upper(), t[0])))
     # Return sorted dictionary
     return sorted_dict
 
 # Function to obtain computers formthe JSS
-def get_computers(username, password):
-    URL = "https://uoe.jamfcloud.com/JSSResource/computergroups/name/Compliance%20-%20Check%20in%20over%20365%20days"
+def get_computers(cache, client, max_age=None):
     print "\n"
     print "Obtaining computer information from the JSS for all machines"
-    # Open connection to JSS, passing search string, The request will return JSON.
-    request = urllib2.Request(URL)
-    request.add_header('Accept','application/json')
-    request.add_header('Authorization', 'Basic ' + base64.b64encode(username + ':' + password))
-    response = urllib2.urlopen(request)
-    # Print message to display if info was obtained
-    print "Status code from request: %s\n" % response.code
-    # Store the response from the JSS
-    response_json = json.loads(response.read())
-    # The following code can be used to display all details from the response. For the moment we are only interested in name and serial.
-    #print json.dumps(response_json,sort_keys=True, indent=4)
-    # Declare empty dictionary to store results'
-    comp_group = {}
-    # For each computer record returned, get the computer name and the serial number
-    for computer in response_json['computer_group']['computers']:
-        comp_group[(computer.get('name'))]=computer.get('serial_number')
+    # The group comes from the local cache if it's recent enough. Otherwise it's
+    # fetched from the JSS, parsing records as they arrive, and the cache is updated.
+    comp_group = cache.members(client, GROUP, max_age)
+    refresh = cache.last_refresh
+    if refresh.source == 'cache':
+        print "Using local cache from %d seconds ago (run with --refresh to fetch again)" % refresh.age
+    elif refresh.source == 'unchanged':
+        print "The JSS reports that the group hasn't changed since it was cached"
+    else:
+        print "Fetched from the JSS: %d added, %d removed, %d changed since last time" % (refresh.added, refresh.removed, refresh.changed)
     #Find amount of computers
     amount = len(comp_group.keys())
     # Return amount of computers and the full list
@@ -59,14 +58,25 @@ def get_computers(username, password):
 # Clear the screen
 subprocess.call('clear')
 
-# Get JSS username
-username = raw_input ('Enter JSS username: ')
-# Get JSS password
-password = getpass.getpass(prompt='Enter your JSS password: ')
+cache = jss_cache.GroupCache()
+refresh = '--refresh' in sys.argv[1:]
+age = cache.age(GROUP)
+
+if refresh or age is None or age >= cache.ttl:
+    # Get JSS username
+    username = raw_input ('Enter JSS username: ')
+    # Get JSS password
+    password = getpass.getpass(prompt='Enter your JSS password: ')
+    client = jss_client.JSSClient(username, password)
+else:
+    # Everything we need is in the cache, so there's no need to log in
+    client = None
 
-comp_dict, total_amount= get_computers(username, password)
+comp_dict, total_amount= get_computers(cache, client, 0 if refresh else None)
+if client:
+    client.close()
+cache.close()
 
 sort_dict_by_keys(comp_dict)
 display_computers(comp_dict, "Last check-in with JSS over 365 days ago")
 print "\nTotal amount not seen in over 365 days : %d\n" % total_amount
-
@@ -0,0 +1,297 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Bounded-concurrency bulk request engine for the JSS Classic API,
+# used by the record-cleanup scripts.
+#
+# Requests are sent from a fixed pool of worker threads sharing one
+# jss_client.JSSClient. A token bucket caps the overall request rate
+# so we don't hammer the cloud tenant, and 429/5xx responses are
+# retried with exponential backoff. Every record gets an outcome,
+# so one failure no longer stops the whole run.
+#
+# Completed records can be written to an on-disk Journal as they
+# finish, so an interrupted run picks up where it left off.
+#
+# Date: @@DATE
+# Version: @@VERSION
+# Origin: @@ORIGIN
+# Released by JSS User: @@USER
+#
+##################################################################
+
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from collections import namedtuple
+
+import jss_client
+
+try:
+    import httplib
+    import Queue as queue
+except ImportError:
+    import http.client as httplib
+    import queue
+
+# Default number of requests in flight at once
+WORKERS = 8
+# Default sustained requests per second, and how many may be sent in a burst
+RATE = 10.0
+BURST = 10
+# Default attempts per record, and the base delay between them in seconds
+ATTEMPTS = 5
+BACKOFF = 1.0
+# Never wait longer than this between attempts, whatever the JSS says
+MAX_BACKOFF = 60.0
+
+# A single request to make: key identifies the record in the outcome
+Job = namedtuple('Job', ['key', 'method', 'path', 'body', 'headers'])
+# What happened to a Job. status is None if no response was ever received.
+Outcome = namedtuple('Outcome', ['key', 'status', 'attempts', 'seconds', 'error'])
+# XML sent to the JSS to turn off management of a computer
+UNMANAGE_PAYLOAD = "<computer><general><remote_management><managed>false</managed></remote_management></general></computer>"
+
+module_logger = logging.getLogger(__name__)
+
+
+def is_retryable(status):
+    """ Returns True if a request with this status is worth trying again """
+    return status == 429 or 500 <= status < 600
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket, refilled at rate tokens per second,
+        holding at most burst tokens.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until a token is available, then take it """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class BulkRunner(object):
+    """ Send many requests through a shared JSSClient from a pool of threads
+
+        workers:  maximum number of requests in flight
+        rate:     sustained requests per second across all workers (None for no limit)
+        burst:    requests which may be sent at once before rate applies
+        attempts: tries per request before giving up on 429/5xx or network errors
+        backoff:  base delay in seconds; doubles after each failed attempt
+        on_outcome: optional callable, called with each Outcome as it completes
+        logger:   where to log errors raised by on_outcome
+    """
+    def __init__(self, client, workers=WORKERS, rate=RATE, burst=BURST,
+                 attempts=ATTEMPTS, backoff=BACKOFF, on_outcome=None, logger=None):
+        self.client = client
+        self.workers = max(1, int(workers))
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.attempts = max(1, int(attempts))
+        self.backoff = backoff
+        self.on_outcome = on_outcome
+        self.logger = logger or module_logger
+        self._lock = threading.Lock()
+
+    def _delay(self, attempt, retry_after=None):
+        # Honour Retry-After if the JSS sent one, otherwise back off
+        # exponentially with some jitter so workers don't retry in lockstep
+        if retry_after:
+            try:
+                return min(MAX_BACKOFF, float(retry_after))
+            except ValueError:
+                pass
+        return min(MAX_BACKOFF, self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+    def _send(self, job):
+        start = time.time()
+        status = None
+        error = None
+        for attempt in range(1, self.attempts + 1):
+            if self.bucket:
+                self.bucket.acquire()
+            retry_after = None
+            try:
+                status, body, headers = self.client.request(job.method, job.path, job.body, job.headers,
+                                                            with_headers=True)
+                error = None
+                if not is_retryable(status):
+                    break
+                retry_after = headers.get('retry-after')
+                error = 'HTTP {}'.format(status)
+            except (httplib.HTTPException, socket.error) as err:
+                status = None
+                error = '{}: {}'.format(type(err).__name__, err)
+            if attempt < self.attempts:
+                time.sleep(self._delay(attempt, retry_after))
+        if status == 404 and job.method == 'DELETE' and attempt > 1:
+            # An earlier attempt got through even though we never heard back,
+            # so the record is already gone
+            error = None
+        elif error is None and status >= 400:
+            error = 'HTTP {}'.format(status)
+        return Outcome(job.key, status, attempt, time.time() - start, error)
+
+    def _worker(self, jobs, outcomes):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            try:
+                outcome = self._send(job)
+            except Exception as err:
+                # Anything unexpected is recorded against the record, rather
+                # than killing the worker and stranding the rest of the queue
+                outcome = Outcome(job.key, None, 0, 0.0, '{}: {}'.format(type(err).__name__, err))
+            with self._lock:
+                outcomes.append(outcome)
+                if self.on_outcome:
+                    try:
+                        self.on_outcome(outcome)
+                    except Exception:
+                        # eg the journal couldn't be written. Carry on, or
+                        # run() would wait forever for this worker
+                        self.logger.exception("Error handling the outcome for {}".format(outcome.key))
+
+    def run(self, jobs):
+        """ Send every Job in jobs and return a list of Outcomes, in order of completion """
+        outcomes = []
+        # Keep the queue short so jobs can be generated lazily
+        work = queue.Queue(maxsize=self.workers * 2)
+        threads = [threading.Thread(target=self._worker, args=(work, outcomes))
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for job in jobs:
+            work.put(job)
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+
+class Journal(object):
+    """ An append-only record of completed keys, one per line, kept on disk
+
+        Keys are flushed as they are added, so if a run is interrupted
+        the next one can skip everything which was already done. Once a
+        run has finished all of its work the journal should be cleared.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as journal:
+                self.done.update(line.strip() for line in journal if line.strip())
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, key):
+        with self._lock:
+            if key not in self.done:
+                self.done.add(key)
+                self._file.write(key + '\n')
+                self._file.flush()
+
+    def clear(self):
+        """ Forget everything, and remove the journal from disk """
+        with self._lock:
+            self.done.clear()
+            self._file.close()
+            os.remove(self.path)
+            self._file = open(self.path, 'a')
+
+    def close(self):
+        self._file.close()
+
+
+def summarise(outcomes):
+    """ Return a dict of status -> count for a list of Outcomes.
+        Requests which never got a response are counted under 'error'.
+    """
+    counts = {}
+    for outcome in outcomes:
+        key = outcome.status if outcome.status is not None else 'error'
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def percentile(values, fraction):
+    """ Return the value at fraction (0-1) of the way through sorted values """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def performance(outcomes, elapsed):
+    """ Return a dict of throughput (requests/s) and per-record latency
+        percentiles, in seconds, for a run which took elapsed seconds
+    """
+    latencies = [o.seconds for o in outcomes]
+    return {'records': len(outcomes),
+            'seconds': elapsed,
+            'per_second': len(outcomes) / elapsed if elapsed else 0.0,
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies) if latencies else 0.0}
+
+
+def delete_computers(client, computers, **kwargs):
+    """ DELETE each computer in computers, a dict of JSS ID -> computer record,
+        returning a list of Outcomes keyed by JSS ID.
+        Extra keyword arguments are passed to BulkRunner.
+    """
+    jobs = (Job(comp['id'], 'DELETE', jss_client.computer_path(comp), None, None)
+            for comp in computers.values())
+    return BulkRunner(client, **kwargs).run(jobs)
+
+
+def unmanage_computers(client, computers, journal=None, on_outcome=None, **kwargs):
+    """ PUT the unmanage payload for each computer in computers, a dict of
+        JSS ID -> computer record, returning a list of Outcomes keyed by JSS ID.
+
+        If a Journal is given, computers whose JSS ID is already in it are
+        skipped, and each JSS ID is added as soon as it succeeds. IDs are
+        used rather than serial numbers, as a re-enrolled Mac can have
+        more than one record with the same serial.
+        Extra keyword arguments are passed to BulkRunner.
+    """
+    def record(outcome):
+        if journal is not None and outcome.error is None:
+            journal.add(str(outcome.key))
+        if on_outcome:
+            on_outcome(outcome)
+
+    jobs = (Job(comp['id'], 'PUT', jss_client.computer_path(comp), UNMANAGE_PAYLOAD, {'Content-Type': 'text/xml'})
+            for comp in computers.values()
+            if journal is None or str(comp['id']) not in journal)
+    return BulkRunner(client, on_outcome=record, **kwargs).run(jobs)
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Local SQLite cache of JSS computer group membership, used by the
+# record-cleanup scripts.
+#
+# Group members (JSS ID, name and serial number) are kept on disk
+# along with when the group was last fetched. Within the TTL a group
+# is served straight from the cache. Once it has expired the group is
+# fetched again - conditionally, if the JSS gave us an ETag or
+# Last-Modified header - and only the differences are written back.
+#
+# Date: @@DATE
+# Version: @@VERSION
+# Origin: @@ORIGIN
+# Released by JSS User: @@USER
+#
+##################################################################
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import jss_client
+
+# One cache for every script, whoever runs it. Kept next to the modules
+# rather than in a home folder, so a run by Jamf (as root) and one by an
+# admin share it.
+CACHE_FILE = '/Library/Management/UoE/jss-cache/jss-records.sqlite'
+# Default seconds a cached group is served without asking the JSS
+TTL = 15 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS groups (
+    name TEXT PRIMARY KEY,
+    fetched REAL NOT NULL,
+    etag TEXT,
+    last_modified TEXT
+);
+CREATE TABLE IF NOT EXISTS computers (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    serial_number TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (
+    group_name TEXT NOT NULL,
+    computer_id INTEGER NOT NULL,
+    PRIMARY KEY (group_name, computer_id)
+);
+'''
+
+# How a call to GroupCache.members() was answered. source is one of
+# 'cache' (not expired), 'unchanged' (the JSS said it hadn't changed) or
+# 'jss' (fetched in full). added, removed and changed count the computers
+# which differed from the cached copy.
+Refresh = namedtuple('Refresh', ['source', 'age', 'added', 'removed', 'changed'])
+
+
+class GroupCache(object):
+    """ On-disk cache of computer group membership
+
+        path: the SQLite database to use, created if needed
+        ttl:  seconds a cached group is good for
+    """
+    def __init__(self, path=CACHE_FILE, ttl=TTL):
+        self.path = path
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            # Only for root, as it lists every machine's name and serial
+            os.makedirs(directory, 0o700)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        # The last Refresh, so callers can report where the data came from,
+        # and the Refresh for each group from the last members_of()
+        self.last_refresh = None
+        self.refreshes = {}
+
+    def _cached(self, group_name):
+        members = {}
+        for comp_id, name, serial in self.db.execute(
+                'SELECT c.id, c.name, c.serial_number FROM members m '
+                'JOIN computers c ON c.id = m.computer_id WHERE m.group_name = ?', (group_name,)):
+            members[comp_id] = {'id': comp_id, 'name': name, 'serial_number': serial}
+        return members
+
+    def age(self, group_name):
+        """ Return how many seconds ago group_name was fetched, or None if it isn't cached """
+        row = self.db.execute('SELECT fetched FROM groups WHERE name = ?', (group_name,)).fetchone()
+        return None if row is None else time.time() - row[0]
+
+    def _row(self, group_name):
+        return self.db.execute('SELECT fetched, etag, last_modified FROM groups WHERE name = ?',
+                               (group_name,)).fetchone()
+
+    def members(self, client, group_name, max_age=None):
+        """ Return the members of group_name as a dict of JSS ID -> computer
+            record, from the cache if it is younger than max_age seconds
+            (the cache's TTL by default), or from the JSS otherwise.
+            Pass max_age=0 to always check with the JSS.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        row = self._row(group_name)
+        now = time.time()
+        if row is not None and now - row[0] < max_age:
+            self.last_refresh = Refresh('cache', now - row[0], 0, 0, 0)
+            return self._cached(group_name)
+        return self._store(group_name, row, fetch(client, group_name, row), now)
+
+    def members_of(self, client, group_names, max_age=None):
+        """ Like members(), for several groups at once. Groups which need to
+            be fetched are fetched concurrently, one thread per group, and
+            written back to the cache as each is parsed.
+
+            Returns an OrderedDict of group name -> members, in the order
+            given, and sets self.refreshes to a dict of group name -> Refresh.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        rows = dict((group_name, self._row(group_name)) for group_name in group_names)
+        now = time.time()
+        stale = [group_name for group_name, row in rows.items() if row is None or now - row[0] >= max_age]
+
+        # SQLite connections can't be shared between threads, so only the
+        # requests and parsing happen in the fetch threads
+        results = {}
+        errors = []
+
+        def fetch_group(group_name):
+            try:
+                results[group_name] = fetch(client, group_name, rows[group_name])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch_group, args=(group_name,)) for group_name in stale]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        groups = OrderedDict()
+        self.refreshes = {}
+        for group_name in group_names:
+            if group_name in results:
+                groups[group_name] = self._store(group_name, rows[group_name], results[group_name], now)
+            else:
+                self.last_refresh = Refresh('cache', now - rows[group_name][0], 0, 0, 0)
+                groups[group_name] = self._cached(group_name)
+            self.refreshes[group_name] = self.last_refresh
+        return groups
+
+    def _store(self, group_name, row, result, now):
+        # Bring the cache up to date with what fetch() returned
+        status, response_headers, fresh = result
+        if status == 304 and row is not None:
+            with self.db:
+                self.db.execute('UPDATE groups SET fetched = ? WHERE name = ?', (now, group_name))
+            self.last_refresh = Refresh('unchanged', 0, 0, 0, 0)
+            return self._cached(group_name)
+        self._update(group_name, fresh, response_headers, now)
+        return fresh
+
+    def _update(self, group_name, fresh, response_headers, now):
+        # Write back only what has changed since the cached copy
+        cached = self._cached(group_name)
+        added = [comp for comp_id, comp in fresh.items() if comp_id not in cached]
+        removed = [comp_id for comp_id in cached if comp_id not in fresh]
+        changed = [comp for comp_id, comp in fresh.items() if comp_id in cached and cached[comp_id] != comp]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO computers (id, name, serial_number) VALUES (?, ?, ?)',
+                                ((c['id'], c['name'], c['serial_number']) for c in added + changed))
+            self.db.executemany('INSERT INTO members (group_name, computer_id) VALUES (?, ?)',
+                                ((group_name, c['id']) for c in added))
+            self.db.executemany('DELETE FROM members WHERE group_name = ? AND computer_id = ?',
+                                ((group_name, comp_id) for comp_id in removed))
+            # Computers which are no longer in any group aren't worth keeping
+            if removed:
+                self.db.execute('DELETE FROM computers WHERE id NOT IN (SELECT computer_id FROM members)')
+            self.db.execute('INSERT OR REPLACE INTO groups (name, fetched, etag, last_modified) VALUES (?, ?, ?, ?)',
+                            (group_name, now, response_headers.get('etag'), response_headers.get('last-modified')))
+        self.last_refresh = Refresh('jss', 0, len(added), len(removed), len(changed))
+
+    def close(self):
+        self.db.close()
+
+
+def fetch(client, group_name, row=None):
+    """ Fetch group_name from the JSS, conditionally if row (the group's
+        cached fetched, etag and last_modified) allows.
+
+        Returns (status, response headers, members), where members is None
+        if the JSS answered 304 Not Modified.
+    """
+    headers = {}
+    if row is not None and row[1]:
+        headers['If-None-Match'] = row[1]
+    if row is not None and row[2]:
+        headers['If-Modified-Since'] = row[2]
+    path = jss_client.group_path(group_name)
+    status, response_headers, chunks = client.get_stream(path, headers)
+    if status == 304 and row is not None:
+        return status, response_headers, None
+    elif status != 200:
+        raise jss_client.JSSError(status, 'GET', path)
+    fresh = {}
+    for computer in jss_client.iter_group_json(chunks):
+        fresh[computer['id']] = jss_client.computer_record(computer)
+    return status, response_headers, fresh
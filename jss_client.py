@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Shared client for the JSS Classic API, used by the record-cleanup
+# scripts (get-, remove- and unmanage-redundant-records).
+#
+# Connections are kept alive and re-used from a small pool, so a run
+# only pays for a TLS handshake once per connection rather than once
+# per request. Smart group membership is parsed incrementally as it
+# comes off the wire, so computer records can be processed as they
+# arrive without holding the whole JSON document in memory.
+#
+# Date: @@DATE
+# Version: @@VERSION
+# Origin: @@ORIGIN
+# Released by JSS User: @@USER
+#
+##################################################################
+
+import base64
+import codecs
+import json
+import re
+import socket
+
+try:
+    import httplib
+    import Queue as queue
+    from urllib import quote
+    from urlparse import urlsplit
+except ImportError:
+    import http.client as httplib
+    import queue
+    from urllib.parse import quote, urlsplit
+
+JSS_URL = 'https://uoe.jamfcloud.com/JSSResource'
+# Size of each read from the socket while streaming a response
+CHUNK_SIZE = 64 * 1024
+# Whitespace allowed between JSON tokens
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Characters which can start, or carry on, a JSON number
+JSON_NUMBER_CHARS = '+-.0123456789eE'
+# Methods which can safely be sent again if a response never comes back
+RETRY_AFTER_SEND = ('GET', 'HEAD')
+
+
+class JSSError(Exception):
+    """ Raised when the JSS answers with an unexpected status code """
+    def __init__(self, code, method, path, reason=''):
+        Exception.__init__(self, '{} {} returned {} {}'.format(method, path, code, reason))
+        self.code = code
+        self.method = method
+        self.path = path
+        self.reason = reason
+
+
+class JSSClient(object):
+    """ A keep-alive connection pool for the JSS Classic API
+
+        The client is safe to share between threads: each request
+        borrows a connection from the pool and returns it once the
+        response has been read in full.
+    """
+
+    def __init__(self, username, password, base_url=JSS_URL, pool_size=4, timeout=60):
+        url = urlsplit(base_url)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.base_path = url.path.rstrip('/')
+        self.timeout = timeout
+        credentials = '{}:{}'.format(username, password).encode('utf-8')
+        self.auth = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def _get_connection(self):
+        # Prefer an idle connection which is already established
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return self._new_connection(), False
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _send(self, method, path, body=None, headers=None):
+        # Send a request and return the connection and response. A pooled
+        # connection may have been closed by the server while it was idle,
+        # in which case we retry once on a fresh connection. Once the request
+        # has gone, it may have been acted on even though no response came
+        # back, so only a GET or HEAD is sent again; anything else is left
+        # for the caller to decide about.
+        all_headers = {'Accept': 'application/json',
+                       'Authorization': self.auth}
+        all_headers.update(headers or {})
+        url = self.base_path + path
+        conn, reused = self._get_connection()
+        sent = False
+        try:
+            conn.request(method, url, body, all_headers)
+            sent = True
+            return conn, conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused or (sent and method not in RETRY_AFTER_SEND):
+                raise
+        conn = self._new_connection()
+        try:
+            conn.request(method, url, body, all_headers)
+            return conn, conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+
+    def _finish(self, conn, response):
+        # A connection can only go back in the pool once its response has
+        # been consumed, and only if the server hasn't asked us to close it
+        if response.isclosed() and not response.will_close:
+            self._release(conn)
+        else:
+            conn.close()
+
+    def request(self, method, path, body=None, headers=None, with_headers=False):
+        """ Send a request and return a (status, body) tuple
+
+            path is relative to the JSSResource base, eg '/computers/id/1'
+            If with_headers is True, a dict of the response headers (with
+            lower case names) is returned as a third item.
+        """
+        conn, response = self._send(method, path, body, headers)
+        try:
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self._finish(conn, response)
+        if with_headers:
+            return response.status, data, dict((k.lower(), v) for k, v in response.getheaders())
+        return response.status, data
+
+    def get_stream(self, path, headers=None):
+        """ GET path, returning a (status, headers, chunks) tuple
+
+            headers is a dict of the response headers, with lower case
+            names. chunks is a generator yielding the response body as it
+            arrives; it should be consumed or closed. If the status isn't
+            200 the body is discarded and chunks yields nothing.
+        """
+        conn, response = self._send('GET', path, None, headers)
+        response_headers = dict((k.lower(), v) for k, v in response.getheaders())
+        if response.status != 200:
+            try:
+                response.read()
+            except Exception:
+                conn.close()
+                raise
+            self._finish(conn, response)
+            return response.status, response_headers, iter([])
+        return response.status, response_headers, self._chunks(conn, response)
+
+    def _chunks(self, conn, response):
+        finished = False
+        try:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            finished = True
+        finally:
+            # If the consumer stopped early, or something went wrong, the
+            # half-read connection can't be re-used
+            if finished:
+                self._finish(conn, response)
+            else:
+                conn.close()
+
+    def stream(self, path):
+        """ GET path, yielding the response body in chunks as it arrives """
+        status, headers, chunks = self.get_stream(path)
+        if status != 200:
+            raise JSSError(status, 'GET', path)
+        return chunks
+
+    def iter_group_computers(self, group_name):
+        """ Yield the computer records of a computer group one at a time """
+        return iter_group_json(self.stream(group_path(group_name)))
+
+    def close(self):
+        """ Close all idle connections in the pool """
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def group_path(group_name):
+    """ Return the API path of a computer group, addressed by name """
+    return '/computergroups/name/{}'.format(quote(group_name, safe=''))
+
+
+def iter_group_json(chunks):
+    """ Yield the members of a computer group from the chunks of its JSON """
+    return iter_json_array(chunks, ('computer_group', 'computers'))
+
+
+def computer_record(computer):
+    """ Return the fields of a computer group member that the cleanup
+        scripts use: JSS ID, name and serial number.
+    """
+    return {'id': computer['id'],
+            'name': computer.get('name') or '',
+            'serial_number': computer.get('serial_number') or ''}
+
+
+def computer_path(computer):
+    """ Return the API path of a computer record, addressed by JSS ID """
+    return '/computers/id/{}'.format(computer['id'])
+
+
+class _JSONStream(object):
+    # A growing text buffer over an iterable of encoded chunks
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = u''
+        self.pos = 0
+
+    def fill(self):
+        # Append the next chunk to the buffer. Returns False at the end of input
+        for chunk in self.chunks:
+            text = self.decoder.decode(chunk)
+            if text:
+                # Drop what we've already consumed so the buffer stays small
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self):
+        # Return the next non-whitespace character without consuming it
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON input')
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError('Expected one of {!r} at offset {}, found {!r}'.format(chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def value(self, decoder=json.JSONDecoder()):
+        # Decode one complete JSON value, reading more input until we have it.
+        # raw_decode() stops a number at whatever it can't parse, so one cut
+        # off by the end of a chunk (eg '1e' or '1.') decodes as just its
+        # first part. Only trust a number once something which can't be part
+        # of it follows, or there's no more input.
+        self.peek()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(self.buf, self.pos)
+                number = self.buf[self.pos] in JSON_NUMBER_CHARS
+                if ((end < len(self.buf) and not (number and self.buf[end] in JSON_NUMBER_CHARS))
+                        or not self.fill()):
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if not self.fill():
+                    raise
+
+
+def iter_json_array(chunks, key_path):
+    """ Incrementally parse a JSON document and yield the members of the
+        array found by following key_path through nested objects.
+
+        Nothing outside that path is kept once it has been skipped over,
+        and each array member is yielded as soon as it has been decoded.
+    """
+    stream = _JSONStream(chunks)
+    stream.expect('{')
+    depth = 0
+    while True:
+        if stream.peek() == '}':
+            # Reached the end of an object on our path without finding the key
+            return
+        key = stream.value()
+        stream.expect(':')
+        if key == key_path[depth] and depth == len(key_path) - 1:
+            break
+        elif key == key_path[depth]:
+            stream.expect('{')
+            depth += 1
+            continue
+        # Not on our path - decode and discard the value
+        stream.value()
+        if stream.expect(',}') == '}':
+            return
+
+    stream.expect('[')
+    if stream.peek() == ']':
+        return
+    while True:
+        yield stream.value()
+        if stream.expect(',]') == ']':
+            return
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# In-process decryption of the encrypted script parameters passed to
+# the record-cleanup scripts by the JSS.
+#
+# Parameters are encrypted on a Mac with:
+#   openssl enc -aes256 -md md5 -a -A -S <salt> -k <passphrase>
+# which gives base64 of 'Salted__' + 8 byte salt + AES-256-CBC
+# ciphertext, keyed with OpenSSL's EVP_BytesToKey. This module reverses
+# that without forking /usr/bin/openssl for every secret, and caches
+# the results for the life of the process.
+#
+# Anything unexpected (no salt header, bad padding) is handed to the
+# openssl binary exactly as before, so the output always matches it.
+# If that can't decrypt it either (eg the passphrase is wrong), or what
+# comes out isn't text, DecryptError is raised.
+#
+# Date: @@DATE
+# Version: @@VERSION
+# Origin: @@ORIGIN
+# Released by JSS User: @@USER
+#
+##################################################################
+
+import base64
+import binascii
+import hashlib
+import subprocess
+
+OPENSSL = '/usr/bin/openssl'
+# The digest /usr/bin/openssl (LibreSSL) uses by default to derive keys
+DIGEST = 'md5'
+SALT_MAGIC = b'Salted__'
+
+# Decrypted strings, keyed by everything that went into them
+_cache = {}
+
+
+class DecryptError(ValueError):
+    """ A parameter couldn't be decrypted with the salt and passphrase given """
+    pass
+
+
+def _text(plain):
+    # Python 3 callers pass and get back text. Garbage from a wrong
+    # passphrase usually isn't valid UTF-8
+    try:
+        return plain.decode('utf-8')
+    except UnicodeDecodeError:
+        raise DecryptError('Decrypted parameter is not UTF-8 text - is the passphrase right?')
+
+
+def _rotl8(x, shift):
+    return ((x << shift) | (x >> (8 - shift))) & 0xFF
+
+
+def _make_sboxes():
+    # Build the AES S-box and its inverse by walking the multiplicative
+    # group of GF(2^8) with generator 3
+    sbox = [0] * 256
+    p = q = 1
+    while True:
+        # p * 3
+        p = p ^ ((p << 1) & 0xFF) ^ (0x1B if p & 0x80 else 0)
+        # q / 3
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xFF
+        if q & 0x80:
+            q ^= 0x09
+        sbox[p] = q ^ _rotl8(q, 1) ^ _rotl8(q, 2) ^ _rotl8(q, 3) ^ _rotl8(q, 4) ^ 0x63
+        if p == 1:
+            break
+    sbox[0] = 0x63
+    inv_sbox = [0] * 256
+    for i, value in enumerate(sbox):
+        inv_sbox[value] = i
+    return sbox, inv_sbox
+
+
+def _gmul(a, b):
+    # Multiply in GF(2^8)
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        a = ((a << 1) ^ 0x1B) & 0xFF if a & 0x80 else a << 1
+        b >>= 1
+    return result
+
+
+SBOX, INV_SBOX = _make_sboxes()
+MUL9, MUL11, MUL13, MUL14 = [[_gmul(x, n) for x in range(256)] for n in (9, 11, 13, 14)]
+
+
+def _round_keys(key):
+    # AES key expansion, returning one 16 byte list per round
+    nk = len(key) // 4
+    rounds = nk + 6
+    words = [list(key[i:i + 4]) for i in range(0, len(key), 4)]
+    rcon = 1
+    for i in range(nk, 4 * (rounds + 1)):
+        temp = list(words[i - 1])
+        if i % nk == 0:
+            temp = [SBOX[b] for b in temp[1:] + temp[:1]]
+            temp[0] ^= rcon
+            rcon = _gmul(rcon, 2)
+        elif nk > 6 and i % nk == 4:
+            temp = [SBOX[b] for b in temp]
+        words.append([a ^ b for a, b in zip(words[i - nk], temp)])
+    return [sum(words[4 * r:4 * r + 4], []) for r in range(rounds + 1)]
+
+
+def _decrypt_block(block, keys):
+    # The AES inverse cipher. The state is column-major: state[row + 4 * col]
+    state = [a ^ b for a, b in zip(block, keys[-1])]
+    for rnd in range(len(keys) - 2, -1, -1):
+        # InvShiftRows and InvSubBytes
+        state = [INV_SBOX[state[r + 4 * ((c - r) % 4)]] for c in range(4) for r in range(4)]
+        state = [a ^ b for a, b in zip(state, keys[rnd])]
+        if rnd == 0:
+            break
+        # InvMixColumns
+        mixed = []
+        for c in range(0, 16, 4):
+            a0, a1, a2, a3 = state[c:c + 4]
+            mixed += [MUL14[a0] ^ MUL11[a1] ^ MUL13[a2] ^ MUL9[a3],
+                      MUL9[a0] ^ MUL14[a1] ^ MUL11[a2] ^ MUL13[a3],
+                      MUL13[a0] ^ MUL9[a1] ^ MUL14[a2] ^ MUL11[a3],
+                      MUL11[a0] ^ MUL13[a1] ^ MUL9[a2] ^ MUL14[a3]]
+        state = mixed
+    return state
+
+
+def bytes_to_key(passphrase, salt, digest=DIGEST, key_length=32, iv_length=16):
+    """ OpenSSL's EVP_BytesToKey with one iteration: returns (key, iv) """
+    derived = b''
+    block = b''
+    while len(derived) < key_length + iv_length:
+        block = hashlib.new(digest, block + passphrase + salt).digest()
+        derived += block
+    return derived[:key_length], derived[key_length:key_length + iv_length]
+
+
+def aes256_cbc_decrypt(ciphertext, key, iv):
+    """ Decrypt ciphertext and strip its PKCS#7 padding.
+        Raises ValueError if the length or padding is wrong.
+    """
+    if not ciphertext or len(ciphertext) % 16:
+        raise ValueError('Ciphertext is not a whole number of blocks')
+    keys = _round_keys(bytearray(key))
+    data = bytearray(ciphertext)
+    previous = bytearray(iv)
+    plain = bytearray()
+    for i in range(0, len(data), 16):
+        block = data[i:i + 16]
+        plain.extend(a ^ b for a, b in zip(_decrypt_block(block, keys), previous))
+        previous = block
+    pad = plain[-1]
+    if not 1 <= pad <= 16 or plain[-pad:] != bytearray([pad]) * pad:
+        raise ValueError('Bad padding')
+    return bytes(plain[:-pad])
+
+
+def openssl_decrypt(input_string, salt, passphrase, digest=None):
+    """ Decrypt by running the openssl binary, as the scripts used to.
+        Without a digest, openssl's own default is used.
+    """
+    cmd = [OPENSSL, 'enc', '-aes256', '-d', '-a', '-A', '-S', salt, '-k', passphrase]
+    if digest:
+        cmd[2:2] = ['-md', digest]
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    text = not isinstance(input_string, bytes)
+    out, err = p.communicate(input_string.encode('utf-8') if text else input_string)
+    if p.returncode != 0:
+        raise DecryptError('openssl could not decrypt parameter: {}'.format(
+            err.decode('utf-8', 'replace').strip() or 'exit status {}'.format(p.returncode)))
+    return _text(out).strip() if text else out.strip()
+
+
+def _decrypt(input_string, salt, passphrase, digest):
+    try:
+        data = base64.b64decode(input_string.strip())
+    except (TypeError, binascii.Error):
+        data = b''
+    if not data.startswith(SALT_MAGIC) or len(data) < 32:
+        # openssl has its own ideas about input like this; let it decide
+        return openssl_decrypt(input_string, salt, passphrase, digest)
+    # Like /usr/bin/openssl, take the salt from the header rather than -S
+    key, iv = bytes_to_key(passphrase.encode('utf-8') if not isinstance(passphrase, bytes) else passphrase,
+                           data[8:16], digest or DIGEST)
+    try:
+        plain = aes256_cbc_decrypt(data[16:], key, iv)
+    except ValueError:
+        return openssl_decrypt(input_string, salt, passphrase, digest)
+    if not isinstance(input_string, bytes):
+        plain = _text(plain)
+    return plain.strip()
+
+
+def decrypt_string(input_string, salt, passphrase, digest=None):
+    """ Decrypt a JSS script parameter, giving the same result as
+        echo input_string | openssl enc -aes256 -d -a -A -S salt -k passphrase
+        digest is the key derivation digest, if not openssl's default (md5).
+        Results are cached, so each secret is only decrypted once per run.
+        Raises DecryptError if it can't be decrypted.
+    """
+    cache_key = (input_string, salt, passphrase, digest)
+    if cache_key not in _cache:
+        _cache[cache_key] = _decrypt(input_string, salt, passphrase, digest)
+    return _cache[cache_key]
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Structured event log for the record-cleanup scripts.
+#
+# Every request made for a computer record is written as one line of
+# JSON (run, time, record id, action, status code, latency, attempts
+# and any error) to an append-only events file alongside the text log.
+#
+# Events go through the logging module, but the handler only puts them
+# on a queue. A background thread writes them out in batches, so the
+# worker threads sending requests never wait on the disk. If the queue
+# is full an event is dropped and counted, rather than blocking.
+#
+# Summary reads an events file back a line at a time and keeps only
+# counts and a fixed latency histogram, so a log of any size can be
+# summarised in constant memory:
+#   jss_events.py /Library/Logs/JSSRecordsRemoved/events.jsonl [run]
+#
+# Date: @@DATE
+# Version: @@VERSION
+# Origin: @@ORIGIN
+# Released by JSS User: @@USER
+#
+##################################################################
+
+from __future__ import print_function
+import bisect
+import json
+import logging
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Events held in memory waiting to be written, before new ones are dropped
+CAPACITY = 10000
+# Most events written before the file is flushed
+BATCH = 500
+# Upper bounds, in seconds, of the latency histogram buckets: 1ms doubling
+# every four buckets, up to about 65s. Anything slower goes in a last bucket.
+LATENCY_BUCKETS = [0.001 * 2 ** (i / 4.0) for i in range(65)]
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """ Formats a record's event dict as one line of compact JSON """
+    def format(self, record):
+        event = {'time': round(record.created, 3)}
+        event.update(getattr(record, 'event', {}) or {'message': record.getMessage()})
+        return json.dumps(event, sort_keys=True, separators=(',', ':'))
+
+
+class BufferedFileHandler(logging.Handler):
+    """ Appends formatted records to path, flushing only when asked """
+    def __init__(self, path):
+        logging.Handler.__init__(self)
+        self.stream = open(path, 'a')
+
+    def emit(self, record):
+        self.stream.write(self.format(record) + '\n')
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+        logging.Handler.close(self)
+
+
+class QueueHandler(logging.Handler):
+    """ Puts records on a queue without ever blocking. Records which don't
+        fit are dropped and counted in self.dropped.
+    """
+    def __init__(self, records):
+        logging.Handler.__init__(self)
+        self.records = records
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class QueueListener(object):
+    """ Background thread which takes records off a queue and passes them
+        to handler, flushing it after each batch
+    """
+    def __init__(self, records, handler, batch=BATCH):
+        self.records = records
+        self.handler = handler
+        self.batch = batch
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            # Wait for the next record, then take whatever else is waiting
+            batch = [self.records.get()]
+            try:
+                while len(batch) < self.batch:
+                    batch.append(self.records.get_nowait())
+            except queue.Empty:
+                pass
+            for record in batch:
+                if record is not None:
+                    self.handler.handle(record)
+            self.handler.flush()
+            if batch[-1] is None:
+                return
+
+    def stop(self):
+        """ Write out everything queued so far, then stop """
+        self.records.put(None)
+        self._thread.join()
+
+
+class EventLog(object):
+    """ Write events for one run of a script to a JSON-lines file
+
+        path:     the events file, appended to
+        run:      identifies this run in the file (the start time by default)
+        capacity: events held in memory before new ones are dropped
+    """
+    def __init__(self, path, run=None, capacity=CAPACITY):
+        self.path = path
+        self.run = run or time.strftime('%Y-%m-%dT%H:%M:%S')
+        records = queue.Queue(maxsize=capacity)
+        self.handler = QueueHandler(records)
+        file_handler = BufferedFileHandler(path)
+        file_handler.setFormatter(JSONLinesFormatter())
+        self.listener = QueueListener(records, file_handler).start()
+        # A logger of our own, so events don't end up in the text log
+        self.logger = logging.getLogger('jss_events.{}'.format(id(self)))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def log(self, record_id, action, status=None, latency=None, attempts=None, error=None):
+        """ Queue an event for a record. Never blocks. """
+        self.logger.info(action, extra={'event': {'run': self.run,
+                                                  'id': record_id,
+                                                  'action': action,
+                                                  'status': status,
+                                                  'latency': None if latency is None else round(latency, 4),
+                                                  'attempts': attempts,
+                                                  'error': error}})
+
+    def log_outcome(self, action, outcome):
+        """ Queue an event for a jss_bulk.Outcome """
+        self.log(outcome.key, action, outcome.status, outcome.seconds, outcome.attempts, outcome.error)
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    def close(self):
+        """ Write out every queued event and close the file. Safe to call more than once. """
+        if self.handler not in self.logger.handlers:
+            return
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+        self.listener.handler.close()
+
+
+class Summary(object):
+    """ Aggregates events in constant memory: counts by action and status,
+        and a histogram of latencies for approximate percentiles
+    """
+    def __init__(self):
+        self.events = 0
+        self.counts = {}
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.first = None
+        self.last = None
+
+    def add(self, event):
+        self.events += 1
+        # Events with no status are either errors or, like report, didn't make a request
+        status = event.get('status')
+        if status is None:
+            status = 'error' if event.get('error') else 'none'
+        key = (event.get('action'), status)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        if event.get('error'):
+            self.errors += 1
+        latency = event.get('latency')
+        if latency is not None:
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            self.histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        if event.get('time') is not None:
+            self.first = event['time'] if self.first is None else min(self.first, event['time'])
+            self.last = event['time'] if self.last is None else max(self.last, event['time'])
+
+    def percentile(self, fraction):
+        """ Return the upper bound of the bucket holding fraction (0-1) of latencies """
+        timed = sum(self.histogram)
+        if not timed:
+            return 0.0
+        wanted = max(1, fraction * timed)
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if seen >= wanted:
+                return min(LATENCY_BUCKETS[i], self.latency_max) if i < len(LATENCY_BUCKETS) else self.latency_max
+        return self.latency_max
+
+    def as_dict(self):
+        timed = sum(self.histogram)
+        seconds = (self.last - self.first) if self.events > 1 else 0.0
+        return {'events': self.events,
+                'errors': self.errors,
+                'by_action_status': dict(('{} {}'.format(action, status), count)
+                                         for (action, status), count in self.counts.items()),
+                'seconds': seconds,
+                'per_second': self.events / seconds if seconds else 0.0,
+                'latency_mean': self.latency_total / timed if timed else 0.0,
+                'latency_p50': self.percentile(0.5),
+                'latency_p90': self.percentile(0.9),
+                'latency_p99': self.percentile(0.99),
+                'latency_max': self.latency_max}
+
+
+def summarise(path, run=None):
+    """ Summarise the events in path, or only those from run if given.
+        Lines which aren't valid JSON (eg a partly written last line) are skipped.
+    """
+    summary = Summary()
+    with open(path) as events:
+        for line in events:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if run is None or event.get('run') == run:
+                summary.add(event)
+    return summary
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: {} <events file> [run]'.format(sys.argv[0]))
+        sys.exit(1)
+    print(json.dumps(summarise(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None).as_dict(),
+                     indent=2, sort_keys=True))
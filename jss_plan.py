@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# Plans for the record-cleanup scripts: the exact set of actions a run
+# will take, kept on disk as JSON lines (one computer per line) so a
+# plan of any size can be written, read and diffed as a stream.
+#
+# Each run's plan is diffed against the previous one, so the operator
+# only has to review what has changed, and records which were already
+# dealt with aren't sent to the JSS again.
+#
+# Date: @@DATE
+# Version: @@VERSION
+# Origin: @@ORIGIN
+# Released by JSS User: @@USER
+#
+##################################################################
+
+import json
+import os
+from collections import OrderedDict, namedtuple
+
+# Status of an entry in a plan
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# The result of diffing a new plan against the previous one. plan is an
+# OrderedDict of JSS ID -> entry; added and dropped are lists of entries
+# which are new to this plan or have left it; done counts entries carried
+# over which need no further action.
+PlanDiff = namedtuple('PlanDiff', ['plan', 'added', 'dropped', 'done'])
+
+
+def load(path):
+    """ Read a plan file, returning an OrderedDict of JSS ID -> entry.
+        A missing plan file is an empty plan.
+    """
+    plan = OrderedDict()
+    if not os.path.exists(path):
+        return plan
+    with open(path) as plan_file:
+        for line in plan_file:
+            if line.strip():
+                entry = json.loads(line)
+                plan[entry['id']] = entry
+    return plan
+
+
+def write(path, plan):
+    """ Write a plan file, one compact JSON entry per line. The file is
+        replaced atomically, so a reader never sees half a plan.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as plan_file:
+        for entry in plan.values():
+            plan_file.write(json.dumps(entry, sort_keys=True, separators=(',', ':')) + '\n')
+    os.rename(temp_path, path)
+
+
+def diff(previous, computers, action):
+    """ Build the plan for applying action to computers, a dict of JSS ID ->
+        computer record in the order they should appear, and compare it with
+        the previous plan.
+
+        Entries for computers already in the previous plan keep their status,
+        so anything done last time isn't done again. Computers no longer in
+        the group are dropped.
+    """
+    plan = OrderedDict()
+    added = []
+    done = 0
+    for comp_id, comp in computers.items():
+        entry = previous.get(comp_id)
+        if (entry is None or entry['action'] != action or
+                entry['name'] != comp['name'] or entry['serial_number'] != comp['serial_number']):
+            entry = {'id': comp_id,
+                     'name': comp['name'],
+                     'serial_number': comp['serial_number'],
+                     'action': action,
+                     'status': PENDING}
+            added.append(entry)
+        elif entry['status'] == DONE:
+            done += 1
+        plan[comp_id] = entry
+    dropped = [entry for comp_id, entry in previous.items() if comp_id not in plan]
+    return PlanDiff(plan, added, dropped, done)
+
+
+def format_entry(entry):
+    """ Return a compact one-line description of a plan entry """
+    return '{} {} {} ({})'.format(entry['id'], entry['name'], entry['serial_number'], entry['status'])
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+###################################################################
+#
+# What the record-cleanup scripts (remove-, unmanage- and
+# cleanup-redundant-records) do to the computers they find, shared so
+# each script doesn't carry its own copy.
+#
+# Each function takes the script's logger, for the text log, and its
+# jss_events.EventLog, which gets one event per request.
+#
+# Date: @@DATE
+# Version: @@VERSION
+# Origin: @@ORIGIN
+# Released by JSS User: @@USER
+#
+##################################################################
+
+import json
+import time
+from collections import OrderedDict
+
+import jss_bulk
+import jss_events
+
+
+def sort_by_name(computers):
+    """ Return a dict of JSS ID -> computer record as an OrderedDict sorted
+        by name. Keys stay as JSS IDs, so machines which share a name are
+        kept apart.
+    """
+    return OrderedDict(sorted(computers.items(), key=lambda t: (t[1]['name'].upper(), t[0])))
+
+
+def remove_computers(client, computers, workers, rate, logger, events):
+    """ Delete every computer in computers from the JSS, returning the Outcomes """
+    # Function to log the result of each removal as it completes
+    def log_outcome(outcome):
+        comp = computers[outcome.key]
+        events.log_outcome('delete', outcome)
+        if outcome.error is not None:
+            logger.error("Unable to remove %s (JSS ID %s) record from the JSS: %s (%d attempt(s))"
+                         % (comp['name'], comp['id'], outcome.error, outcome.attempts))
+
+    logger.info("Removing %d records from the JSS with %d workers...." % (len(computers), workers))
+    # Requests are sent concurrently, rate limited and retried on 429/5xx.
+    # A failure is logged against its record rather than stopping the run.
+    outcomes = jss_bulk.delete_computers(client, computers, workers=workers, rate=rate,
+                                         on_outcome=log_outcome, logger=logger)
+    # Report how every record got on
+    failed = sorted("%s (JSS ID %s)" % (computers[o.key]['name'], o.key) for o in outcomes if o.error is not None)
+    logger.info("Outcome by status code: %s" % json.dumps(jss_bulk.summarise(outcomes), sort_keys=True))
+    if failed:
+        logger.error("%d record(s) could not be removed: %s" % (len(failed), ", ".join(failed)))
+    return outcomes
+
+
+def unmanage_computers(client, computers, journal, workers, rate, logger, events):
+    """ Turn off management of every computer in computers whose JSS ID
+        isn't in journal, returning the Outcomes
+    """
+    # Function to log the result of each unmanage request as it completes
+    def log_outcome(outcome):
+        comp = computers[outcome.key]
+        events.log_outcome('unmanage', outcome)
+        if outcome.error is not None:
+            logger.error("Unable to unmanage %s (JSS ID %s): %s (%d attempt(s))"
+                         % (comp['name'], comp['id'], outcome.error, outcome.attempts))
+
+    already_done = [comp for comp in computers.values() if str(comp['id']) in journal]
+    if already_done:
+        logger.info("Skipping %d machines already unmanaged by a previous run: %s"
+                    % (len(already_done), ", ".join("%s (JSS ID %s)" % (comp['serial_number'], comp['id'])
+                                                   for comp in already_done)))
+    logger.info("Attempting to unmanage %d machines in the JSS with %d workers...."
+                % (len(computers) - len(already_done), workers))
+    # Requests are sent concurrently through the shared client, and each
+    # JSS ID is journalled as soon as its machine has been unmanaged
+    start = time.time()
+    outcomes = jss_bulk.unmanage_computers(client, computers, journal=journal, workers=workers,
+                                           rate=rate, on_outcome=log_outcome, logger=logger)
+    stats = jss_bulk.performance(outcomes, time.time() - start)
+    logger.info("Sent %d requests in %.1fs (%.1f/s). Latency p50 %.3fs, p90 %.3fs, p99 %.3fs, max %.3fs"
+                % (stats['records'], stats['seconds'], stats['per_second'],
+                   stats['p50'], stats['p90'], stats['p99'], stats['max']))
+    logger.info("Outcome by status code: %s" % json.dumps(jss_bulk.summarise(outcomes), sort_keys=True))
+    return outcomes
+
+
+def close_events(events, logger):
+    """ Write out the event log and add a summary of this run to the text log """
+    events.close()
+    summary = jss_events.summarise(events.path, events.run).as_dict()
+    logger.info("Run summary: %s" % json.dumps(summary, sort_keys=True))
+    if events.dropped:
+        logger.warn("%d events could not be written to %s" % (events.dropped, events.path))
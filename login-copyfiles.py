@@ -16,6 +16,31 @@
 #
 # This script expects to be run as a login script with $3 containing
 # the username of the logging-in user.
+#
+# With INCREMENTAL set, a manifest of what was copied is kept for each
+# user in MANIFEST_DIR, and a file is only copied again if it, or the
+# copy in the home folder, has changed since it was last copied.
+#
+# The home folder is waited for for up to TARGET_WAIT seconds, watching
+# the folder above it with kqueue (macOS) or inotify (Linux), so the
+# copying starts as soon as it appears.
+#
+# Files are copied by COPY_WORKERS threads at once, in the kernel
+# (sendfile() on Linux, fcopyfile() on macOS) where it can be done.
+#
+# Items starting with 'ro:' (eg ro:Library/Fonts) are read-only, and
+# are deployed as READONLY_DEPLOY says rather than copied:
+#   clone - a copy-on-write clone of each file (clonefile() on APFS,
+#           the FICLONE ioctl on btrfs/XFS), or a copy if the
+#           filesystem can't clone
+#   link  - a hard link to a file in the content-addressed STORE_DIR,
+#           kept once for everyone, owned by root and not writable (a
+#           copy if the store is on another filesystem). Stored files
+#           nothing links to any more are removed after each login.
+#   auto  - clone where possible, otherwise link
+#   copy  - copy, as any other item
+# A linked file which someone has since replaced gets a real copy from
+# then on, so they can change it.
 # 
 # Date: @@DATE
 # Version: @@VERSION
@@ -28,12 +53,53 @@ import os
 import sys
 import pwd
 import time
+import json
+import stat
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import select
+import shutil
+import hashlib
+import threading
 import subprocess
 from datetime import datetime
-from distutils.file_util import copy_file
-from distutils.dir_util import mkpath
-from distutils.errors import DistutilsFileError
-
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # The backport, if it's installed
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Only copy files which have changed since they were last copied
+INCREMENTAL = True
+# Compare the contents of source files too, not just their size and mtime
+HASH_CONTENTS = False
+# Where each user's manifest of copied files is kept between logins
+MANIFEST_DIR = '/var/db/UoELoginCopyfiles'
+# Longest we wait for the home folder to appear, in seconds
+TARGET_WAIT = 10
+# Files copied at once
+COPY_WORKERS = 8
+# Most files handed to a copying thread at a time
+COPY_BATCH = 64
+# Items starting with this are read-only
+READONLY_PREFIX = 'ro:'
+# How read-only items are deployed: clone, link, auto or copy
+READONLY_DEPLOY = 'auto'
+# Where linked files are kept, only readable by root. Hard links need it
+# on the same filesystem as the home folders
+STORE_DIR = '/Library/Application Support/UoELoginCopyfiles/Store'
+# Stored files are only removed once nothing has linked to them for this
+# many seconds
+STORE_PRUNE_AGE = 3600
 
 
 def main(args):
@@ -48,17 +114,53 @@ def main(args):
     if not wait_for_target(args['target']):
         sys.exit(1)
 
+    if INCREMENTAL:
+        args['manifest'] = Manifest(os.path.join(MANIFEST_DIR, args['user'] + '.json'),
+                                    hash_contents=HASH_CONTENTS)
+    args['engine'] = CopyEngine(args['uid'], args['gid'], workers=COPY_WORKERS,
+                                manifest=args.get('manifest'),
+                                store=ContentStore(STORE_DIR))
+
+    copies = []
     for item in args['items']:
-        target = '/'.join([args['target'], item])
-        source = '/'.join([args['source'], item])
-        log("Copying {} to {}".format(source, target))
-        try:
+        deploy = 'copy'
+        if item.startswith(READONLY_PREFIX):
+            item = item[len(READONLY_PREFIX):]
+            deploy = READONLY_DEPLOY
+        copies.append(('/'.join([args['source'], item]),
+                       '/'.join([args['target'], item]), deploy))
 
-            copy_item(source, target, args)
-        except TypeError as exc:
-            # probably just a file that doesn't exist
-            print(exc)
-            
+    # Make every directory the items go in first, all in one go
+    create_parents([(source, target) for source, target, _ in copies], args)
+
+    try:
+        for source, target, deploy in copies:
+            log("Copying {} to {} ({})".format(source, target, deploy))
+            try:
+
+                copy_item(source, target, args, deploy)
+            except TypeError as exc:
+                # probably just a file that doesn't exist
+                print(exc)
+    finally:
+        # Wait for the copies to finish, then set their ownership. Whatever
+        # was copied is given to the user, and kept in the manifest, even
+        # if something went wrong
+        try:
+            args['engine'].finish()
+        finally:
+            if args.get('manifest'):
+                args['manifest'].save()
+    log("Copied {} files, {} unchanged ({} cloned, {} linked)".format(
+        args['engine'].copied, args['engine'].unchanged,
+        args['engine'].cloned, args['engine'].linked))
+
+    # Anything this login stopped linking to may not be wanted by anyone now
+    if any(deploy in ('link', 'auto') for _, _, deploy in copies):
+        try:
+            log("Removed {} unused files from the store".format(args['engine'].store.prune()))
+        except OSError as exc:
+            log("Unable to prune the store: {}".format(exc))
 
     log("Done.") 
         
@@ -99,133 +201,766 @@ def user_is_local(user):
                                 '-U', user, '-G', 'localaccounts']).split('\n'))
   
   
-def copy_item(source, target, args):
+def copy_item(source, target, args, deploy='copy'):
     
-    create_parents(source, target, args)
-
+    engine = args['engine']
     if os.path.isfile(source):
-        copy_file(source, target)
-        os.chown(target, args['uid'], args['gid'])
+        engine.copy_file(source, target, deploy=deploy)
         
     elif os.path.isdir(source):
-        copy_tree(source, target, uid=args['uid'], gid=args['gid'])
+        engine.copy_tree(source, target, deploy=deploy)
 
     else:
         raise TypeError('copy_item() passed something other'
                         'than a path to a file or directory.')
 
 
-def create_parents(source, target, args):
-    def _recurse(path):
-        components = []
-        if os.path.isfile(path):
-            components = os.path.dirname(target).split('/')
-        elif os.path.isdir(path):
-            components = target.split('/')
-        for i in range(1, len(components) + 1):
-            thisdir = '/' + '/'.join(components[:i])
-            log(thisdir)
-            yield thisdir
-    
-    for item in _recurse(source):
-        if not os.path.isdir(item):
-            os.mkdir(item)
-            os.chown(item, args['uid'], args['gid'])
-
-
-def wait_for_target(target):
-    maxwait = 10
-    waited = 0
-    while not os.path.isdir(target):
-        if waited == maxwait:
-            log('Target {} doesn\'t exist after {} '
-                'seconds. Exiting'.format(target, maxwait))
-            return False
-        else:
-            log('Waiting for {} to exist ({})'.format(target, waited))
-            waited += 1
-            time.sleep(1)
-    return True
+def create_parents(items, args):
+    """Create the directories which the (source, target) pairs in 'items'
+    are to be copied into, owned by the user: a file's parent, or a
+    directory itself.
+    """
+    # The home folder exists, so nothing above it needs looking at
+    planner = DirectoryPlanner(exists=[args['target']])
+    for source, target in items:
+        if os.path.isfile(source):
+            planner.add(os.path.dirname(target))
+        elif os.path.isdir(source):
+            planner.add(target)
+    for path in planner.create(args['uid'], args['gid']):
+        log('Created ' + path)
+    log('Checked {} directories for {} items ({} stat() calls saved)'.format(
+        planner.checked, len(items), planner.saved))
+
+
+class DirectoryPlanner(object):
+    """Works out which directories need creating for a set of paths.
+
+    Every directory in the paths added goes in a trie, so one shared by
+    many paths (like the home folder and everything above it) is only
+    looked at once. Anything under 'exists' isn't looked at at all, and
+    nor is anything under a directory which had to be created.
+
+    'checked' counts the directories looked at, and 'saved' the stat()s
+    avoided compared with checking every directory in every path.
+    """
+    def __init__(self, exists=()):
+        self.root = {}
+        self.checked = 0
+        self.requested = 0
+        self.exists = set()
+        for path in exists:
+            # Everything above an existing directory exists too
+            names = self._split(path)
+            for i in range(1, len(names) + 1):
+                self.exists.add('/' + '/'.join(names[:i]))
+
+    @staticmethod
+    def _split(path):
+        return [name for name in path.split('/') if name]
+
+    @property
+    def saved(self):
+        return self.requested - self.checked
+
+    def add(self, path):
+        names = self._split(path)
+        # '/' and every directory down to 'path'
+        self.requested += len(names) + 1
+        node = self.root
+        for name in names:
+            node = node.setdefault(name, {})
+
+    def create(self, uid, gid):
+        """Create the missing directories, parents first, owned by 'uid'
+        and 'gid', and return their paths.
+        """
+        created = []
+
+        def _walk(node, path, parent_missing):
+            for name in sorted(node):
+                child = path + '/' + name
+                missing = parent_missing
+                if not missing and child not in self.exists:
+                    self.checked += 1
+                    missing = not os.path.isdir(child)
+                if missing:
+                    os.mkdir(child)
+                    os.chown(child, uid, gid)
+                    created.append(child)
+                _walk(node[name], child, missing)
+
+        _walk(self.root, '', False)
+        return created
+
+
+def wait_for_target(target, maxwait=TARGET_WAIT, watch=None):
+    """Wait up to 'maxwait' seconds for directory 'target' to exist,
+    returning as soon as it does. Whatever is above it is watched with
+    'watch(directory)' (watch_directory() by default), and looked at
+    again each time that says it's changed.
+    """
+    watch = watch or watch_directory
+    deadline = time.time() + maxwait
+    backend = None
+    try:
+        while True:
+            # Watch the nearest directory above the target which exists,
+            # starting before looking, so nothing happening in between is missed
+            watched = existing_parent(target)
+            if backend is None or backend.directory != watched:
+                if backend is not None:
+                    backend.close()
+                backend = watch(watched)
+            if os.path.isdir(target):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                log('Target {} doesn\'t exist after {} '
+                    'seconds. Exiting'.format(target, maxwait))
+                return False
+            log('Waiting for {} to exist ({:.1f}s left)'.format(target, remaining))
+            backend.wait_for_change(remaining)
+    finally:
+        if backend is not None:
+            backend.close()
+
+
+def existing_parent(path):
+    parent = os.path.dirname(path.rstrip('/')) or '/'
+    while not os.path.isdir(parent):
+        parent = os.path.dirname(parent) or '/'
+    return parent
+
+
+def watch_directory(directory):
+    """Return a backend which waits for something to change in
+    'directory': kqueue on macOS, inotify on Linux, or failing those,
+    looking every second.
+    """
+    try:
+        if hasattr(select, 'kqueue'):
+            return KqueueDirectoryBackend(directory)
+        if _inotify_init1 is not None:
+            return InotifyDirectoryBackend(directory)
+    except (IOError, OSError) as exc:
+        log("Can't watch {} ({}) - polling instead".format(directory, exc))
+    return PollingDirectoryBackend(directory)
+
+
+class PollingDirectoryBackend(object):
+    """Has no way of knowing when 'directory' changes, so just waits
+    'interval' seconds between looks.
+    """
+    def __init__(self, directory, interval=1):
+        self.directory = directory
+        self.interval = interval
+
+    def wait_for_change(self, timeout):
+        time.sleep(min(self.interval, timeout))
+
+    def close(self):
+        pass
+
+
+class InotifyDirectoryBackend(object):
+    """Waits for inotify to say something was created in, or moved
+    into, 'directory'.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if _inotify_add_watch(self.fd, _path_bytes(directory), IN_CREATE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err), directory)
+
+    def wait_for_change(self, timeout):
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except (select.error, OSError) as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            # We only care that something happened, not what
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except OSError as exc:
+                if exc.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        os.close(self.fd)
+
+
+class KqueueDirectoryBackend(object):
+    """Waits for kqueue to say 'directory' was written to, which is
+    what adding anything to it does.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        # O_EVTONLY, so watching doesn't stop the volume being unmounted
+        self.fd = os.open(directory, getattr(os, 'O_EVTONLY', 0x8000))
+        try:
+            self.kq = select.kqueue()
+            self.kq.control([select.kevent(self.fd, filter=select.KQ_FILTER_VNODE,
+                                           flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                                           fflags=select.KQ_NOTE_WRITE)], 0)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def wait_for_change(self, timeout):
+        try:
+            self.kq.control(None, 1, timeout)
+        except (select.error, OSError) as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+
+    def close(self):
+        self.kq.close()
+        os.close(self.fd)
+
 
 def log(msg):
     print('{}: {}'.format(datetime.now(), msg))
 
 
-# This is copied from distutils and modified to add chown functionality
-def copy_tree(src, dst, uid=None, gid=None, preserve_mode=1, preserve_times=1,
-              preserve_symlinks=0, update=0, verbose=1, dry_run=0):
-    """Copy an entire directory tree 'src' to a new location 'dst'.
-
-    Both 'src' and 'dst' must be directory names.  If 'src' is not a
-    directory, raise DistutilsFileError.  If 'dst' does not exist, it is
-    created with 'mkpath()'.  The end result of the copy is that every
-    file in 'src' is copied to 'dst', and directories under 'src' are
-    recursively copied to 'dst'.  Return the list of files that were
-    copied or might have been copied, using their output name.  The
-    return value is unaffected by 'update' or 'dry_run': it is simply
-    the list of all files under 'src', with the names changed to be
-    under 'dst'.
-
-    If 'uid' and 'gid' are provided, newly created directories and 
-    files will have ownership changed to match them. Requires that 
-    you are running as root.
-    
-    'preserve_mode' and 'preserve_times' are the same as for
-    'copy_file'; note that they only apply to regular files, not to
-    directories.  If 'preserve_symlinks' is true, symlinks will be
-    copied as symlinks (on platforms that support them!); otherwise
-    (the default), the destination of the symlink will be copied.
-    'update' and 'verbose' are the same as for 'copy_file'.
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """What was copied at previous logins, kept in a JSON file at 'path'.
+
+    For each copied file (keyed by its target path) the manifest holds
+    the size and mtime of the source and of the copy, and with
+    'hash_contents' the SHA-1 of the source. A file is unchanged if both
+    still match, so the copy is still there and nobody has touched it.
+
+    Files deployed as links to the store are marked, so that if one has
+    since been replaced, was_replaced() says it's to get a real copy. That
+    sticks, so it's never linked again however the copy changes.
+
+    Only files looked at in this run are saved, so anything no longer
+    being copied drops out.
     """
+    def __init__(self, path, hash_contents=False):
+        self.path = path
+        self.hash_contents = hash_contents
+        self.current = {}
+        # Targets found to have been replaced this time
+        self.replaced = set()
+        try:
+            with open(path) as f:
+                self.previous = json.load(f)
+        except (IOError, ValueError):
+            # First login, or an unreadable manifest: copy everything
+            self.previous = {}
+
+    def is_unchanged(self, src, dst, src_st=None):
+        entry = self.previous.get(dst)
+        if entry is None:
+            return False
+        try:
+            src_st = src_st or os.stat(src)
+            dst_st = os.stat(dst)
+        except OSError:
+            return False
+        if (entry['source'] != [src_st.st_size, src_st.st_mtime] or
+                entry['target'] != [dst_st.st_size, dst_st.st_mtime]):
+            return False
+        if self.hash_contents and entry.get('hash') != file_hash(src):
+            return False
+        self.current[dst] = entry
+        return True
 
-    if not dry_run and not os.path.isdir(src):
-        raise DistutilsFileError, \
-              "cannot copy tree '%s': not a directory" % src
+    def was_replaced(self, dst):
+        entry = self.previous.get(dst)
+        if not entry:
+            return False
+        if entry.get('replaced'):
+            return True
+        if not entry.get('linked'):
+            return False
+        try:
+            dst_st = os.stat(dst)
+            replaced = entry['target'] != [dst_st.st_size, dst_st.st_mtime]
+        except OSError:
+            replaced = True
+        if replaced:
+            self.replaced.add(dst)
+        return replaced
+
+    def record(self, src, dst, src_st=None, dst_st=None, linked=False):
+        src_st = src_st or os.stat(src)
+        dst_st = dst_st or os.stat(dst)
+        entry = {'source': [src_st.st_size, src_st.st_mtime],
+                 'target': [dst_st.st_size, dst_st.st_mtime]}
+        if linked:
+            entry['linked'] = True
+        if dst in self.replaced or self.previous.get(dst, {}).get('replaced'):
+            entry['replaced'] = True
+        if self.hash_contents:
+            entry['hash'] = file_hash(src)
+        self.current[dst] = entry
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), 0o700)
+        # Write to a temporary file first, so a half-written manifest is never read
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.current, f)
+        os.rename(self.path + '.tmp', self.path)
+
+
+def _load_libc():
     try:
-        names = os.listdir(src)
-    except os.error, (errno, errstr):
-        if dry_run:
-            names = []
-        else:
-            raise DistutilsFileError, \
-                  "error listing files in '%s': %s" % (src, errstr)
-
-    if not dry_run:
-        mkpath(dst, verbose=verbose)
-        if uid and gid:
-            log('chown: ' + dst)
-            os.chown(dst, uid, gid)
-
-    outputs = []
-
-    for n in names:
-        src_name = os.path.join(src, n)
-        dst_name = os.path.join(dst, n)
-
-        if preserve_symlinks and os.path.islink(src_name):
-            link_dest = os.readlink(src_name)
-            if verbose >= 1:
-                log("linking {} -> {}".format(dst_name, link_dest))
-            if not dry_run:
-                os.symlink(link_dest, dst_name)
-            outputs.append(dst_name)
-
-        elif os.path.isdir(src_name):
-            outputs.extend(
-                copy_tree(src_name, dst_name, uid, gid, preserve_mode,
-                          preserve_times, preserve_symlinks, update,
-                          verbose=verbose, dry_run=dry_run))
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+_sendfile = None
+_fcopyfile = None
+if _libc is not None and sys.platform.startswith('linux'):
+    # Only Linux can sendfile() between regular files
+    _sendfile = _libc.sendfile
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+elif _libc is not None and sys.platform == 'darwin':
+    _fcopyfile = _libc.fcopyfile
+    _fcopyfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_uint32]
+    _fcopyfile.restype = ctypes.c_int
+# fcopyfile() flag to copy just the data
+COPYFILE_DATA = 1 << 3
+_clonefile = None
+if _libc is not None and sys.platform == 'darwin':
+    try:
+        _clonefile = _libc.clonefile
+        _clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32]
+        _clonefile.restype = ctypes.c_int
+    except AttributeError:
+        # Before 10.12
+        _clonefile = None
+# Linux ioctl to make a file share all of another's data: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# What clonefile() and FICLONE fail with when the filesystem can't clone
+CLONE_UNSUPPORTED = set([errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV,
+                         errno.EINVAL, errno.ENOTTY, errno.ENOSYS])
+_inotify_init1 = None
+_inotify_add_watch = None
+if _libc is not None and sys.platform.startswith('linux'):
+    try:
+        _inotify_init1 = _libc.inotify_init1
+        _inotify_init1.argtypes = [ctypes.c_int]
+        _inotify_init1.restype = ctypes.c_int
+        _inotify_add_watch = _libc.inotify_add_watch
+        _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _inotify_add_watch.restype = ctypes.c_int
+    except AttributeError:
+        _inotify_init1 = None
+# inotify flags, from <sys/inotify.h>
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CREATE = 0x100
+IN_MOVED_TO = 0x80
+
+
+def _path_bytes(path):
+    # ctypes wants bytes for char *
+    return path if isinstance(path, bytes) else path.encode('utf-8')
+
+
+def copy_data(fsrc, fdst, size):
+    """Copy the contents of open file 'fsrc' to 'fdst', in the kernel if
+    possible, otherwise by reading and writing it here.
+    """
+    if _sendfile is not None:
+        copied = 0
+        while copied < size:
+            sent = _sendfile(fdst.fileno(), fsrc.fileno(), None, size - copied)
+            if sent <= 0:
+                break
+            copied += sent
+        if copied >= size:
+            return
+        # Something odd (eg the file grew or shrank): just copy the rest
+        fsrc.seek(copied)
+        fdst.seek(copied)
+    elif _fcopyfile is not None:
+        if _fcopyfile(fsrc.fileno(), fdst.fileno(), None, COPYFILE_DATA) == 0:
+            return
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def copy_file_contents(src, dst, src_st):
+    """Copy file 'src' to 'dst' with the mode and times of 'src', as
+    distutils' copy_file() did: any existing 'dst' is removed first.
+    Returns the stat of the copy.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            if src_st.st_size:
+                copy_data(fsrc, fdst, src_st.st_size)
+    os.utime(dst, (src_st.st_atime, src_st.st_mtime))
+    os.chmod(dst, stat.S_IMODE(src_st.st_mode))
+    return os.stat(dst)
+
+
+def clone_file(src, dst):
+    """Make 'dst' a copy-on-write clone of 'src', sharing its data until
+    either is changed. 'dst' mustn't exist. Returns False, leaving no
+    'dst', if the filesystem can't clone.
+    """
+    if _clonefile is not None:
+        if _clonefile(_path_bytes(src), _path_bytes(dst), 0) == 0:
+            return True
+        err = ctypes.get_errno()
+        if err in CLONE_UNSUPPORTED:
+            return False
+        raise OSError(err, os.strerror(err), dst)
+    if not sys.platform.startswith('linux'):
+        return False
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return True
+            except (IOError, OSError) as exc:
+                if exc.errno not in CLONE_UNSUPPORTED:
+                    raise
+    os.unlink(dst)
+    return False
+
+
+class ContentStore(object):
+    """Files kept once each in directory 'root', named by the SHA-1 of
+    their contents, to be hard linked into home folders.
+
+    The store is only for root: 'root' and everything in it must be
+    owned by whoever runs this (root) and not be symlinks, and 'root' is
+    kept at mode 0700. Stored files aren't writable, so one user can't
+    change a file everyone shares; all they can do is replace their
+    link. A stored file's contents are checked against its name before
+    it's first reused in a run, and replaced if they don't match.
+
+    If 'root' isn't as it should be, nothing is linked, and the files
+    are copied instead (see usable()).
+    """
+    def __init__(self, root):
+        self.root = root
+        self._usable = None
+        self._verified = set()
+        self._lock = threading.Lock()
+
+    def _check(self, path, st, is_type):
+        """Raise OSError unless 'st', the lstat of 'path', is of type
+        'is_type' and is ours.
+        """
+        if stat.S_ISLNK(st.st_mode) or not is_type(st.st_mode):
+            raise OSError(errno.EPERM, 'not a plain file or directory', path)
+        if st.st_uid != os.geteuid():
+            raise OSError(errno.EPERM, 'owned by uid {}'.format(st.st_uid), path)
+
+    def _make_dir(self, path):
+        """Create directory 'path' if it isn't there, and check it's ours"""
+        try:
+            os.mkdir(path, 0o700)
+        except OSError as exc:
+            # Already there, perhaps made by another thread
+            if exc.errno != errno.EEXIST:
+                raise
+        st = os.lstat(path)
+        self._check(path, st, stat.S_ISDIR)
+        if stat.S_IMODE(st.st_mode) != 0o700:
+            os.chmod(path, 0o700)
+
+    def usable(self):
+        """Whether the store can be used, creating it if need be. Only
+        looked at once, and logged if it can't be.
+        """
+        with self._lock:
+            if self._usable is None:
+                try:
+                    if not os.path.isdir(os.path.dirname(self.root)):
+                        os.makedirs(os.path.dirname(self.root), 0o755)
+                    self._make_dir(self.root)
+                    self._usable = True
+                except OSError as exc:
+                    log("Not linking to the store, copying instead: {}".format(exc))
+                    self._usable = False
+            return self._usable
+
+    def add(self, src, src_st):
+        """Store the contents, mode and times of 'src', if they aren't
+        already, and return the path of the stored file.
+        """
+        digest = file_hash(src)
+        # Files with the same contents but different modes or mtimes are
+        # stored separately, so each link looks just like a copy would
+        mode = stat.S_IMODE(src_st.st_mode) & ~0o222
+        path = os.path.join(self.root, digest[:2], '{}-{:o}-{}'.format(digest, mode, int(src_st.st_mtime)))
+        if path in self._verified:
+            return path
+        self._make_dir(os.path.dirname(path))
+        try:
+            st = os.lstat(path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
         else:
-            copy_file(src_name, dst_name, preserve_mode,
-                      preserve_times, update, verbose=verbose,
-                      dry_run=dry_run)
-            if uid and gid:
-                log('chown: ' + dst_name)
-                os.chown(dst_name, uid, gid)
-            outputs.append(dst_name)
-           
-
-    return outputs
+            try:
+                self._check(path, st, stat.S_ISREG)
+                if stat.S_IMODE(st.st_mode) != mode or file_hash(path) != digest:
+                    raise OSError(errno.EINVAL, 'contents or mode have changed', path)
+                self._verified.add(path)
+                return path
+            except OSError as exc:
+                log("Replacing stored file: {}".format(exc))
+                os.unlink(path)
+        # Copy it in under a name of our own, so it only appears once complete
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        copy_file_contents(src, tmp, src_st)
+        os.chmod(tmp, mode)
+        os.rename(tmp, path)
+        self._verified.add(path)
+        return path
+
+    def link(self, stored, dst):
+        """Hard link 'dst' to the stored file 'stored'. Returns False if it
+        can't be, eg if the store is on another filesystem (a symlink
+        into the store would be no use, as users can't get into it).
+        """
+        try:
+            os.link(stored, dst)
+        except OSError as exc:
+            if exc.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                raise
+            return False
+        return True
+
+    def prune(self, min_age=STORE_PRUNE_AGE):
+        """Remove the stored files nothing links to any more, and any
+        left half-copied, and return how many were removed. Anything
+        changed in the last 'min_age' seconds is left, as another login
+        may be about to link to it.
+        """
+        if not self.usable():
+            return 0
+        removed = 0
+        now = time.time()
+        for subdir in os.listdir(self.root):
+            directory = os.path.join(self.root, subdir)
+            try:
+                self._check(directory, os.lstat(directory), stat.S_ISDIR)
+            except OSError as exc:
+                log("Not pruning {}: {}".format(directory, exc))
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                st = os.lstat(path)
+                # Only our own files, and the ctime changes whenever a link
+                # is made or removed
+                if (not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid() or
+                        st.st_nlink > 1 or now - st.st_ctime < min_age):
+                    continue
+                os.unlink(path)
+                self._verified.discard(path)
+                removed += 1
+        return removed
+
+
+def list_dir(path):
+    """Return (name, is_dir, stat) for everything in 'path', following
+    symlinks, using the stat results scandir() already has where it can.
+    """
+    if scandir is not None:
+        return [(entry.name, entry.is_dir(), entry.stat()) for entry in scandir(path)]
+    entries = []
+    for name in os.listdir(path):
+        st = os.stat(os.path.join(path, name))
+        entries.append((name, stat.S_ISDIR(st.st_mode), st))
+    return entries
+
+
+class CopyEngine(object):
+    """Copies files and directory trees into a home folder.
+
+    Trees are walked here, creating directories as they're reached, and
+    the files are handed to a pool of 'workers' threads to copy. Once
+    finish() has waited for them, everything created or copied is given
+    to 'uid' and 'gid' in one pass, and the first error any copy hit is
+    raised.
+
+    With a 'manifest', files it says are unchanged since they were last
+    copied are skipped, and those which are copied are recorded in it.
+
+    Files can be deployed as clones or as links to a 'store' instead of
+    copied (see deploy_file()). Linked files are left to the store's
+    owner rather than chowned.
+    """
+    def __init__(self, uid=None, gid=None, workers=COPY_WORKERS, manifest=None, store=None):
+        self.uid = uid
+        self.gid = gid
+        self.workers = workers
+        self.manifest = manifest
+        self.store = store
+        self.copied = 0
+        self.unchanged = 0
+        self.cloned = 0
+        self.linked = 0
+        # Cleared the first time cloning or linking fails, so it isn't tried
+        # for every file
+        self.can_clone = True
+        self.can_link = True
+        self._tasks = queue.Queue(maxsize=workers * 4)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._done = []
+        self._errors = []
+        self._chown = []
+
+    def _worker(self):
+        while True:
+            batch = self._tasks.get()
+            try:
+                if batch is None:
+                    return
+                done = []
+                errors = []
+                for src, dst, src_st, deploy in batch:
+                    try:
+                        done.append((src, dst, src_st) + self.deploy_file(src, dst, src_st, deploy))
+                    except Exception as exc:
+                        # Anything let out would end the thread, and leave the
+                        # files still queued waiting for it forever
+                        log("Unable to deploy {} to {}: {}".format(src, dst, exc))
+                        errors.append(exc)
+                with self._lock:
+                    self._done.extend(done)
+                    self._errors.extend(errors)
+            finally:
+                self._tasks.task_done()
+
+    def deploy_file(self, src, dst, src_st, deploy='copy'):
+        """Put file 'src' at 'dst' as 'deploy' says: 'copy', 'clone',
+        'link', or 'auto' for a clone if possible, otherwise a link.
+        Anything which can't be done falls back to a copy. Returns the
+        stat of 'dst' and how it was deployed.
+        """
+        if deploy in ('clone', 'auto') and self.can_clone:
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            if clone_file(src, dst):
+                os.utime(dst, (src_st.st_atime, src_st.st_mtime))
+                os.chmod(dst, stat.S_IMODE(src_st.st_mode))
+                return os.stat(dst), 'clone'
+            self.can_clone = False
+        if deploy in ('link', 'auto') and self.can_link and self.store is not None and self.store.usable():
+            stored = self.store.add(src, src_st)
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            if self.store.link(stored, dst):
+                return os.stat(dst), 'link'
+            self.can_link = False
+        return copy_file_contents(src, dst, src_st), 'copy'
+
+    def _submit(self, batch):
+        if len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._tasks.put(batch)
+
+    def _wanted(self, src, dst, src_st, deploy):
+        """Return how 'src' is to be deployed to 'dst', or None if it's
+        unchanged since last time.
+        """
+        if not self.manifest:
+            return deploy
+        if self.manifest.is_unchanged(src, dst, src_st):
+            self.unchanged += 1
+            return None
+        if deploy != 'copy' and self.manifest.was_replaced(dst):
+            # Someone wants their own version of this one
+            return 'copy'
+        return deploy
+
+    def copy_file(self, src, dst, src_st=None, deploy='copy'):
+        src_st = src_st or os.stat(src)
+        deploy = self._wanted(src, dst, src_st, deploy)
+        if deploy:
+            self._submit([(src, dst, src_st, deploy)])
+
+    def copy_tree(self, src, dst, deploy='copy'):
+        """Copy everything in directory 'src' to 'dst', creating 'dst' and
+        any directories under it which don't exist. Files are deployed as
+        'deploy' says (see deploy_file()).
+        """
+        if not os.path.isdir(src):
+            raise OSError("cannot copy tree '%s': not a directory" % src)
+        if not os.path.isdir(dst):
+            os.makedirs(dst)
+        self._chown.append(dst)
+        # Hand the files over in batches, and only then go into the directories
+        batch = []
+        subdirs = []
+        for name, is_dir, st in list_dir(src):
+            src_name = src + '/' + name
+            dst_name = dst + '/' + name
+            if is_dir:
+                subdirs.append((src_name, dst_name))
+                continue
+            how = self._wanted(src_name, dst_name, st, deploy)
+            if how:
+                batch.append((src_name, dst_name, st, how))
+                if len(batch) == COPY_BATCH:
+                    self._submit(batch)
+                    batch = []
+        if batch:
+            self._submit(batch)
+        for src_name, dst_name in subdirs:
+            self.copy_tree(src_name, dst_name, deploy)
+
+    def finish(self):
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        for src, dst, src_st, dst_st, how in self._done:
+            if how == 'link':
+                self.linked += 1
+            else:
+                self._chown.append(dst)
+                self.cloned += how == 'clone'
+            if self.manifest:
+                self.manifest.record(src, dst, src_st, dst_st, linked=how == 'link')
+        self.copied += len(self._done)
+        self._done = []
+        if self.uid and self.gid:
+            for path in self._chown:
+                os.chown(path, self.uid, self.gid)
+            log("Set ownership of {} files and directories".format(len(self._chown)))
+        self._chown = []
+        if self._errors:
+            raise self._errors[0]
 
 
 if __name__ == '__main__':
@@ -1,13 +1,21 @@
 #!/usr/bin/python
 
 # Import resources
-import urllib2
-import base64
 import getpass
-import subprocess
 from collections import OrderedDict
 import json
 import sys
+# The shared jss_* modules. Jamf only runs the script itself, so they're
+# installed in JSS_MODULES by the JSS tools package (see README.md)
+JSS_MODULES = '/Library/Management/UoE/jss-modules'
+sys.path.append(JSS_MODULES)
+import jss_client
+import jss_credentials
+import jss_events
+import jss_cache
+import jss_plan
+import jss_bulk
+import jss_records
 import logging
 import datetime
 import os
@@ -35,6 +43,13 @@ else:
 
 log_file = "/Library/Logs/JSSRecordsRemoved/%s.log" % current_short_date
 
+# The plan from the last run, one JSON line per computer, recording what was
+# to be removed and whether it has been
+plan_file = "/Library/Logs/JSSRecordsRemoved/plan.jsonl"
+
+# One line of JSON for every request made for a record, for later analysis
+events_file = "/Library/Logs/JSSRecordsRemoved/events.jsonl"
+
 # Create logger object and set default logging level
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -58,87 +73,130 @@ file_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 logger.addHandler(file_handler)
 
+# Events are queued and written out by a background thread, so logging them
+# never holds up the requests
+events = jss_events.EventLog(events_file)
+
 # Function to close and remove logging handlers
 def close_logger():
+    events.close()
     console_handler.close()
     file_handler.close()
     logger.removeHandler(console_handler)
     logger.removeHandler(file_handler)
 
-# Function for sorting dictionary by keys
-def sort_dict_by_keys(temp_comp_dict):
-    dict_upper = {k.upper(): v for k, v in temp_comp_dict.iteritems()}
-    sorted_dict = OrderedDict(sorted(dict_upper.items(), key=lambda t: t[0]))
-    # Return sorted dictionary
-    return sorted_dict
-
 # Function to obtain computers from the JSS
-def get_computers(username, password):
-    URL = "https://uoe.jamfcloud.com/JSSResource/computergroups/name/Compliance%20-%20No%20check-in%20for%20over%20300%20days"
+def get_computers(client):
+    group = "Compliance - No check-in for over 300 days"
     logger.info("\n")
     logger.info('Obtaining information from JSS smart group "Compliance - No check-in for over 300 days":')
-    # Open connection to JSS, passing search string, The request will return JSON.
-    request = urllib2.Request(URL)
-    request.add_header('Accept','application/json')
-    request.add_header('Authorization', 'Basic ' + base64.b64encode(username + ':' + password))
-    response = urllib2.urlopen(request)
-    # Print message to display if info was obtained
-    logger.info("Status code from request: %s\n" % response.code)
-    # Store the response from the JSS
-    response_json = json.loads(response.read())
-    # The following code can be used to display all details from the response. For the moment we are only interested in name and serial.
-    #print json.dumps(response_json,sort_keys=True, indent=4)
-    # Declare empty dictionary to store results'
-    comp_group = {}
-    # For each computer record returned, get the computer name and the serial number
-    for computer in response_json['computer_group']['computers']:
-        comp_group[(computer.get('name'))]=computer.get('serial_number')
+    # Always check with the JSS before acting on records, but go through the local
+    # cache so only the differences are written back, and interactive queries
+    # afterwards can be answered locally.
+    cache = jss_cache.GroupCache()
+    comp_group = cache.members(client, group, max_age=0)
+    refresh = cache.last_refresh
+    logger.info("Group membership changes since last fetch: %d added, %d removed, %d changed" % (refresh.added, refresh.removed, refresh.changed))
+    cache.close()
     #Find amount of computers
     amount = len(comp_group.keys())
     # Return amount of computers and the full list
     return comp_group, amount
 
-def remove_computers(username, password, computers):
-    for comp in computers:
-        logger.info("Removing %s record from the JSS...." % comp)
-        URL = "https://uoe.jamfcloud.com/JSSResource/computers/name/%s" % comp
-        request = urllib2.Request(URL)
-        request.add_header('Accept','application/json')
-        request.add_header('Authorization', 'Basic ' + base64.b64encode(username + ':' + password))
-        request.get_method = lambda: 'DELETE'
-        response = urllib2.urlopen(request)
-
 def DecryptString(inputString, salt, passphrase):
     '''Usage: >>> DecryptString("Encrypted String", "Salt", "Passphrase")'''
-    p = subprocess.Popen(['/usr/bin/openssl', 'enc', '-aes256', '-d', '-a', '-A', '-S', salt, '-k', passphrase], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
-    return p.communicate(inputString)[0].strip()
+    # Decrypted in-process and cached, falling back to /usr/bin/openssl
+    return jss_credentials.decrypt_string(inputString, salt, passphrase)
 
 # Get encrypted strings
 apiuser = str(sys.argv[4])
 apipword = str(sys.argv[5])
 salt = str(sys.argv[6])
 passphrase = str(sys.argv[7])
+# Optional concurrency and requests-per-second limit for the removals
+try:
+    workers = int(sys.argv[8])
+except (IndexError, ValueError):
+    workers = jss_bulk.WORKERS
+try:
+    rate = float(sys.argv[9])
+except (IndexError, ValueError):
+    rate = jss_bulk.RATE
+# Optional mode:
+#   plan  - dry run. Work out what would be removed, show what has changed since
+#           the last plan and write the new plan for review. Nothing is removed.
+#   apply - remove only what is in the reviewed plan. Anything which has joined
+#           the group since is left for the next plan.
+#   auto  - (default) plan and remove everything in one go.
+try:
+    mode = sys.argv[10] or 'auto'
+except IndexError:
+    mode = 'auto'
+if mode not in ('plan', 'apply', 'auto'):
+    logger.error("Mode must be one of plan, apply or auto, not %s" % mode)
+    close_logger()
+    sys.exit(1)
 
 # De-crypt strings
-JSSusername = DecryptString(apiuser ,salt, passphrase)
-JSSpword = DecryptString(apipword ,salt, passphrase)
+try:
+    JSSusername = DecryptString(apiuser ,salt, passphrase)
+    JSSpword = DecryptString(apipword ,salt, passphrase)
+except jss_credentials.DecryptError as err:
+    logger.error("Unable to decrypt the JSS credentials: %s" % err)
+    close_logger()
+    sys.exit(1)
+
+# Connect to the JSS. Connections are kept open and shared by every request,
+# with one per worker.
+client = jss_client.JSSClient(JSSusername, JSSpword, pool_size=workers)
 
 # Get list of machines that have not contacted JSS in over 300 days
-comp_dict, total_amount= get_computers(JSSusername, JSSpword)
+comp_dict, total_amount= get_computers(client)
 
 # Sort the machines by name
-sorted_comp = sort_dict_by_keys(comp_dict)
+sorted_comp = jss_records.sort_by_name(comp_dict)
 
-# Print out list of machines
+# Compare with the previous plan, and only show what has changed
 logger.info("Total amount not seen in over 300 days : %d" % total_amount)
-logger.info("Complete list of machines not checked in in over 300 days")
-logger.info("===========================================================")
-logger.info((json.dumps(sorted_comp, indent=35, sort_keys=True)))
-logger.info("Preparing to remove JSS Records...")
+planned = jss_plan.diff(jss_plan.load(plan_file), sorted_comp, 'delete')
+logger.info("Changes since the last plan: %d new, %d no longer in the group, %d already removed"
+            % (len(planned.added), len(planned.dropped), planned.done))
+for entry in planned.added:
+    logger.info("+ %s" % jss_plan.format_entry(entry))
+for entry in planned.dropped:
+    logger.info("- %s" % jss_plan.format_entry(entry))
+
+if mode == 'plan':
+    jss_plan.write(plan_file, planned.plan)
+    logger.info("Dry run: plan written to %s. No records have been removed." % plan_file)
+    client.close()
+    close_logger()
+    sys.exit(0)
+
+plan = planned.plan
+if mode == 'apply' and planned.added:
+    # Only act on what the operator has already seen in a plan
+    for entry in planned.added:
+        del plan[entry['id']]
+    logger.warn("%d machines are not in the reviewed plan and will be left alone. Run in plan mode to review them." % len(planned.added))
+
+# Anything already removed by a previous run is skipped
+to_remove = OrderedDict((comp_id, sorted_comp[comp_id]) for comp_id, entry in plan.items() if entry['status'] != jss_plan.DONE)
+logger.info("Preparing to remove %d JSS Records..." % len(to_remove))
 
 # Remove the records
-remove_computers(JSSusername, JSSpword, sorted_comp)
+outcomes = jss_records.remove_computers(client, to_remove, workers, rate, logger, events)
+client.close()
+
+# Record how each removal went, so the next plan can skip what's done
+for outcome in outcomes:
+    plan[outcome.key]['status'] = jss_plan.DONE if outcome.error is None else jss_plan.FAILED
+jss_plan.write(plan_file, plan)
 
-logger.info("JSS Records removed!")
+if all(o.error is None for o in outcomes):
+    logger.info("JSS Records removed!")
+else:
+    logger.warn("JSS Records removed, with errors.")
 
-close_logger()
\ No newline at end of file
+jss_records.close_events(events, logger)
+close_logger()
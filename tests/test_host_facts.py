@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+""" Tests for the pmset and sysctl parsing in coreconfig-softwareupdate-run.py,
+    against the outputs collected in benchmarks/fixtures/host_facts
+    (expected.json says what each should parse to), and for HostFacts
+    only probing each fact once.
+
+    The script is Python 2, so these only run under Python 2.
+
+    Run with: python -m unittest discover tests
+"""
+
+import json
+import logging
+import os
+import sys
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(REPO, 'coreconfig-softwareupdate-run.py')
+FIXTURES = os.path.join(REPO, 'benchmarks', 'fixtures', 'host_facts')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as output:
+        return output.read()
+
+
+class Prober(object):
+    """ Answers sysctl and pmset from fixtures, counting the calls """
+    def __init__(self, model, power):
+        self.outputs = {'sysctl': fixture('sysctl-hw.model-{}.txt'.format(model)),
+                        'pmset': fixture('pmset-batt-{}.txt'.format(power))}
+        self.calls = 0
+
+    def __call__(self, cmd):
+        self.calls += 1
+        return self.outputs[cmd[0]]
+
+
+@unittest.skipIf(sys.version_info[0] > 2, 'the script is Python 2')
+class HostFactsTest(unittest.TestCase):
+
+    def setUp(self):
+        import imp
+        self.swupdate = imp.load_source('swupdate_run', SCRIPT)
+        self.swupdate.logger.addHandler(logging.NullHandler())
+
+    def test_fixtures(self):
+        with open(os.path.join(FIXTURES, 'expected.json')) as expected_file:
+            expected = json.load(expected_file)
+        for name in sorted(expected):
+            if name.startswith('pmset'):
+                parsed = dict(self.swupdate.parse_pmset_batt(fixture(name))._asdict())
+            else:
+                parsed = {'model': self.swupdate.parse_sysctl_model(fixture(name))}
+            self.assertEqual(parsed, expected[name], name)
+
+    def test_checks(self):
+        for model, power, ok, laptop in (('macbookpro', 'macbookpro-discharging', True, True),
+                                         ('macbookair', 'macbookair-low', False, True),
+                                         ('macbookpro', 'macbookpro-charging', True, True),
+                                         ('imac', 'imac', True, False),
+                                         ('macmini', 'macmini-ups', False, False)):
+            self.swupdate.host_facts = self.swupdate.HostFacts(Prober(model, power))
+            answer = (self.swupdate.using_ac_power() or bool(self.swupdate.min_battery_level(20)),
+                      self.swupdate.is_a_laptop())
+            self.assertEqual(answer, (ok, laptop), (model, power))
+
+    def test_probed_once(self):
+        prober = Prober('macbookpro', 'macbookpro-discharging')
+        self.swupdate.host_facts = self.swupdate.HostFacts(prober)
+        for _ in range(3):
+            self.swupdate.using_ac_power()
+            self.swupdate.min_battery_level(20)
+            self.swupdate.is_a_laptop()
+        self.assertEqual(prober.calls, 2)
+        # The power state can change, so it's probed again once refreshed
+        self.swupdate.host_facts.refresh()
+        self.swupdate.using_ac_power()
+        self.assertEqual(prober.calls, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+""" Tests for jss_bulk.BulkRunner's handling of failures, and for the
+    journal of unmanaged machines.
+
+    Run with: python -m unittest discover tests
+"""
+
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jss_bulk
+
+
+class ScriptedClient(object):
+    """ Answers each path with the next of its scripted responses: a
+        status, or an exception to raise
+    """
+    def __init__(self, script):
+        self.script = dict((path, list(responses)) for path, responses in script.items())
+        self.lock = threading.Lock()
+
+    def request(self, method, path, body=None, headers=None, with_headers=False):
+        with self.lock:
+            response = self.script[path].pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response, b'', {}
+
+
+class BulkRunnerTest(unittest.TestCase):
+
+    def run_jobs(self, script, method='DELETE', **kwargs):
+        jobs = [jss_bulk.Job(path, method, path, None, None) for path in sorted(script)]
+        runner = jss_bulk.BulkRunner(ScriptedClient(script), workers=2, rate=None, backoff=0, **kwargs)
+        return dict((o.key, o) for o in runner.run(jobs))
+
+    def test_retried_delete_already_done(self):
+        outcomes = self.run_jobs({'/computers/id/1': [socket.error('reset'), 404]})
+        self.assertIsNone(outcomes['/computers/id/1'].error)
+
+    def test_delete_not_found(self):
+        outcomes = self.run_jobs({'/computers/id/1': [404]})
+        self.assertEqual(outcomes['/computers/id/1'].error, 'HTTP 404')
+
+    def test_retried_put_not_found(self):
+        outcomes = self.run_jobs({'/computers/id/1': [socket.error('reset'), 404]}, method='PUT')
+        self.assertEqual(outcomes['/computers/id/1'].error, 'HTTP 404')
+
+    def test_failing_callback(self):
+        def on_outcome(outcome):
+            raise IOError(28, 'No space left on device')
+
+        logger = logging.getLogger('test_jss_bulk')
+        logger.addHandler(logging.NullHandler())
+        script = dict(('/computers/id/{}'.format(i), [200]) for i in range(20))
+        # Would hang if a worker died
+        outcomes = self.run_jobs(script, on_outcome=on_outcome, logger=logger)
+        self.assertEqual(len(outcomes), 20)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.journal = jss_bulk.Journal(os.path.join(self.workdir, 'journal'))
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.workdir)
+
+    def test_records_sharing_a_serial(self):
+        # The same Mac enrolled twice
+        computers = {1: {'id': 1, 'name': 'lab-1', 'serial_number': 'C02X'},
+                     2: {'id': 2, 'name': 'lab-1', 'serial_number': 'C02X'}}
+        client = ScriptedClient({'/computers/id/1': [200], '/computers/id/2': [500]})
+        outcomes = jss_bulk.unmanage_computers(client, computers, journal=self.journal, workers=1,
+                                               rate=None, backoff=0, attempts=1)
+        self.assertEqual(sorted((o.key, o.error) for o in outcomes), [(1, None), (2, 'HTTP 500')])
+        self.journal.close()
+
+        # Only the one which failed is tried again
+        self.journal = jss_bulk.Journal(os.path.join(self.workdir, 'journal'))
+        client = ScriptedClient({'/computers/id/2': [200]})
+        outcomes = jss_bulk.unmanage_computers(client, computers, journal=self.journal, workers=1,
+                                               rate=None, backoff=0)
+        self.assertEqual([(o.key, o.error) for o in outcomes], [(2, None)])
+        self.assertEqual(sorted(self.journal.done), ['1', '2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
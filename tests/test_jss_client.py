@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+""" Tests for jss_client's incremental JSON parsing, in particular values
+    split across the chunks a response arrives in, and for when it sends a
+    request again on a fresh connection.
+
+    Run with: python -m unittest discover tests
+"""
+
+import json
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jss_client
+
+
+def splits(document):
+    """ Every way of cutting document into two chunks """
+    for i in range(len(document) + 1):
+        yield [document[:i], document[i:]]
+
+
+class IterJSONArrayTest(unittest.TestCase):
+
+    def members(self, chunks):
+        return list(jss_client.iter_json_array(chunks, ('computer_group', 'computers')))
+
+    def test_numbers_split_at_every_point(self):
+        computers = [1e3, 1.5, -2.25e-2, 10, 0, 1E+2, 123456789]
+        document = json.dumps({'computer_group': {'size': 7, 'computers': computers}}).encode('utf-8')
+        for chunks in splits(document):
+            self.assertEqual(self.members(chunks), computers, chunks)
+
+    def test_exponent_cut_off(self):
+        self.assertEqual(self.members([b'{"computer_group": {"computers": [1e', b'3]}}']), [1000.0])
+
+    def test_fraction_cut_off(self):
+        self.assertEqual(self.members([b'{"computer_group": {"computers": [1.', b'5, 2]}}']), [1.5, 2])
+
+    def test_records_split_at_every_point(self):
+        computers = [{'id': 12, 'name': u'Mac é', 'serial_number': 'C02X'},
+                     {'id': 7, 'name': 'lab-1', 'serial_number': ''}]
+        document = json.dumps({'computer_group': {'id': 3, 'name': 'x', 'computers': computers}},
+                              ensure_ascii=False).encode('utf-8')
+        for chunks in splits(document):
+            self.assertEqual(self.members(chunks), computers, chunks)
+
+    def test_one_byte_chunks(self):
+        document = b'{"computer_group": {"computers": [{"id": 1e2}, 3.0e1, true, null]}}'
+        chunks = [document[i:i + 1] for i in range(len(document))]
+        self.assertEqual(self.members(chunks), [{'id': 100.0}, 30.0, True, None])
+
+    def test_truncated_document(self):
+        with self.assertRaises(ValueError):
+            self.members([b'{"computer_group": {"computers": [1, 2'])
+
+
+class StubResponse(object):
+    status = 200
+    will_close = False
+
+    def read(self):
+        return b'{}'
+
+    def isclosed(self):
+        return True
+
+
+class StubConnection(object):
+    """ Fails at 'fail' ('request' or 'getresponse'), if given, and records
+        what was sent in sent
+    """
+    def __init__(self, sent, fail=None):
+        self.sent = sent
+        self.fail = fail
+
+    def request(self, method, url, body, headers):
+        if self.fail == 'request':
+            raise socket.error('broken pipe')
+        self.sent.append(method)
+
+    def getresponse(self):
+        if self.fail == 'getresponse':
+            raise jss_client.httplib.BadStatusLine('')
+        return StubResponse()
+
+    def close(self):
+        pass
+
+
+class RetryTest(unittest.TestCase):
+
+    def client(self, fail):
+        """ A client whose pooled connection fails at fail """
+        self.sent = []
+        client = jss_client.JSSClient('user', 'password', base_url='http://jss.invalid/JSSResource')
+        client._release(StubConnection(self.sent, fail))
+        client._new_connection = lambda: StubConnection(self.sent)
+        return client
+
+    def test_get_sent_again(self):
+        client = self.client('getresponse')
+        self.assertEqual(client.request('GET', '/computers')[0], 200)
+        self.assertEqual(self.sent, ['GET', 'GET'])
+
+    def test_delete_not_sent_again(self):
+        for method in ('DELETE', 'PUT', 'POST'):
+            client = self.client('getresponse')
+            with self.assertRaises(jss_client.httplib.HTTPException):
+                client.request(method, '/computers/id/1')
+            self.assertEqual(self.sent, [method])
+
+    def test_delete_retried_if_never_sent(self):
+        client = self.client('request')
+        self.assertEqual(client.request('DELETE', '/computers/id/1')[0], 200)
+        self.assertEqual(self.sent, ['DELETE'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+""" Tests for jss_credentials' in-process decryption, checked against the
+    openssl binary with both the md5 digest (/usr/bin/openssl on a Mac)
+    and sha256 (OpenSSL 1.1 and later's default).
+
+    Run with: python -m unittest discover tests
+"""
+
+import base64
+import os
+import subprocess
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jss_credentials
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+OPENSSL = which('openssl')
+SALT = '0011223344556677'
+PASSPHRASE = 'correct horse battery staple'
+DIGESTS = ('md5', 'sha256')
+
+
+def openssl(args, data=b''):
+    p = subprocess.Popen([OPENSSL] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = p.communicate(data)[0]
+    if p.returncode != 0:
+        raise RuntimeError('openssl {} failed'.format(' '.join(args)))
+    return out
+
+
+def encrypt(plain, digest, passphrase=PASSPHRASE, salt=SALT):
+    """ Encrypt as the parameters are, always with the 'Salted__' header
+        (OpenSSL 3 leaves it out when the salt is given with -S)
+    """
+    raw = openssl(['enc', '-aes256', '-md', digest, '-S', salt, '-k', passphrase], plain)
+    if not raw.startswith(jss_credentials.SALT_MAGIC):
+        raw = jss_credentials.SALT_MAGIC + bytearray.fromhex(salt) + raw
+    return base64.b64encode(bytes(raw)).decode('ascii')
+
+
+@unittest.skipIf(OPENSSL is None, 'needs the openssl binary')
+class DecryptTest(unittest.TestCase):
+
+    def setUp(self):
+        jss_credentials._cache.clear()
+        self.original_openssl = jss_credentials.OPENSSL
+        jss_credentials.OPENSSL = OPENSSL
+
+    def tearDown(self):
+        jss_credentials.OPENSSL = self.original_openssl
+
+    def test_bytes_to_key_matches_openssl(self):
+        for digest in DIGESTS:
+            printed = openssl(['enc', '-aes256', '-md', digest, '-S', SALT, '-k', PASSPHRASE, '-P']).decode('ascii')
+            values = dict(line.replace(' ', '').split('=', 1) for line in printed.splitlines() if '=' in line)
+            key, iv = jss_credentials.bytes_to_key(PASSPHRASE.encode('utf-8'), bytes(bytearray.fromhex(SALT)), digest)
+            self.assertEqual(base64.b16encode(key).decode('ascii'), values['key'].upper(), digest)
+            self.assertEqual(base64.b16encode(iv).decode('ascii'), values['iv'].upper(), digest)
+
+    def test_known_answer(self):
+        # FIPS-197 appendix C.3: AES-256 of one block, without padding
+        key = bytes(bytearray(range(32)))
+        ciphertext = base64.b16decode('8EA2B7CA516745BFEAFC49904B496089')
+        # Add a block of padding, encrypted as CBC chains it on
+        padding = openssl(['enc', '-aes-256-ecb', '-nopad', '-K', base64.b16encode(key).decode('ascii')],
+                          bytes(bytearray(a ^ b for a, b in zip(bytearray([16] * 16), bytearray(ciphertext)))))
+        plain = jss_credentials.aes256_cbc_decrypt(ciphertext + padding, key, b'\0' * 16)
+        self.assertEqual(plain, base64.b16decode('00112233445566778899AABBCCDDEEFF'))
+
+    def test_round_trip(self):
+        for digest in DIGESTS:
+            for length in (1, 15, 16, 17, 31, 32, 33, 100):
+                plain = ''.join(chr(ord('a') + i % 26) for i in range(length))
+                encrypted = encrypt(plain.encode('ascii'), digest)
+                self.assertEqual(jss_credentials.decrypt_string(encrypted, SALT, PASSPHRASE, digest), plain)
+                # And bytes in, bytes out, as on Python 2
+                self.assertEqual(jss_credentials.decrypt_string(encrypted.encode('ascii'), SALT, PASSPHRASE,
+                                                                digest), plain.encode('ascii'))
+
+    def test_matches_openssl_decrypting(self):
+        for digest in DIGESTS:
+            encrypted = encrypt(u'jss-api-user é'.encode('utf-8'), digest)
+            expected = openssl(['enc', '-aes256', '-d', '-md', digest, '-a', '-A', '-k', PASSPHRASE],
+                               encrypted.encode('ascii')).strip().decode('utf-8')
+            self.assertEqual(jss_credentials.decrypt_string(encrypted, SALT, PASSPHRASE, digest), expected)
+
+    def test_bad_padding(self):
+        for digest in DIGESTS:
+            raw = bytearray(base64.b64decode(encrypt(b'a secret of 20 bytes', digest)))
+            # Flipping a bit in the first block flips it in the padding of the last
+            raw[-17] ^= 0x01
+            with self.assertRaises(jss_credentials.DecryptError):
+                jss_credentials.decrypt_string(base64.b64encode(bytes(raw)).decode('ascii'), SALT,
+                                               PASSPHRASE, digest)
+
+    def test_wrong_passphrase(self):
+        for digest in DIGESTS:
+            encrypted = encrypt(b'some secret', digest)
+            with self.assertRaises(jss_credentials.DecryptError):
+                # Bad padding, so openssl gets a go too, and fails
+                jss_credentials.decrypt_string(encrypted, SALT, 'wrong', digest)
+
+    def test_wrong_passphrase_good_padding(self):
+        # About one wrong passphrase in 256 gives garbage with good padding,
+        # which isn't text
+        raw = base64.b64decode(encrypt(b'some secret', 'md5'))
+        for i in range(5000):
+            wrong = 'wrong {}'.format(i)
+            key, iv = jss_credentials.bytes_to_key(wrong.encode('utf-8'), raw[8:16], 'md5')
+            try:
+                garbage = jss_credentials.aes256_cbc_decrypt(raw[16:], key, iv)
+            except ValueError:
+                continue
+            try:
+                garbage.decode('utf-8')
+            except UnicodeDecodeError:
+                break
+        else:
+            self.fail('no wrong passphrase gave good padding')
+        with self.assertRaises(jss_credentials.DecryptError):
+            jss_credentials.decrypt_string(base64.b64encode(raw).decode('ascii'), SALT, wrong, 'md5')
+
+
+if __name__ == '__main__':
+    unittest.main()
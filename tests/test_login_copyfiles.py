@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+""" Tests for login-copyfiles.py, logging users in with a template and
+    home folders in a temporary directory, and waiting for home folders
+    to appear there.
+
+    Run with: python -m unittest discover tests
+"""
+
+import errno
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(REPO, 'login-copyfiles.py')
+# Who home folders are given to, when running as root
+UID = 501
+GID = 20
+
+
+def load_script():
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source('login_copyfiles', SCRIPT)
+    spec = importlib.util.spec_from_file_location('login_copyfiles', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LoginTest(unittest.TestCase):
+    """ A template in self.source, and somewhere for home folders, the
+        manifests and the store
+    """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.workdir, 'template')
+        os.mkdir(self.source)
+        self.copyfiles = copyfiles = load_script()
+        copyfiles.MANIFEST_DIR = os.path.join(self.workdir, 'manifests')
+        copyfiles.STORE_DIR = os.path.join(self.workdir, 'store')
+        # Everyone is a network user here
+        copyfiles.user_is_local = lambda user: False
+        if os.geteuid() == 0:
+            self.uid, self.gid = UID, GID
+        else:
+            self.uid, self.gid = os.getuid(), os.getgid()
+        # The script logs every file it copies
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.workdir)
+
+    def write(self, rel, data=b'contents', mode=0o644):
+        path = os.path.join(self.source, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.chmod(path, mode)
+        return path
+
+    def home(self, user='someone'):
+        return os.path.join(self.workdir, 'homes', user)
+
+    def login(self, items, user='someone'):
+        """ Log user in, returning the CopyEngine used """
+        if not os.path.isdir(self.home(user)):
+            os.makedirs(self.home(user))
+        args = {'source': self.source, 'items': items, 'target': self.home(user),
+                'uid': self.uid, 'gid': self.gid, 'user': user}
+        try:
+            self.copyfiles.main(args)
+        finally:
+            self.engine = args.get('engine')
+        return self.engine
+
+
+class OwnershipTest(LoginTest):
+
+    @unittest.skipUnless(os.geteuid() == 0, 'needs root to give files away')
+    def test_chowned_after_a_failed_item(self):
+        for i in range(10):
+            self.write('A/f{}'.format(i))
+        # Can't be copied
+        os.makedirs(os.path.join(self.source, 'B'))
+        os.symlink(os.path.join(self.source, 'nowhere'), os.path.join(self.source, 'B', 'dangling'))
+        with self.assertRaises(OSError):
+            self.login(['A', 'B'])
+        for i in range(10):
+            self.assertEqual(os.stat(os.path.join(self.home(), 'A', 'f{}'.format(i))).st_uid, UID)
+        self.assertEqual(os.stat(os.path.join(self.home(), 'A')).st_uid, UID)
+
+
+class ReadOnlyTest(LoginTest):
+
+    def setUp(self):
+        LoginTest.setUp(self)
+        self.copyfiles.READONLY_DEPLOY = 'link'
+        self.write('Library/Fonts/a.ttf', b'font a')
+
+    def target(self):
+        return os.path.join(self.home(), 'Library/Fonts/a.ttf')
+
+    def assertCopy(self):
+        st = os.lstat(self.target())
+        self.assertTrue(stat.S_ISREG(st.st_mode))
+        self.assertEqual(st.st_nlink, 1)
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o644)
+        with open(self.target(), 'rb') as f:
+            self.assertEqual(f.read(), b'font a')
+
+    def test_replaced_stays_a_copy(self):
+        self.login(['ro:Library/Fonts'])
+        self.assertEqual(os.stat(self.target()).st_nlink, 2)
+        # They replace the link with their own version
+        os.unlink(self.target())
+        with open(self.target(), 'wb') as f:
+            f.write(b'my version')
+        self.login(['ro:Library/Fonts'])
+        self.assertCopy()
+        # Then change the copy they were given
+        with open(self.target(), 'ab') as f:
+            f.write(b' and more')
+        self.login(['ro:Library/Fonts'])
+        self.assertCopy()
+        self.assertEqual(self.engine.linked, 0)
+
+
+class DeployTest(LoginTest):
+    """ Each way of deploying read-only items, as the benchmark times them """
+    files = ['Library/Fonts/dir{}/file{}'.format(i % 3, i) for i in range(12)]
+
+    def setUp(self):
+        LoginTest.setUp(self)
+        for i, rel in enumerate(self.files):
+            # Some executables, so modes are checked too
+            self.write(rel, os.urandom(4096), 0o755 if i % 4 == 0 else 0o644)
+        self.users = ['user{}'.format(i) for i in range(3)]
+
+    def deploy(self, how, user):
+        self.copyfiles.READONLY_DEPLOY = how
+        return self.login(['ro:Library/Fonts'], user)
+
+    def assertDeployed(self, user, linked):
+        for rel in self.files:
+            src = os.path.join(self.source, rel)
+            dst = os.path.join(self.home(user), rel)
+            with open(src, 'rb') as a:
+                with open(dst, 'rb') as b:
+                    self.assertEqual(a.read(), b.read(), rel)
+            mode = stat.S_IMODE(os.stat(src).st_mode)
+            if linked:
+                mode &= ~0o222
+            st = os.lstat(dst)
+            self.assertTrue(stat.S_ISREG(st.st_mode), rel)
+            self.assertEqual(stat.S_IMODE(st.st_mode), mode, rel)
+            self.assertEqual(st.st_nlink > 1, linked, rel)
+
+    def check(self, how, linked):
+        for user in self.users:
+            engine = self.deploy(how, user)
+            self.assertEqual(engine.linked, len(self.files) if linked else 0)
+            self.assertDeployed(user, linked)
+        # Nothing to do the next time
+        self.assertEqual(self.deploy(how, self.users[0]).copied, 0)
+        # A changed file reaches everyone
+        with open(os.path.join(self.source, self.files[1]), 'ab') as f:
+            f.write(b'changed')
+        for user in self.users:
+            self.assertEqual(self.deploy(how, user).copied, 1)
+            self.assertDeployed(user, linked)
+
+    def test_copy(self):
+        self.check('copy', False)
+
+    def test_clone(self):
+        # Copied where the filesystem can't clone
+        self.check('clone', False)
+
+    def test_link(self):
+        self.check('link', True)
+        # Each file is stored once, for everyone, however often it changed
+        stored = [os.path.join(d, name) for d, _, names in os.walk(self.copyfiles.STORE_DIR) for name in names]
+        self.assertEqual(len(stored), len(self.files) + 1)
+        self.assertEqual(stat.S_IMODE(os.stat(self.copyfiles.STORE_DIR).st_mode), 0o700)
+
+    def test_auto(self):
+        engine = self.deploy('auto', self.users[0])
+        self.assertEqual(engine.cloned + engine.linked, len(self.files))
+        self.assertDeployed(self.users[0], bool(engine.linked))
+
+    def test_other_filesystem(self):
+        # Hard links can't cross filesystems, and a symlink into the store
+        # would be no use, so everything is copied
+        def link(src, dst):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        original = os.link
+        os.link = link
+        try:
+            engine = self.deploy('link', self.users[0])
+        finally:
+            os.link = original
+        self.assertEqual(engine.linked, 0)
+        self.assertDeployed(self.users[0], False)
+
+    def test_tampered_store(self):
+        self.deploy('link', self.users[0])
+        stored = self.copyfiles.ContentStore(self.copyfiles.STORE_DIR).add(
+            os.path.join(self.source, self.files[2]), os.stat(os.path.join(self.source, self.files[2])))
+        # Stored files aren't writable, but we're their owner
+        os.chmod(stored, 0o600)
+        with open(stored, 'wb') as f:
+            f.write(b'tampered with')
+        os.chmod(stored, 0o444)
+        self.deploy('link', self.users[1])
+        self.assertDeployed(self.users[1], True)
+
+    def test_symlinked_store(self):
+        store = self.copyfiles.STORE_DIR
+        os.mkdir(store + '.real', 0o700)
+        os.symlink(store + '.real', store)
+        engine = self.deploy('link', self.users[0])
+        self.assertEqual(engine.linked, 0)
+        self.assertDeployed(self.users[0], False)
+        self.assertEqual(os.listdir(store + '.real'), [])
+
+    def test_prune(self):
+        for user in self.users:
+            self.deploy('link', user)
+        store = self.copyfiles.ContentStore(self.copyfiles.STORE_DIR)
+        self.assertEqual(store.prune(min_age=0), 0)
+        # Once everyone's copy has gone, nothing needs the stored files
+        shutil.rmtree(os.path.join(self.workdir, 'homes'))
+        self.assertEqual(store.prune(min_age=0), len(self.files))
+        # But recently linked ones are kept, in case another login is
+        # about to link to them
+        self.deploy('link', self.users[0])
+        shutil.rmtree(os.path.join(self.workdir, 'homes'))
+        self.assertEqual(store.prune(), 0)
+
+
+class WaitForTargetTests(object):
+    """ wait_for_target() with the backend self.backend() returns, for
+        both the home folder and the folder above it appearing late
+    """
+    delay = 0.3
+    # How soon after the folder appears the wait should notice
+    latency = 0.3
+
+    def setUp(self):
+        LoginTest.setUp(self)
+        self.users = os.path.join(self.workdir, 'Users')
+        os.mkdir(self.users)
+        self.watch = self.backend()
+
+    def wait(self, target, maxwait, *dirs):
+        """ Make dirs one after another, delay seconds apart, while waiting
+            for target. Returns (found, seconds after the last was made)
+        """
+        created = []
+
+        def appear():
+            for directory in dirs:
+                time.sleep(self.delay)
+                os.mkdir(directory)
+            created.append(time.time())
+        thread = threading.Thread(target=appear)
+        thread.start()
+        try:
+            start = time.time()
+            found = self.copyfiles.wait_for_target(target, maxwait, self.watch)
+            returned = time.time()
+        finally:
+            thread.join()
+        return found, returned - (created[0] if dirs else start)
+
+    def test_appears(self):
+        target = os.path.join(self.users, 'someone')
+        found, seconds = self.wait(target, 5, target)
+        self.assertTrue(found)
+        self.assertLess(seconds, self.latency)
+
+    def test_appears_nested(self):
+        network = os.path.join(self.users, 'network')
+        target = os.path.join(network, 'someone')
+        found, seconds = self.wait(target, 5, network, target)
+        self.assertTrue(found)
+        self.assertLess(seconds, self.latency)
+
+    def test_already_there(self):
+        found, seconds = self.wait(self.users, 5)
+        self.assertTrue(found)
+        self.assertLess(seconds, 0.1)
+
+    def test_times_out(self):
+        found, seconds = self.wait(os.path.join(self.users, 'someone'), 0.5)
+        self.assertFalse(found)
+        self.assertGreaterEqual(seconds, 0.5)
+        self.assertLess(seconds, 1)
+
+
+class PollingWaitTest(WaitForTargetTests, LoginTest):
+    # It looks once a second
+    latency = 1.2
+
+    def backend(self):
+        return self.copyfiles.PollingDirectoryBackend
+
+
+class WatchedWaitTest(WaitForTargetTests, LoginTest):
+    """ With whatever watch_directory() uses here: inotify on Linux,
+        kqueue on macOS
+    """
+    def backend(self):
+        watched = self.copyfiles.watch_directory(self.users)
+        watched.close()
+        if isinstance(watched, self.copyfiles.PollingDirectoryBackend):
+            self.skipTest("can't watch directories here")
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+""" Tests for coreconfig-softwareupdate-run.py, run against
+    benchmarks/fake_softwareupdate.py in place of softwareupdate, with
+    the preferences served by MockPreferencesBackend.
+
+    The script is Python 2, so these only run under Python 2.
+
+    Run with: python -m unittest discover tests
+"""
+
+import json
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(REPO, 'coreconfig-softwareupdate-run.py')
+FAKE = os.path.join(REPO, 'benchmarks', 'fake_softwareupdate.py')
+# The fake's settings, put back after each test
+FAKE_ENVIRONMENT = ('FAKE_SWUPDATE_CATALOG', 'FAKE_SWUPDATE_CACHE', 'FAKE_SWUPDATE_DOWNLOAD',
+                    'FAKE_SWUPDATE_INSTALL', 'FAKE_SWUPDATE_LOG')
+
+
+def load_script():
+    import imp
+    swupdate = imp.load_source('swupdate_run', SCRIPT)
+    swupdate.logger.addHandler(logging.NullHandler())
+    return swupdate
+
+
+def make_catalog(count):
+    return [{'Product Key': '041-{:05d}'.format(i),
+             'Identifier': 'FakeUpdate{}'.format(i),
+             'Display Name': 'Fake Update {}'.format(i),
+             'Display Version': '1.0.{}'.format(i)} for i in range(count)]
+
+
+@unittest.skipIf(sys.version_info[0] > 2, 'the script is Python 2')
+class FakeSoftwareUpdateTest(unittest.TestCase):
+    """ Points the script at the fake softwareupdate, with its state files
+        in a temporary directory
+    """
+    updates = 3
+
+    def setUp(self):
+        self.environ = dict((name, os.environ.get(name)) for name in FAKE_ENVIRONMENT)
+        self.workdir = tempfile.mkdtemp()
+        self.swupdate = swupdate = load_script()
+        self.catalog = make_catalog(self.updates)
+        with open(os.path.join(self.workdir, 'catalog.json'), 'w') as catalog_file:
+            json.dump(self.catalog, catalog_file)
+        # A wrapper, so the fake runs with this Python whatever its #! says
+        wrapper = os.path.join(self.workdir, 'softwareupdate')
+        with open(wrapper, 'w') as script:
+            script.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, FAKE))
+        os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IXUSR)
+        cache = os.path.join(self.workdir, 'Updates')
+        os.mkdir(cache)
+        os.environ.update({'FAKE_SWUPDATE_CATALOG': os.path.join(self.workdir, 'catalog.json'),
+                           'FAKE_SWUPDATE_CACHE': cache,
+                           'FAKE_SWUPDATE_DOWNLOAD': '0',
+                           'FAKE_SWUPDATE_INSTALL': '0',
+                           'FAKE_SWUPDATE_LOG': os.path.join(self.workdir, 'commands.jsonl')})
+
+        swupdate.SWUPDATE = wrapper
+        swupdate.UPDATES_CACHE = cache
+        swupdate.updates_cache = swupdate.UpdatesCacheIndex(cache)
+        swupdate.restart_cache = swupdate.RestartCache(os.path.join(self.workdir, 'restart-cache.plist'))
+        swupdate.sync_state = swupdate.SyncState(os.path.join(self.workdir, 'sync-state.plist'))
+        swupdate.metrics = swupdate.PhaseMetrics(os.path.join(self.workdir, 'metrics.jsonl'))
+        self.prefs = swupdate.MockPreferencesBackend({swupdate.SWUPDATE_PREFS: {'RecommendedUpdates': self.catalog}})
+        swupdate.updates_snapshot = swupdate.UpdateSnapshot(self.prefs)
+        # Nobody is at the console, and nobody is logged in remotely
+        swupdate.console_user = lambda: None
+        swupdate.nobody_logged_in = lambda: False
+        # is_downloaded() prints
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        self.swupdate.metrics.close()
+        for name, value in self.environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(self.workdir)
+
+    def commands(self):
+        """ The arguments of each command the fake ran """
+        with open(os.environ['FAKE_SWUPDATE_LOG']) as log:
+            return [json.loads(line)['args'] for line in log]
+
+
+class UpdateSnapshotTest(FakeSoftwareUpdateTest):
+
+    def process_updates(self, batch):
+        return self.swupdate.process_updates({'DOWNLOAD_CONCURRENCY': 2, 'SYNC_FRESHNESS': 0,
+                                              'BATCH_INSTALLS': batch}, None)
+
+    def installed(self):
+        return sorted(arg for args in self.commands() if '-i' in args for arg in args[1:])
+
+    def test_one_preferences_read_per_run(self):
+        for batch in (True, False):
+            self.prefs.reads = 0
+            self.swupdate.updates_snapshot.invalidate()
+            self.assertTrue(self.process_updates(batch))
+            self.assertEqual(self.prefs.reads, 1, 'batch' if batch else 'one at a time')
+
+    def test_everything_installed(self):
+        self.process_updates(True)
+        self.assertEqual(self.installed(), sorted(self.swupdate.update_label(u) for u in self.catalog))
+
+    def test_invalidated_by_sync(self):
+        self.assertEqual(len(self.swupdate.updates_snapshot), self.updates)
+        self.swupdate.sync_update_list(0)
+        len(self.swupdate.updates_snapshot)
+        self.assertEqual(self.prefs.reads, 2)
+
+    def test_invalidated_by_install(self):
+        for install in (lambda: self.swupdate.install_update(self.catalog[0]),
+                        lambda: self.swupdate.install_updates(self.catalog[1:])):
+            len(self.swupdate.updates_snapshot)
+            reads = self.prefs.reads
+            install()
+            len(self.swupdate.updates_snapshot)
+            self.assertEqual(self.prefs.reads, reads + 1)
+
+
+class BatchInstallTest(FakeSoftwareUpdateTest):
+    updates = 4
+
+    def test_batches_overlap_downloads(self):
+        os.environ['FAKE_SWUPDATE_DOWNLOAD'] = '0.5'
+        os.environ['FAKE_SWUPDATE_INSTALL'] = '1'
+        self.swupdate.process_updates({'DOWNLOAD_CONCURRENCY': 1, 'SYNC_FRESHNESS': 0,
+                                       'BATCH_INSTALLS': True}, None)
+        with open(os.environ['FAKE_SWUPDATE_LOG']) as log:
+            commands = [json.loads(line) for line in log]
+        installed = sorted(arg for c in commands if '-i' in c['args'] for arg in c['args'][1:])
+        self.assertEqual(installed, sorted(self.swupdate.update_label(u) for u in self.catalog))
+        installs = [c for c in commands if '-i' in c['args']]
+        last_download = max(c['end'] for c in commands if '-d' in c['args'])
+        # The first download is installed while the rest download, and
+        # those which finish meanwhile are installed together
+        self.assertLess(installs[0]['start'], last_download)
+        self.assertLess(len(installs), len(self.catalog))
+
+
+class DownloadUpdatesTest(FakeSoftwareUpdateTest):
+
+    def test_downloads(self):
+        downloaded = list(self.swupdate.download_updates(self.catalog, 2))
+        self.assertEqual(sorted(u['Product Key'] for u in downloaded), sorted(u['Product Key'] for u in self.catalog))
+        self.assertTrue(all(self.swupdate.is_downloaded(u) for u in self.catalog))
+
+    def test_timeout_kills_the_download(self):
+        os.environ['FAKE_SWUPDATE_DOWNLOAD'] = '2'
+        self.swupdate.DOWNLOAD_TIMEOUT = 0.3
+        self.swupdate.KILL_GRACE = 0.5
+        start = time.time()
+        with self.assertRaises(self.swupdate.CommandTimeout):
+            list(self.swupdate.download_updates(self.catalog[:1], 1))
+        self.assertLess(time.time() - start, 1.5)
+        # Had it been left running, it would have finished by now
+        time.sleep(2.5)
+        self.assertFalse(os.path.exists(os.environ['FAKE_SWUPDATE_LOG']))
+        self.assertFalse(self.swupdate.is_downloaded(self.catalog[0]))
+        with open(os.path.join(self.workdir, 'metrics.jsonl')) as metrics:
+            self.assertEqual([json.loads(line)['outcome'] for line in metrics], ['timeout'])
+
+
+if __name__ == '__main__':
+    unittest.main()
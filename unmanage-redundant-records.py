@@ -1,13 +1,20 @@
 #!/usr/bin/python
 
 # Import resources
-import urllib2
-import base64
 import getpass
-import subprocess
 from collections import OrderedDict
 import json
 import sys
+# The shared jss_* modules. Jamf only runs the script itself, so they're
+# installed in JSS_MODULES by the JSS tools package (see README.md)
+JSS_MODULES = '/Library/Management/UoE/jss-modules'
+sys.path.append(JSS_MODULES)
+import jss_client
+import jss_credentials
+import jss_events
+import jss_cache
+import jss_bulk
+import jss_records
 import logging
 import datetime
 import os
@@ -35,6 +42,14 @@ else:
 
 log_file = "/Library/Logs/JSSRecordsRemoved/%s.log" % current_short_date
 
+# JSS IDs of the machines unmanaged so far. Kept until a run completes
+# without errors, so if we're interrupted the next run only deals with
+# what's left.
+journal_file = "/Library/Logs/JSSRecordsUnmanaged/unmanaged-ids.journal"
+
+# One line of JSON for every request made for a record, for later analysis
+events_file = "/Library/Logs/JSSRecordsUnmanaged/events.jsonl"
+
 # Create logger object and set default logging level
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -58,93 +73,92 @@ file_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 logger.addHandler(file_handler)
 
+# Events are queued and written out by a background thread, so logging them
+# never holds up the requests
+events = jss_events.EventLog(events_file)
+
 # Function to close and remove logging handlers
 def close_logger():
+    events.close()
     console_handler.close()
     file_handler.close()
     logger.removeHandler(console_handler)
     logger.removeHandler(file_handler)
 
-# Function for sorting dictionary by keys
-def sort_dict_by_keys(temp_comp_dict):
-    dict_upper = {k.upper(): v for k, v in temp_comp_dict.iteritems()}
-    sorted_dict = OrderedDict(sorted(dict_upper.items(), key=lambda t: t[0]))
-    # Return sorted dictionary
-    return sorted_dict
-
 # Function to obtain computers from the JSS
-def get_computers(username, password):
-    URL = "https://uoe.jamfcloud.com/JSSResource/computergroups/name/Compliance%20-%20No%20check-in%20for%20over%20300%20days"
+def get_computers(client):
+    group = "Compliance - No check-in for over 300 days"
     logger.info("\n")
     logger.info('Obtaining information from JSS smart group "Compliance - No check-in for over 300 days":')
-    # Open connection to JSS, passing search string, The request will return JSON.
-    request = urllib2.Request(URL)
-    request.add_header('Accept','application/json')
-    request.add_header('Authorization', 'Basic ' + base64.b64encode(username + ':' + password))
-    response = urllib2.urlopen(request)
-    # Print message to display if info was obtained
-    logger.info("Status code from request: %s\n" % response.code)
-    # Store the response from the JSS
-    response_json = json.loads(response.read())
-    # The following code can be used to display all details from the response. For the moment we are only interested in name and serial.
-    #print json.dumps(response_json,sort_keys=True, indent=4)
-    # Declare empty dictionary to store results'
-    comp_group = {}
-    # For each computer record returned, get the computer name and the serial number
-    for computer in response_json['computer_group']['computers']:
-        comp_group[(computer.get('name'))]=computer.get('serial_number')
+    # Always check with the JSS before acting on records, but go through the local
+    # cache so only the differences are written back, and interactive queries
+    # afterwards can be answered locally.
+    cache = jss_cache.GroupCache()
+    comp_group = cache.members(client, group, max_age=0)
+    refresh = cache.last_refresh
+    logger.info("Group membership changes since last fetch: %d added, %d removed, %d changed" % (refresh.added, refresh.removed, refresh.changed))
+    cache.close()
     #Find amount of computers
     amount = len(comp_group.keys())
     # Return amount of computers and the full list
     return comp_group, amount
 
-def unmanage_computers(username, password, computers):
-    payload = "<computer><general><remote_management><managed>false</managed></remote_management></general></computer>"
-    for comp in computers:
-        logger.info("Attempting to unmanage %s in the JSS...." % comp)
-        URL = "https://uoe.jamfcloud.com/JSSResource/computers/name/%s" % comp
-        request = urllib2.Request(URL)
-        request.add_header('Authorization', 'Basic ' + base64.b64encode(username + ':' + password))
-        request.add_header('Content-Type','text/xml')
-        request.get_method = lambda: 'PUT'
-        response = urllib2.urlopen(request, payload)
-        response_code = response.code
-        if (response_code == 201):
-            logger.info("%s successfully unmanaged!" % comp)
-        else:
-            logger.info("Unable to unmanage %s" % comp)
-
 def DecryptString(inputString, salt, passphrase):
     '''Usage: >>> DecryptString("Encrypted String", "Salt", "Passphrase")'''
-    p = subprocess.Popen(['/usr/bin/openssl', 'enc', '-aes256', '-d', '-a', '-A', '-S', salt, '-k', passphrase], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
-    return p.communicate(inputString)[0].strip()
+    # Decrypted in-process and cached, falling back to /usr/bin/openssl
+    return jss_credentials.decrypt_string(inputString, salt, passphrase)
 
 # Get encrypted strings
 apiuser = str(sys.argv[4])
 apipword = str(sys.argv[5])
 salt = str(sys.argv[6])
 passphrase = str(sys.argv[7])
+# Optional concurrency and requests-per-second limit for the unmanage requests
+try:
+    workers = int(sys.argv[8])
+except (IndexError, ValueError):
+    workers = jss_bulk.WORKERS
+try:
+    rate = float(sys.argv[9])
+except (IndexError, ValueError):
+    rate = jss_bulk.RATE
 
 # De-crypt strings
-JSSusername = DecryptString(apiuser ,salt, passphrase)
-JSSpword = DecryptString(apipword ,salt, passphrase)
+try:
+    JSSusername = DecryptString(apiuser ,salt, passphrase)
+    JSSpword = DecryptString(apipword ,salt, passphrase)
+except jss_credentials.DecryptError as err:
+    logger.error("Unable to decrypt the JSS credentials: %s" % err)
+    close_logger()
+    sys.exit(1)
+
+# Connect to the JSS. Connections are kept open and shared by every request,
+# with one per worker.
+client = jss_client.JSSClient(JSSusername, JSSpword, pool_size=workers)
 
 # Get list of machines that have not contacted JSS in over 300 days
-comp_dict, total_amount= get_computers(JSSusername, JSSpword)
+comp_dict, total_amount= get_computers(client)
 
 # Sort the machines by name
-sorted_comp = sort_dict_by_keys(comp_dict)
+sorted_comp = jss_records.sort_by_name(comp_dict)
 
 # Print out list of machines
 logger.info("Total amount not seen in over 300 days : %d" % total_amount)
-logger.info("Complete list of machines not checked in in over 300 days")
-logger.info("===========================================================")
-logger.info((json.dumps(sorted_comp, indent=35, sort_keys=True)))
+# Each machine's result is written to the event log as its request completes
 logger.info("Preparing to unmanage machines...")
 
-# Remove the records
-unmanage_computers(JSSusername, JSSpword, sorted_comp)
+# Unmanage the machines
+journal = jss_bulk.Journal(journal_file)
+outcomes = jss_records.unmanage_computers(client, sorted_comp, journal, workers, rate, logger, events)
+client.close()
 
-logger.info("JSS Records unmanaged!")
+if all(o.error is None for o in outcomes):
+    # Everything is done, so the next run can start afresh
+    journal.clear()
+    logger.info("JSS Records unmanaged!")
+else:
+    logger.warn("JSS Records unmanaged, with errors. %d machines are journalled as done and will be skipped next time." % len(journal))
+journal.close()
 
-close_logger()
\ No newline at end of file
+jss_records.close_events(events, logger)
+close_logger()